@@ -0,0 +1,80 @@
+"""Suggest indexes for the queries the server has been asked for."""
+from __future__ import print_function
+from optparse import make_option
+from magpy.server.database import Database
+from magpy.server.indexes import index_name
+from magpy.server.queries import QUERY_STATS_COLLECTION, \
+    explain_summary, needs_index, suggest_index, placeholder_spec, \
+    load_shape
+from magpy.management import BaseCommand, CommandError
+
+# Not magpy_, so that load_models does not drop them.
+ADVICE_PREFIX = 'advised_'
+
+
+class Command(BaseCommand):
+    """Explain the most used list queries and suggest indexes for them."""
+    help = ('Explain the most used list queries and suggest indexes '
+            'for them.')
+    args = '[resource ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--create', dest='create',
+                    action='store_true', default=False,
+                    help='Create the suggested indexes.'),
+        make_option('--top', dest='top',
+                    type='int', default=10,
+                    help='How many of the query shapes to look at, '
+                    'by total time taken (default 10).'),)
+
+    def handle(self, *args, **kwargs):
+        database = Database().database
+        spec = {'resource': {'$in': list(args)}} if args else {}
+        shapes = list(database[QUERY_STATS_COLLECTION].find(spec).sort(
+            'total_ms', -1).limit(kwargs.get('top', 10)))
+        if not shapes:
+            raise CommandError(
+                "No queries have been recorded yet. "
+                "(Is query_stats_interval set to 0?)")
+        for stats in shapes:
+            self.advise(database, stats, kwargs.get('create'))
+
+    @staticmethod
+    def advise(database, stats, create=False):
+        """Explain one query shape and suggest an index for it."""
+        collection = database[stats['resource']]
+        shape = load_shape(stats['shape'])
+        sort = [tuple(pair) for pair in stats.get('sort', [])]
+        # The values are not kept, so explain the shape with placeholders
+        cursor = collection.find(placeholder_spec(shape))
+        if sort:
+            cursor = cursor.sort(sort)
+        summary = explain_summary(cursor.explain())
+
+        print("%s %s sort %s" % (stats['resource'], shape, sort))
+        print("    Used %s times, average %.1fms" % (
+            stats['count'], stats['total_ms'] / max(stats['count'], 1)))
+        print("    Uses %s, examined %s to return %s%s" % (
+            summary['index'] or 'a collection scan',
+            summary['examined'],
+            summary['returned'],
+            ', sorted in memory' if summary['in_memory_sort'] else ''))
+
+        if not needs_index(summary):
+            return
+        fields = suggest_index(shape, sort)
+        if fields is None:
+            print("    No single index can be suggested.")
+            return
+        existing = [tuple(tuple(pair) for pair in info['key'])
+                    for info in collection.index_information().values()]
+        if tuple(fields) in existing:
+            print("    The index %s exists but is not used well." % fields)
+            return
+
+        print("    Suggested index: %s" % [list(pair) for pair in fields])
+        if create:
+            name = index_name(fields, ADVICE_PREFIX)
+            collection.create_index(fields, name=name, background=True)
+            print("    Created index %s" % name)
+        print("    To keep it, add {'fields': %s} to the _indexes "
+              "of the model." % [list(pair) for pair in fields])
@@ -1,13 +1,9 @@
 """Load models from an app."""
 from __future__ import print_function
-from __future__ import print_function
-from __future__ import print_function
-from __future__ import print_function
-from __future__ import print_function
-from __future__ import print_function
-from __future__ import print_function
+from optparse import make_option
 from magpy.server.instances import InstanceLoader
 from magpy.server.database import Database
+from magpy.server.indexes import ensure_indexes
 from magpy.management import BaseCommand, CommandError
 import importlib
 
@@ -16,6 +12,10 @@ class Command(BaseCommand):
     """Load the models from app_name(s)."""
     help = ('Load the models from app_name(s).')
     args = '[app_name ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--no-indexes', dest='no_indexes',
+                    action='store_true', default=False,
+                    help='Do not create the indexes of the models.'),)
 
     def handle(self, *args, **kwargs):
         models = []
@@ -33,13 +33,14 @@ class Command(BaseCommand):
             new_models = getattr(models_module, 'MODELS', [])
             for index, model in enumerate(new_models):
                 self.validate_model(model, index, module_name)
-                self.index_model(model)
 
             models.extend(new_models)
 
         instanceloader = InstanceLoader(validation=False)
         instanceloader.add_instances(models)
         print("")
+        if not kwargs.get('no_indexes'):
+            ensure_indexes(instanceloader.database.database, models)
 
     def validate_model(self, model, index, module_name):
         """Check each model for basic sanity."""
@@ -60,12 +61,6 @@ class Command(BaseCommand):
                 "'modeldescription' key" % (index, module_name))
             print("Warning: Apps which assume a modeldescription may break.")
 
-    def index_model(self, model):
-        """Make sure each key has an index."""
-        for field in model:
-            if field is not '_id':
-                print ("Index:", field)
-
     @staticmethod
     def _abort(index, module_name):
         """Abort due to invalid model."""
@@ -20,7 +20,18 @@ class Command(BaseCommand):
         make_option('--conf', '-c', dest='config',
                     action='store',
                     type='string',
-                    help='Location of config file.'),)
+                    help='Location of config file.'),
+        make_option('--indexes', dest='create_indexes',
+                    action='store_true', default=False,
+                    help='Create any missing model indexes at startup.'),
+        make_option('--production', dest='production',
+                    action='store_true', default=None,
+                    help='Run in several processes, without debug '
+                    'or autoreload.'),
+        make_option('--processes', dest='processes',
+                    action='store', type='int', default=None,
+                    help='Number of processes in production, '
+                    '0 for one per CPU.'),)
 
     def handle(self, *args, **kwargs):
         loader = URLLoader()
@@ -28,4 +39,7 @@ class Command(BaseCommand):
         base.main(
             urls,
             kwargs['port'],
-            kwargs['config'])
+            kwargs['config'],
+            kwargs['create_indexes'],
+            kwargs['production'],
+            kwargs['processes'])
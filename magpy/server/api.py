@@ -3,13 +3,9 @@ from __future__ import print_function
 
 from datetime import datetime
 from copy import deepcopy
-import json
-import re
-import os
-import base64
+import time
 
 import tornado.web
-from bson import json_util
 from functools import partial
 from magpy.server.validators import validate_model_instance, \
     ValidationError, MissingFields
@@ -18,6 +14,14 @@ from magpy.server.auth import AuthenticationMixin, WhoAmIMixin, \
     permission_required
 from magpy.server.database import DatabaseMixin, ValidationMixin
 from magpy.server.utils import dejsonify, instance_list_to_dict
+from magpy.server.serialization import dumps, loads
+from magpy.server.streaming import ListStreamWriter
+from magpy.server.conditional import ConditionalMixin, instance_etag, \
+    list_etag
+from magpy.server.media import MediaMixin, parse_data_uri, media_url, \
+    write_files, write_many_files, delete_files, replace_files
+from magpy.server.paging import paging_sort, make_after_token, \
+    parse_after_token, add_after_to_spec, include_sort_fields
 import six
 
 
@@ -25,17 +29,19 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
                           DatabaseMixin,
                           AuthenticationMixin,
                           ValidationMixin,
-                          WhoAmIMixin):
+                          WhoAmIMixin,
+                          ConditionalMixin,
+                          MediaMixin):
     """
     finds the overall collection and performs the relevant method upon it.
     """
     # pylint: disable=W0221,R0904
 
-    writing = False
-    new_instances = {}
-    validated_instances = []
-    _output_instances = []
-    _post_history_instances = []
+    stream_writer = None
+    paging_sort = None
+    paging_after = None
+    paging_limit = None
+    query_started = None
 
     @tornado.web.asynchronous
     @permission_required('delete')
@@ -44,8 +50,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         body = self.request.body
         if six.PY3 and isinstance(body, six.binary_type):
             body = body.decode('utf8')
-        data = json.loads(body,
-                          object_hook=json_util.object_hook)
+        data = loads(body)
         if not 'ids' in data:
             raise tornado.web.HTTPError(400, "No ids to delete")
 
@@ -71,15 +76,14 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         
     
     def _get_model(self, response, error, ids, resource):
-        coll = self.get_collection('_model')
         success = partial(self._check_files_in_model,
                           resource=resource,
                           ids=ids)
-        coll.find({'_id': resource}).to_list(callback=success)
-        
-    def _check_files_in_model(self, response, error, resource, ids):
-        if '_file_fields' in response[0]:
-            self._get_instances(response[0]['_file_fields']['fields'], resource, ids)
+        self.get_model(resource, callback=success)
+
+    def _check_files_in_model(self, model, error, resource, ids):
+        if model and '_file_fields' in model:
+            self._get_instances(model['_file_fields']['fields'], resource, ids)
         else:
             self._do_multiple_delete(ids, resource)
 
@@ -93,11 +97,20 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
 
         
     def _delete_files(self, response, error, file_fields, resource, ids):
-        for json in response:
-            for field in file_fields:
-                file = json[field].replace('/media/', '/srv/itsee/mediamanager/restricted/')
-                if os.path.isfile(file):
-                    os.unlink(file)
+        """Delete the media files of the instances."""
+        urls = [instance.get(field) for instance in response
+                for field in file_fields]
+        callback = partial(self._files_deleted,
+                           resource=resource,
+                           ids=ids)
+        self.run_media(delete_files, callback, self.media_root,
+                       resource, urls)
+
+    def _files_deleted(self, response, error, resource, ids):
+        """Now delete the instances."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
         self._do_multiple_delete(ids, resource)
 
     @tornado.web.asynchronous
@@ -114,6 +127,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
 
     def _delete_success(self, response, error, resource, ids):
         """Return the deleted ids."""
+        self.notify_change(resource, ids)
         self._return_data(
             {'resource': resource,
              'ids': ids})
@@ -252,14 +266,11 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         if six.PY3 and isinstance(body, six.binary_type):
             body = body.decode('utf8')
 
-        data = json.loads(body,
-                          object_hook=json_util.object_hook)
+        data = loads(body)
 
         if 'fields' in data:
             return self._field_get_user(resource, data)
 
-        self._output_instances = []
-        self._post_history_instances = []
         return self._request_model({'_model': resource},
                                    self._get_batch_update_user,
                                    False)
@@ -287,8 +298,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         if six.PY3 and isinstance(body, six.binary_type):
             body = body.decode('utf8')
 
-        data = json.loads(body,
-                          object_hook=json_util.object_hook)
+        data = loads(body)
         # 3. Now we get all the ids of the previous instances.
         if 'ids' in data:
             ids = data['ids']
@@ -406,6 +416,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         # Check that old instances are different than new
         # and update _meta field in new ones.
         changed = []
+        unchanged = []
         versional_comment = data.get('_versional_comment', None)
         instance_dict = instance_list_to_dict(
             deepcopy(previous_instances))
@@ -421,69 +432,56 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
             if new_with_meta:
                 changed.append(new_with_meta)
             else:
-                self._output_instances.append(old_instance)
-
-        # Go through changed and validate it
-        return self._validate_sequentially(None, changed)
-
-    def _validate_sequentially(self,
-                                         instance,
-                                         changed):
-        """Validate each instance in turn."""
-        # If we have an instance, then it is a valid instance
-        if instance:
-            self.validated_instances.append(instance)
+                unchanged.append(old_instance)
 
-        # If we have run out of instances, then we are done.
         if not changed:
-            return self._sequentially_add_to_history(None, None, None)
+            return self._return_data({'instances': unchanged})
 
-        # Get the next instance
-        next_instance = changed.pop()
-
-        # On success come back
-        success = partial(
-            self._validate_sequentially,
-            changed=changed)
-
-        self.validate_instance(next_instance, success)
-
-    def _sequentially_add_to_history(self,
-                                     version,
-                                     error,
-                                     instance):
-        """Add each instance to history, and then move to the next.
-        We can probably refactor out this recursive approach now the
-        underlying driver supports lists."""
-        if instance:
-            self._post_history_instances.append(instance)
-        if not self.validated_instances:
-            return self._update_instances_sequentially(None)
-        new_instance = self.validated_instances.pop()
-        if '_versional_comment' in new_instance:
-            versional_comment = new_instance['_versional_comment']
-            del new_instance['_versional_comment']
-        else:
-            versional_comment = "Instance created"
-
-        self.add_version_to_history(
-            response=None, instance=new_instance,
-            callback=self._sequentially_add_to_history,
-            versional_comment=versional_comment)
+        # Validate all the changed instances in one go
+        callback = partial(self._batch_validated,
+                           resource=resource,
+                           changed=changed,
+                           unchanged=unchanged,
+                           previous=[instance_dict[instance['_id']]
+                                     for instance in changed])
+        return self.validate_instances(changed, callback)
+
+    def _batch_validated(self, problems, resource, changed, unchanged,
+                         previous=None):
+        """If they are all valid, add them all to the history."""
+        for instance, problem in zip(changed, problems):
+            if problem:
+                raise tornado.web.HTTPError(
+                    400, "%s: %s" % (instance['_id'], problem))
+
+        comments = [instance.pop('_versional_comment', 'Instance updated')
+                    for instance in changed]
+        callback = partial(self._batch_history_written,
+                           resource=resource,
+                           changed=changed,
+                           unchanged=unchanged)
+        self.update_history(changed, 'update', callback, comments,
+                            previous)
+
+    def _batch_history_written(self, response, error, resource,
+                               changed, unchanged):
+        """Now write all the updates at once."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        callback = partial(self._batch_updated,
+                           resource=resource,
+                           changed=changed,
+                           unchanged=unchanged)
+        self.replace_instances(resource, changed, callback)
 
-    def _update_instances_sequentially(self, instance, error=None):
-        """Go through each of the instances and update the database."""
-        # If we have an instance, then it is a valid instance
-        if instance:
-            self._output_instances.append(instance)
-        if not self._post_history_instances:
-            # We are done finish up.
-            return self._return_data({'instances': self._output_instances})
-        next_instance = self._post_history_instances.pop()
-        coll = self.get_collection(next_instance['_model'])
-        coll.update({'_id': next_instance['_id']},
-                    next_instance,
-                    callback=self._update_instances_sequentially)
+    def _batch_updated(self, response, error, resource, changed, unchanged):
+        """Return all the instances, changed or not."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        self.notify_change(resource, [instance['_id'] for
+                                      instance in changed])
+        return self._return_data({'instances': unchanged + changed})
 
     #for files we may need to remove permission required setting not sure when that kicks in
     @tornado.web.asynchronous
@@ -495,8 +493,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         if six.PY3 and isinstance(body, six.binary_type):
             body = body.decode('utf8')
         
-        data = json.loads(body,
-                          object_hook=json_util.object_hook)
+        data = loads(body)
 
 
         if isinstance(data, dict):
@@ -509,23 +506,14 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
                 coll = self.get_collection(resource)
                 coll.find_one({'_id': data['_id']},
                               callback=callback)
-        else :
-            for object in data:
-                if not '_id' in object:
-                    # Skip straight on
-                    self.validate_instance(object, self._create_instance)
-                else:
-                    callback = partial(self._process_post, data=object)
-                    coll = self.get_collection(resource)
-                    coll.find_one({'_id': object['_id']},
-                                  callback=callback)
+        else:
+            self._bulk_create(resource, data)
     @tornado.web.asynchronous
     @permission_required('create')              
     def _post_JSON(self, resource):
         """Create a new instance.
         Start by looking if it already exists!"""
-        data = json.loads(self.request.body,
-                          object_hook=json_util.object_hook)
+        data = loads(self.request.body)
         if isinstance(data, dict):
             if not '_id' in data:
                 # Skip straight on
@@ -535,18 +523,196 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
                 coll = self.get_collection(resource)
                 coll.find_one({'_id': data['_id']},
                               callback=callback)
-        else :
-            for object in data:
-                if not '_id' in object:
-                    # Skip straight on
-                    self.validate_instance(object, self._create_instance)
-                else:
-                    callback = partial(self._process_post, data=object)
-                    coll = self.get_collection(resource)
-                    coll.find_one({'_id': object['_id']},
-                                  callback=callback)
+        else:
+            self._bulk_create(resource, data)
         
 
+    def _bulk_create(self, resource, instances):
+        """Create a list of instances together.
+        There is one existence check, one validation pass, one user lookup,
+        one insert and one history insert for the whole list.
+        The response has a status for each instance, in the same order."""
+        results = []
+        batch = []
+        ids = set()
+        for instance in instances:
+            if not isinstance(instance, dict) or \
+                    instance.get('_model') != resource:
+                results.append({'status': 400,
+                                'error': 'Missing or wrong model key'})
+                continue
+            if '_id' not in instance:
+                instance['_id'] = str(ObjectId())
+            result = {'_id': instance['_id'], 'status': None}
+            results.append(result)
+            if instance['_id'] in ids:
+                result['status'] = 409
+                result['error'] = 'Duplicate _id'
+                continue
+            ids.add(instance['_id'])
+            batch.append((result, instance))
+
+        if not batch:
+            return self._bulk_created(None, None, resource, results)
+
+        callback = partial(self._bulk_check_existing,
+                           resource=resource,
+                           batch=batch,
+                           results=results)
+        coll = self.get_collection(resource)
+        coll.find(spec={'_id': {'$in': list(ids)}},
+                  fields=['_id']).to_list(callback=callback)
+
+    def _bulk_check_existing(self, existing, error, resource, batch, results):
+        """Leave out the instances that already exist, validate the rest."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        existing_ids = set(instance['_id'] for instance in existing)
+        remaining = []
+        for result, instance in batch:
+            if instance['_id'] in existing_ids:
+                # We have already got one!
+                result['status'] = 409
+                result['error'] = 'Already exists'
+            else:
+                remaining.append((result, instance))
+        if not remaining:
+            return self._bulk_created(None, None, resource, results)
+
+        callback = partial(self._bulk_validated,
+                           resource=resource,
+                           batch=remaining,
+                           results=results)
+        self.validate_instances([instance for result, instance in remaining],
+                                callback)
+
+    def _bulk_validated(self, problems, resource, batch, results):
+        """Leave out the invalid instances, then find out who is
+        creating the rest."""
+        valid = []
+        for (result, instance), problem in zip(batch, problems):
+            if problem:
+                result['status'] = 400
+                result['error'] = problem
+            else:
+                valid.append((result, instance))
+        if not valid:
+            return self._bulk_created(None, None, resource, results)
+
+        success = partial(self._bulk_insert,
+                          resource=resource,
+                          batch=valid,
+                          results=results)
+        failure = partial(success, None, None)
+        return self.who_am_i(success, failure)
+
+    def _bulk_insert(self, user, error, resource, batch, results):
+        """Insert all the valid instances at once."""
+        # pylint: disable-msg=W0613
+        now = datetime.now()
+        instances = []
+        comments = []
+        files = []
+        for result, instance in batch:
+            instance_files, comment = self._prepare_new_instance(
+                instance, user, now)
+            instances.append(instance)
+            comments.append(comment)
+            files.append(instance_files)
+        callback = partial(self._bulk_inserted,
+                           resource=resource,
+                           batch=batch,
+                           results=results,
+                           comments=comments,
+                           files=files,
+                           now=now)
+        coll = self.get_collection(resource)
+        coll.insert(instances, callback=callback)
+
+    def _bulk_inserted(self, response, error, resource, batch, results,
+                       comments, files, now):
+        """If the insert stopped part way through,
+        find out which instances made it in."""
+        # pylint: disable-msg=W0613
+        callback = partial(self._bulk_record_history,
+                           resource=resource,
+                           batch=batch,
+                           results=results,
+                           comments=comments,
+                           files=files)
+        if not error:
+            return callback(None, None)
+        coll = self.get_collection(resource)
+        coll.find(spec={'_id': {'$in': [instance['_id'] for
+                                        result, instance in batch]},
+                        '_meta._created_time': now},
+                  fields=['_id']).to_list(callback=callback)
+
+    def _bulk_record_history(self, inserted, error, resource, batch,
+                             results, comments, files):
+        """Add the history of all the inserted instances at once.
+        inserted - the inserted ids, or None if they all were."""
+        if inserted is not None:
+            inserted_ids = set(instance['_id'] for instance in inserted)
+            kept = [item for item in zip(batch, comments, files)
+                    if item[0][1]['_id'] in inserted_ids]
+            for result, instance in batch:
+                if instance['_id'] not in inserted_ids:
+                    result['status'] = 500
+                    result['error'] = str(error) if error else 'Not created'
+            if not kept:
+                return self._bulk_created(None, None, resource, results)
+            batch, comments, files = [list(item) for item in zip(*kept)]
+
+        callback = partial(self._bulk_save_files,
+                           resource=resource,
+                           batch=batch,
+                           results=results,
+                           files=files)
+        self.update_history([instance for result, instance in batch],
+                            'create',
+                            callback,
+                            comments)
+
+    def _bulk_save_files(self, response, error, resource, batch,
+                         results, files):
+        """Write any file data and mark the instances as created,
+        or as failed if their history could not be written."""
+        for result, instance in batch:
+            if error:
+                result['status'] = 500
+                result['error'] = 'History not written: %s' % error
+            else:
+                result['status'] = 201
+        items = [(instance, instance_files) for (result, instance),
+                 instance_files in zip(batch, files) if instance_files]
+        if not items:
+            return self._bulk_created(response, error, resource, results)
+        callback = partial(self._bulk_files_saved,
+                           resource=resource,
+                           results=[result for (result, instance),
+                                    instance_files in zip(batch, files)
+                                    if instance_files],
+                           all_results=results)
+        self.run_media(write_many_files, callback, self.media_root, items)
+
+    def _bulk_files_saved(self, file_errors, error, resource, results,
+                          all_results):
+        """Mark the instances whose files could not be written."""
+        if error:
+            file_errors = [str(error)] * len(results)
+        for result, file_error in zip(results, file_errors):
+            if file_error:
+                result['status'] = 500
+                result['error'] = file_error
+        return self._bulk_created(None, None, resource, all_results)
+
+    def _bulk_created(self, response, error, resource, results):
+        """Return the status of each instance."""
+        # pylint: disable-msg=W0613
+        return self._return_data({'resource': resource,
+                                  'results': results})
+
     def _process_post(self, result, error, data):
         """Only create a new one if it does not exist."""
         if result is None:
@@ -559,7 +725,16 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
     @permission_required('read')
     def get(self, resource):
         """Get the collection list."""
-        # Count the results first
+        self.get_list_marker(resource,
+                             partial(self._check_list_etag,
+                                     resource=resource))
+
+    def _check_list_etag(self, history_id, error, resource):
+        """Send 304 if the client already has the list."""
+        # pylint: disable-msg=W0613
+        if history_id is not None and \
+                self.not_modified(list_etag(history_id, self.request.query)):
+            return
         return self._parse_arguments(resource)
 
     @tornado.web.asynchronous
@@ -567,6 +742,7 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         """Parse the critera to make friendly searches."""
         kwargs = {}
         count = None
+        after = None
         arguments = self.request.arguments
         if arguments:
             query = dict((key, value[0]) for \
@@ -597,6 +773,10 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
                 kwargs['fields'] = dejsonify(query['_fields'])
                 del query['_fields']
 
+            if '_after' in query:
+                after = query['_after']
+                del query['_after']
+
             if query:
                 # Decode any decoded values
                 kwargs['spec'] = {}
@@ -604,58 +784,133 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
                 for key, value in six.iteritems(query):
                     kwargs['spec'][key] = dejsonify(value)
 
+        if kwargs.get('limit') or after is not None:
+            self._set_up_paging(kwargs, after)
+
         if count == "true":
             return self._count_results(resource, kwargs)
 
+        if count == "estimated":
+            return self._count_results(resource, kwargs, estimate=True)
+
         return self._get_results(count=None, error=None,
                                  resource=resource, kwargs=kwargs)
 
+    def _set_up_paging(self, kwargs, after=None):
+        """Sort so that a page can be followed by the next,
+        and read the _after token if we were given one."""
+        self.paging_sort = paging_sort(kwargs.get('sort'))
+        self.paging_limit = abs(kwargs.get('limit', 0))
+        kwargs['sort'] = self.paging_sort
+        if 'fields' in kwargs:
+            kwargs['fields'] = include_sort_fields(kwargs['fields'],
+                                                   self.paging_sort)
+        if after is not None:
+            try:
+                self.paging_after = parse_after_token(after,
+                                                      self.paging_sort)
+            except ValueError as err:
+                raise tornado.web.HTTPError(400, str(err))
+
+    def _next_page(self):
+        """Return the token for the next page, if there might be one."""
+        if self.paging_limit and \
+                self.stream_writer.written == self.paging_limit:
+            return {'after': make_after_token(self.stream_writer.last,
+                                              self.paging_sort)}
+        return {}
+
     @tornado.web.asynchronous
-    def _count_results(self, resource, kwargs):
-        """Count the results."""
-        coll = self.get_collection(resource)
-        cursor = coll.find(**kwargs)  # pylint: disable-msg=W0142
+    def _count_results(self, resource, kwargs, estimate=False):
+        """Count the results, using a cached count if we have one.
+        estimate - for a query without criteria, the count can come from
+        the collection statistics rather than counting."""
         callback = partial(self._get_results,
                            resource=resource,
                            kwargs=kwargs)
+        spec = kwargs.get('spec')
+        counts = self.count_cache
+        if counts is not None:
+            count = counts.get(self.database_name, resource, spec)
+            if count is not None:
+                return callback(count, None)
+
+        if estimate and not spec:
+            return self.database.command(
+                'collstats', resource,
+                callback=partial(self._estimated_count, callback=callback))
+
+        if counts is not None:
+            callback = partial(
+                self._store_count,
+                resource=resource,
+                spec=spec,
+                generation=counts.generation(self.database_name, resource),
+                callback=callback)
+        coll = self.get_collection(resource)
+        cursor = coll.find(**kwargs)  # pylint: disable-msg=W0142
         cursor.count(callback=callback)
 
+    def _store_count(self, count, error, resource, spec, generation,
+                     callback):
+        """Keep the count for next time."""
+        if not error:
+            self.count_cache.store(self.database_name, resource, spec,
+                                   count, generation)
+        return callback(count, error)
+
+    @staticmethod
+    def _estimated_count(stats, error, callback):
+        """Pass on the count from the collection statistics."""
+        return callback(stats.get('count', 0) if stats else None, error)
+
     @tornado.web.asynchronous
     def _get_results(self, count, error, resource, kwargs):
         """Get the collection list."""
-        self.writing = False
-        output_wrapper = '{'
-        if count:
-            output_wrapper += '"count":%s, ' % count
-        output_wrapper += '"results":['
-        self.write(output_wrapper)
+        self.stream_writer = ListStreamWriter.for_handler(self)
+        self.stream_writer.start(count)
+        callback = self._stream_processor
+        if self.query_recorder is not None:
+            # Record the query as asked for, without the paging condition
+            self.query_started = time.time()
+            callback = partial(self._stream_processor,
+                               resource=resource,
+                               kwargs=kwargs)
+        if self.paging_after is not None:
+            kwargs = dict(kwargs, spec=add_after_to_spec(
+                kwargs.get('spec'), self.paging_sort, self.paging_after))
         coll = self.get_collection(resource)
         # pylint: disable-msg=W0142
-        coll.find(**kwargs).each(self._stream_processor)
+        coll.find(**kwargs).each(callback)
 
     # pylint: disable-msg=W0613
-    def _stream_processor(self, result, error):
+    def _stream_processor(self, result, error, resource=None, kwargs=None):
         """Write the result out.
         We are fed the collection argument,
         (whether we want it or not), but currently do not use it."""
         if not result:
-            self.write(']}')
-            self.finish()
+            self.stream_writer.finish(**self._next_page())
+            if resource is not None:
+                self._record_query(resource, kwargs)
             return
 
-        self.write((',' if self.writing else '') + \
-                       json.dumps(result,
-                                  default=json_util.default))
-        self.flush()
-        if not self.writing:
-            self.writing = True
+        self.stream_writer.add(result)
+
+    def _record_query(self, resource, kwargs):
+        """Record the shape of the query and how long it took."""
+        self.query_recorder.record(self.database_name,
+                                   resource,
+                                   kwargs.get('spec'),
+                                   kwargs.get('sort'),
+                                   kwargs.get('fields'),
+                                   time.time() - self.query_started)
 
     def _return_data(self, data):
         """Return a single instance or anything else that can become JSON."""
         if not data:
             raise tornado.web.HTTPError(404)
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(data, default=json_util.default))
+        self.write(dumps(data))
         self.finish()
 
     def _validate_instance(self, model, instance):
@@ -684,14 +939,38 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
     def _do_create_instance(self, user, error, instance):
         """Create an instance."""
         instance_collection = self.get_collection(instance['_model'])
+        files, versional_comment = self._prepare_new_instance(instance,
+                                                              user)
+
+        if files is None:
+            save_cb = None
+        else:
+            save_cb = partial(self._save_files,
+                              instance=instance,
+                              files=files)
+        callback = partial(self.add_version_to_history,
+                       instance=instance,
+                       versional_comment=versional_comment,
+                       callback=save_cb)
+
+        instance_collection.insert(instance,
+                                   callback=callback)
+
+    @staticmethod
+    def _prepare_new_instance(instance, user, now=None):
+        """Add the _id and _meta to a new instance,
+        and take out the file data and the versional comment.
+        Returns the files (or None) and the versional comment."""
         if not user:
             user = {"_id": "unknown",
                     "name": "unknown"}
-            
+        if now is None:
+            now = datetime.now()
+
         if '_id' not in instance:
             instance['_id'] = str(ObjectId())
-        instance['_meta'] = {'_created_time': datetime.now(),
-                             '_last_modified_time': datetime.now(),
+        instance['_meta'] = {'_created_time': now,
+                             '_last_modified_time': now,
                              '_last_modified_by': user['_id'],
                              '_last_modified_by_display': user['name'],
                              '_version': 1}
@@ -699,13 +978,9 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
         if '_file_data' in instance:
             files = instance['_file_data']
             for label in files:
-                meta, content = files[label].split(',', 1)
-                ext_m = re.match("data:.*?/(.*?);base64", meta)
-                if not ext_m:
-                    raise ValueError("Can't parse base64 file data ({})".format(meta))
-                filename = '/media/%s/%s_%s.%s' % (instance['_model'], instance['_id'], label, ext_m.group(1))
+                extension = parse_data_uri(files[label])[0]
                 if label in instance:
-                    instance[label] = filename
+                    instance[label] = media_url(instance, label, extension)
             del instance['_file_data']
             
         if '_versional_comment' in instance:
@@ -713,38 +988,23 @@ class ResourceTypeHandler(tornado.web.RequestHandler,
             del instance['_versional_comment']
         else:
             versional_comment = "Instance created"
-
-        if files is None:
-            save_cb = None
-        else:
-            save_cb = partial(self._save_files,
-                              instance=instance,
-                              files=files)
-        callback = partial(self.add_version_to_history,
-                       instance=instance,
-                       versional_comment=versional_comment,
-                       callback=save_cb)
-
-        instance_collection.insert(instance,
-                                   callback=callback)
+        return files, versional_comment
         
     def _save_files(self, response,  # pylint: disable-msg=W0613
                                error=None,
                                instance=None,
                                files=None):
-        for file in files:
-            meta, content = files[file].split(',', 1)
-            ext_m = re.match("data:.*?/(.*?);base64", meta)
-            if not ext_m:
-                raise ValueError("Can't parse base64 file data ({})".format(meta))
-            assert instance[file].startswith('/media/')
-            filename = instance[file][7:]
-            real_content = base64.b64decode(content)
-            with open('/srv/itsee/mediamanager/restricted/' + filename,  'w') as f:
-                f.write(real_content)
-            
+        """Write the file data, then return the instance."""
+        callback = partial(self._files_saved, instance=instance)
+        self.run_media(write_files, callback, self.media_root,
+                       instance, files)
+
+    def _files_saved(self, response, error, instance):
+        """Return the new instance."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
         return self._return_data(instance)
-        
 
     def _return_main_data(self, response, error, data):
         """Return the data without the response."""
@@ -832,7 +1092,7 @@ class CommandHandler(tornado.web.RequestHandler,
 
     def return_data(self, data):
         """Return the data to the browser."""
-        self.write(json.dumps(data, default=json_util.default))
+        self.write(dumps(data))
         self.finish()
 
 
@@ -840,11 +1100,15 @@ class ResourceHandler(tornado.web.RequestHandler,
                       DatabaseMixin,
                       AuthenticationMixin,
                       ValidationMixin,
-                      WhoAmIMixin):
+                      WhoAmIMixin,
+                      ConditionalMixin,
+                      MediaMixin):
     """
        finds a single instance and performs the relevant method upon it.
     """
     # pylint: disable=W0221,R0904
+    # The instance before an update, for its history
+    previous_instance = None
 
     @tornado.web.asynchronous
     @permission_required('read')
@@ -880,6 +1144,26 @@ class ResourceHandler(tornado.web.RequestHandler,
         """Get a single instance."""
         #print "100", dir(self.application)
         coll = self.get_collection(resource)
+        if self.request.headers.get('If-None-Match'):
+            # Fetch just the version first, the client probably has it
+            coll.find_one({'_id': objectid},
+                          fields=['_meta._version'],
+                          callback=partial(self._check_instance_etag,
+                                           resource=resource,
+                                           objectid=objectid))
+            return
+        coll.find_one({'_id': objectid},
+                      callback=self.return_instance)
+
+    def _check_instance_etag(self, result, error, resource, objectid):
+        """Send 304 if the client already has the instance,
+        otherwise get the whole instance."""
+        # pylint: disable-msg=W0613
+        if not result:
+            raise tornado.web.HTTPError(404)
+        if self.not_modified(instance_etag(result)):
+            return
+        coll = self.get_collection(resource)
         coll.find_one({'_id': objectid},
                       callback=self.return_instance)
 
@@ -908,15 +1192,14 @@ class ResourceHandler(tornado.web.RequestHandler,
         
     @tornado.web.asynchronous
     def _get_model(self, response, error, instance, resource, objectid):
-        coll = self.get_collection('_model')
         success = partial(self._check_files_in_model,
                           resource=resource,
                           objectid=objectid)
-        coll.find({'_id': resource}).to_list(callback=success)
-        
-    def _check_files_in_model(self, response, error, resource, objectid):
-        if '_file_fields' in response[0]:
-            self._get_instance(response[0]['_file_fields']['fields'], resource, objectid)
+        self.get_model(resource, callback=success)
+
+    def _check_files_in_model(self, model, error, resource, objectid):
+        if model and '_file_fields' in model:
+            self._get_instance(model['_file_fields']['fields'], resource, objectid)
         else:
             self._do_delete({'_model': resource, '_id': objectid})
             
@@ -931,11 +1214,20 @@ class ResourceHandler(tornado.web.RequestHandler,
 
         
     def _delete_files(self, response, error, file_fields, resource, objectid):
-        for json in response:
-            for field in file_fields:
-                file = json[field].replace('/media/', '/srv/itsee/mediamanager/restricted/')
-                if os.path.isfile(file):
-                    os.unlink(file)
+        """Delete the media files of the instance."""
+        urls = [instance.get(field) for instance in response
+                for field in file_fields]
+        callback = partial(self._files_deleted,
+                           resource=resource,
+                           objectid=objectid)
+        self.run_media(delete_files, callback, self.media_root,
+                       resource, urls)
+
+    def _files_deleted(self, response, error, resource, objectid):
+        """Now delete the instance."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
         self._do_delete({'_model': resource, '_id': objectid})
 
     @tornado.web.asynchronous
@@ -943,12 +1235,13 @@ class ResourceHandler(tornado.web.RequestHandler,
                    instance=None):  # pylint: disable-msg=W0613
         """Do the deletion."""
         coll = self.get_collection(instance['_model'])
-        callback = self._deleted(instance=instance)
+        callback = partial(self._deleted, instance=instance)
         coll.remove(instance['_id'],
                     callback=callback)
 
-    def _deleted(self, instance, error = None):
+    def _deleted(self, response, error=None, instance=None):
         """Item is successfully deleted."""
+        self.notify_change(instance['_model'], [instance['_id']])
         self.return_instance({'success': True,
                               '_id': instance['_id'],
                               '_model': instance['_model']})
@@ -961,8 +1254,7 @@ class ResourceHandler(tornado.web.RequestHandler,
         if six.PY3 and isinstance(body, six.binary_type):
             body = body.decode('utf8')
 
-        new_instance = json.loads(body,
-                                  object_hook=json_util.object_hook)
+        new_instance = loads(body)
         if '_id' not in new_instance:
             raise tornado.web.HTTPError(400, "Missing _id key")
         if new_instance['_id'] != objectid:
@@ -1028,6 +1320,7 @@ class ResourceHandler(tornado.web.RequestHandler,
             # Put your shoes back on and move along
             old_instance['_meta'] = old_meta
             return self.return_instance(old_instance)
+        self.previous_instance = dict(old_instance, _meta=old_meta)
 
         new_instance['_meta'] = {
             '_created_time': old_meta['_created_time'],
@@ -1042,14 +1335,11 @@ class ResourceHandler(tornado.web.RequestHandler,
             files = new_instance['_file_data']
             for_delete = []
             for label in files:
-                meta, content = files[label].split(',', 1)
-                ext_m = re.match("data:.*?/(.*?);base64", meta)
-                if not ext_m:
-                    raise ValueError("Can't parse base64 file data ({})".format(meta))
-                filename = '/media/%s/%s_%s.%s' % (new_instance['_model'], new_instance['_id'], label, ext_m.group(1))
+                extension = parse_data_uri(files[label])[0]
                 if label in new_instance:
-                    for_delete.append(old_instance[label])
-                    new_instance[label] = filename
+                    for_delete.append(old_instance.get(label))
+                    new_instance[label] = media_url(new_instance, label,
+                                                    extension)
             files['_delete'] = for_delete
             del new_instance['_file_data']
         
@@ -1074,7 +1364,10 @@ class ResourceHandler(tornado.web.RequestHandler,
             save_cb = partial(self._save_files,
                               instance=instance,
                               files=files)
-        callback = self.add_version_to_history(instance, save_cb)
+        self.add_version_to_history(instance, save_cb)
+        callback = partial(self._written,
+                           collection=instance['_model'],
+                           ids=[instance['_id']])
         instance_collection.update({'_id': instance['_id']},
                                    instance,
                                    callback=callback)
@@ -1083,23 +1376,18 @@ class ResourceHandler(tornado.web.RequestHandler,
                                error=None,
                                instance=None,
                                files=None):
-        if '_delete' in files:
-            for file in files['_delete']:
-                filepath = file.replace('/media/', '/srv/itsee/mediamanager/restricted/')
-                if os.path.isfile(filepath):
-                    os.unlink(filepath)
-        del files['_delete']
-        for file in files:
-            meta, content = files[file].split(',', 1)
-            ext_m = re.match("data:.*?/(.*?);base64", meta)
-            if not ext_m:
-                raise ValueError("Can't parse base64 file data ({})".format(meta))
-            assert instance[file].startswith('/media/')
-            filename = instance[file][7:]
-            real_content = base64.b64decode(content)
-            with open('/srv/itsee/mediamanager/restricted/' + filename,  'w') as f:
-                f.write(real_content)
-            
+        """Replace the old files with the new file data,
+        then return the instance."""
+        old_urls = files.pop('_delete', [])
+        callback = partial(self._files_saved, instance=instance)
+        self.run_media(replace_files, callback, self.media_root,
+                       instance, files, old_urls)
+
+    def _files_saved(self, response, error, instance):
+        """Return the updated instance."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
         return self.return_instance(instance)
 
 
@@ -1121,14 +1409,19 @@ class ResourceHandler(tornado.web.RequestHandler,
         self.update_history(instance,
                             operation,
                             insert_callback,
-                            versional_comment)
+                            versional_comment,
+                            self.previous_instance)
         
     def return_instance(self, result, error=None):
         """Return a single instance or anything else that can become JSON."""
         if not result:
             raise tornado.web.HTTPError(404)
+        if isinstance(result, dict):
+            etag = instance_etag(result)
+            if etag:
+                self.set_header("Etag", etag)
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(result, default=json_util.default))
+        self.write(dumps(result))
         self.finish()
         
     def _return_main_instance(self, response, error, instance):
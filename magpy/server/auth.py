@@ -4,11 +4,11 @@ import tornado.auth
 import tornado.web  # pylint: disable=W0404
 import tornado.gen
 import json
-from bson import json_util
 from bson.objectid import ObjectId
 from functools import partial
 from magpy.server.database import DatabaseMixin
 from magpy.server.utils import dejsonify
+from magpy.server.serialization import dumps, loads
 import six
 import base64
 
@@ -62,6 +62,18 @@ class AuthenticationMixin(object):
     Provides authentication checks for the api.
     """
 
+    @property
+    def permission_cache(self):
+        """The application's permission cache, if it has one."""
+        return getattr(self.application, 'permission_cache', None)
+
+    def get_user_id(self):
+        """The id of the logged in user, or None."""
+        user_id = self.get_secure_cookie("user")
+        if user_id and isinstance(user_id, six.binary_type):
+            user_id = user_id.decode('utf8')
+        return user_id or None
+
     def check_permissions(self,
                           success,
                           failure=None,
@@ -81,83 +93,138 @@ class AuthenticationMixin(object):
         if not failure:
             failure = self.permission_denied
 
-        # 1. get user
-        # 2. get relevant groups
-        # 2. get models
-        # 3. combine them together
-        # 4. Test it against the input
-
-        if not self.get_secure_cookie("user"):
+        callback = partial(self._do_check_permissions,
+                           permissions=permissions,
+                           success=success,
+                           failure=failure)
+        self.get_effective_permissions(list(permissions.keys()), callback)
+
+    def get_effective_permissions(self, resources, callback):
+        """Get the user's permissions on each of the resources,
+        then run callback with a dictionary of them by resource, e.g.
+        {'author': {'read': True, 'create': False, ...}}
+        Resources without a model are left out.
+
+        Answers come from the permission cache when it has them,
+        otherwise:
+        1. get user
+        2. get relevant groups
+        3. get models
+        4. combine them together
+        """
+        user_id = self.get_user_id()
+        cache = self.permission_cache
+        found = {}
+        missing = list(resources)
+        generation = None
+        if cache is not None:
+            missing = []
+            for resource in resources:
+                permissions = cache.get(self.database_name,
+                                        user_id,
+                                        resource)
+                if permissions is None:
+                    missing.append(resource)
+                else:
+                    found[resource] = permissions
+            if not missing:
+                return callback(found)
+            generation = cache.generation(self.database_name)
+
+        next_step = partial(self._get_relevant_groups,
+                            resources=missing,
+                            found=found,
+                            generation=generation,
+                            callback=callback)
+        if not user_id:
             # We are not logged in, go to the next stage
             return self._get_models_for_check_perms(
                 groups=None,
                 error=None,
                 user=None,
-                permissions=permissions,
-                success=success,
-                failure=failure)
+                resources=missing,
+                found=found,
+                generation=generation,
+                callback=callback)
 
-        callback = partial(self._get_relevant_groups,
-                           permissions=permissions,
-                           success=success,
-                           failure=failure)
         coll = self.get_collection('_user')
-        coll.find_one({'_id': self.get_secure_cookie("user")},
-                      callback=callback,
+        coll.find_one({'_id': user_id},
+                      callback=next_step,
                       fields=['_permissions'])
 
     def _get_relevant_groups(self,
                              user,
                              error,
-                             permissions,
-                             success,
-                             failure):
+                             resources,
+                             found,
+                             generation,
+                             callback):
         """Get relevant groups.
         Result is a list of results, e.g.:
         [{u'_id': u'citations_editors',
         u'_permissions': {u'author':
         {u'update': {u'author': True}}}}]
         """
-        callback = partial(self._get_models_for_check_perms,
-                           user=user,
-                           permissions=permissions,
-                           success=success,
-                           failure=failure)
+        next_step = partial(self._get_models_for_check_perms,
+                            user=user,
+                            resources=resources,
+                            found=found,
+                            generation=generation,
+                            callback=callback)
+        if not user:
+            return next_step(None, None)
 
         groups = self.get_collection('_group')
 
-        model_names = permissions.keys()
         or_query = [
             {
                 '_permissions.%s' % model_name: {
-                    "$exists": True}} for model_name in model_names]
+                    "$exists": True}} for model_name in resources]
 
         groups.find(
             {'members': user['_id'],
              '$or': or_query},
-            ['_permissions']).to_list(callback=callback)
+            ['_permissions']).to_list(callback=next_step)
 
     def _get_models_for_check_perms(self,
                                     groups,
                                     error,
                                     user,
-                                    permissions,
-                                    success,
-                                    failure):
+                                    resources,
+                                    found,
+                                    generation,
+                                    callback):
         """Get the required models to satisfy permissions."""
-        callback = partial(self._do_check_permissions,
-                           permissions=permissions,
-                           user=user,
-                           groups=groups,
-                           success=success,
-                           failure=failure)
-
-        models = self.get_collection('_model')
-        models.find(
-            spec={
-                '_id': {
-                    '$in': tuple(permissions.keys())}},
-            fields=['_permissions']).to_list(callback=callback)
+        next_step = partial(self._store_effective_permissions,
+                            user=user,
+                            groups=groups,
+                            found=found,
+                            generation=generation,
+                            callback=callback)
+        self.get_models(resources, callback=next_step)
+
+    def _store_effective_permissions(self,
+                                     models,
+                                     error,
+                                     user,
+                                     groups,
+                                     found,
+                                     generation,
+                                     callback):
+        """Combine the permissions, and keep them for next time."""
+        permissions = self._overlay_permissions(models or [], user, groups)
+        cache = self.permission_cache
+        if cache is not None:
+            user_id = self.get_user_id()
+            for resource, resource_permissions in \
+                    six.iteritems(permissions):
+                cache.store(self.database_name,
+                            user_id,
+                            resource,
+                            resource_permissions,
+                            generation)
+        permissions.update(found)
+        return callback(permissions)
 
     @staticmethod
     def _overlay_permissions(models,
@@ -197,21 +264,18 @@ class AuthenticationMixin(object):
 
         return permissions
 
-    def _do_check_permissions(self,
-                              models,
-                              error,
-                              user,
-                              groups,
+    @staticmethod
+    def _do_check_permissions(stored_permissions,
                               permissions,
                               success,
                               failure):
         """Process the stored permissions."""
-        stored_permissions = self._overlay_permissions(models, user, groups)
         missing_permissions = {}
 
         for resource, perm_list in six.iteritems(permissions):
+            resource_permissions = stored_permissions.get(resource, {})
             for perm in perm_list:
-                if not stored_permissions[resource][perm]:
+                if not resource_permissions.get(perm):
                     if resource in missing_permissions:
                         missing_permissions[resource].append(perm)
                     else:
@@ -234,71 +298,49 @@ class AuthenticationMixin(object):
         if not failure:
             failure = self.permission_denied
 
-        if not self.get_secure_cookie("user"):
-            # We are not logged in, go to the next stage
-            return self._request_modelp(resource, permission, success, failure)
-
-        callback = partial(self._check_user,
+        callback = partial(self._check_effective_permission,
                            resource=resource,
-                           permission=permission,
-                           success=success,
-                           failure=failure)
-        coll = self.get_collection('_user')
-        coll.find_one({'_id': self.get_secure_cookie("user")},
-                      callback=callback)
-
-    def _check_user(self, user, error, resource, permission, success, failure):
-        """Check if the user has the required permission."""
-        if not user:
-            return self._request_modelp(resource, permission, success, failure)
-        if '_permissions' not in user:
-            return self._request_modelp(resource, permission, success, failure)
-        if resource not in user['_permissions']:
-            return self._request_modelp(resource, permission, success, failure)
-        if permission in user['_permissions'][resource]:
-            permission_value = \
-                user['_permissions'][resource].get(permission)
-            if permission_value:
-                return success()
-            else:
-                return failure()
-        return self._request_modelp(resource, permission, success, failure)
-
-    def _request_modelp(self, resource, permission, success, failure):
-        """Get the model from the database."""
-
-        coll = self.get_collection('_model')
-
-        callback = partial(self._check_model,
                            permission=permission,
                            on_success=success,
                            on_failure=failure)
-        coll.find_one({'_id': resource},
-                      callback=callback)
-
-    #def _check_model(self, model, permission, success, failure):
-    def _check_model(self, model, error, permission,
-                     on_success, on_failure, *args, **kwargs):
-        """See that permissions there are in the model."""
-        if not model:
+        self.get_effective_permissions([resource], callback)
+
+    def _check_effective_permission(self, permissions, resource, permission,
+                                    on_success, on_failure):
+        """See if the permission is granted."""
+        if resource not in permissions:
+            return self._check_user_permission(resource, permission,
+                                               on_success, on_failure)
+        if permissions[resource].get(permission):
+            return on_success()
+        return on_failure()
+
+    def _check_user_permission(self, resource, permission,
+                               on_success, on_failure):
+        """A resource without a model only has the permissions
+        given to the user themselves."""
+        user_id = self.get_user_id()
+        if not user_id:
             return on_failure()
-        if '_permissions' not in model:
-            return self._standard(permission, on_success, on_failure)
-        if permission in model['_permissions']:
-            if model['_permissions'][permission]:
-                return on_success()
-            else:
-                return on_failure()
-
-        return self._standard(permission, on_success, on_failure)
+        callback = partial(self._check_user_permission_found,
+                           resource=resource,
+                           permission=permission,
+                           on_success=on_success,
+                           on_failure=on_failure)
+        coll = self.get_collection('_user')
+        coll.find_one({'_id': user_id},
+                      callback=callback,
+                      fields=['_permissions'])
 
     @staticmethod
-    def _standard(permission, success, failure):
-        """Give the standard answer."""
-        if permission == 'read':
-            return success()
-        else:
-            return failure()
+    def _check_user_permission_found(user, error, resource, permission,
+                                     on_success, on_failure):
+        """See if the user has been given the permission."""
+        # pylint: disable-msg=W0613
+        user_permissions = (user or {}).get('_permissions') or {}
+        if user_permissions.get(resource, {}).get(permission):
+            return on_success()
+        return on_failure()
 
     @staticmethod
     def permission_denied(details=None):
@@ -324,7 +366,7 @@ class AuthPermissionsHandler(tornado.web.RequestHandler,
     def _return_instance(self, instance, error=None):
         """Return a single instance or anything else that can become JSON."""
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        json_response = json.dumps(instance, default=json_util.default)
+        json_response = dumps(instance)
         if six.PY3:
             json_response = bytes(json_response, 'utf8')
         
@@ -351,7 +393,7 @@ class AuthPermissionHandler(tornado.web.RequestHandler,
     def _return_instance(self, instance, error=None):
         """Return a single instance or anything else that can become JSON."""
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(instance, default=json_util.default))
+        self.write(dumps(instance))
         self.finish()
 
 
@@ -384,7 +426,7 @@ class AuthWhoAmIHandler(tornado.web.RequestHandler,
         if not instance:
             raise tornado.web.HTTPError(404)
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(instance, default=json_util.default))
+        self.write(dumps(instance))
         self.finish()
 
 class AuthWhoAreTheyHandler(tornado.web.RequestHandler,
@@ -392,14 +434,14 @@ class AuthWhoAreTheyHandler(tornado.web.RequestHandler,
     @tornado.web.asynchronous
     def get(self):
         if self.get_argument('ids', None):
-            ids = json.loads(self.get_argument('ids')[5:])
+            ids = loads(self.get_argument('ids')[5:])
             #self.resolve_ids_to_names(ids)
             coll = self.get_collection('_user')
             callback = partial(self._build_dictionary)
             coll.find(spec={'_id': {'$in': ids}}).to_list(callback=callback)
         else:
             self.set_header("Content-Type", "application/json; charset=UTF-8")
-            empty_response = json.dumps({}, default=json_util.default)
+            empty_response = dumps({})
             if six.PY3:
                 empty_response = bytes(json_response, 'utf8')
             self.write(empty_response)
@@ -424,7 +466,7 @@ class AuthWhoAreTheyHandler(tornado.web.RequestHandler,
             else:
                 resolved[entry['_id']] = entry['_id']
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(resolved, default=json_util.default))
+        self.write(dumps(resolved))
         self.finish()
         return
 
@@ -6,50 +6,305 @@ All the boilerplate we don't care so much about.
 
 from __future__ import print_function
 
+import os
+import sys
+import errno
+import signal
+from datetime import timedelta
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
 import tornado.autoreload
+import tornado.netutil
+import tornado.process
 import motor
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from magpy.server.config import MagpyConfigParser
+from magpy.server.database import Database, connection_options
+from magpy.server.indexes import ensure_indexes
+from magpy.server.cache import ModelRegistry, PermissionCache, CountCache, \
+    SyncStateCache
+from magpy.server.queries import QueryRecorder
+from magpy.server.compression import CompressionTransform
+from magpy.server.history import HistoryWriter, HISTORY_WRITERS, \
+    DEFAULT_BATCH_SIZE, DEFAULT_BATCH_DELAY
+from magpy.server.deltas import DEFAULT_SNAPSHOT_INTERVAL
+from magpy.server.transactions import DEFAULT_SYNC_PAGE_SIZE
+from magpy.server.changes import ChangeFeed, DEFAULT_FEED_INTERVAL
+from magpy.server.media import DEFAULT_MEDIA_ROOT, DEFAULT_MEDIA_THREADS, \
+    DEFAULT_UPLOAD_MAX_BYTES
 
 class App(tornado.web.Application):
     """Simple Web Application."""
-    def __init__(self, ioloop, handlers, cookie_secret, databases, google_secrets, login_redirect):
+    def __init__(self, ioloop, handlers, cookie_secret, databases, google_secrets, login_redirect,
+                 permission_cache_size=10000, permission_cache_ttl=60,
+                 stream_flush_bytes=65536, stream_flush_count=1000,
+                 count_cache_size=1000, count_cache_ttl=30,
+                 query_stats_interval=60,
+                 media_root=DEFAULT_MEDIA_ROOT,
+                 media_threads=DEFAULT_MEDIA_THREADS,
+                 media_upload_max_bytes=DEFAULT_UPLOAD_MAX_BYTES,
+                 media_accel_redirect=None,
+                 compression=True, compression_min_length=1024,
+                 compression_level=6, debug=True,
+                 history_writer='direct',
+                 history_batch_size=DEFAULT_BATCH_SIZE,
+                 history_batch_delay=DEFAULT_BATCH_DELAY,
+                 history_storage='full',
+                 history_snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 sync_page_size=DEFAULT_SYNC_PAGE_SIZE,
+                 sync_state_ttl=30,
+                 change_feed_interval=DEFAULT_FEED_INTERVAL,
+                 model_registry_ttl=60):
         settings = dict(
-            debug=True,
+            debug=debug,
             io_loop=ioloop,
             cookie_secret=cookie_secret,
             google_oauth=google_secrets,
-            login_redirect=login_redirect)
+            login_redirect=login_redirect,
+            stream_flush_bytes=stream_flush_bytes,
+            stream_flush_count=stream_flush_count,
+            media_root=media_root,
+            media_upload_max_bytes=media_upload_max_bytes,
+            media_accel_redirect=media_accel_redirect,
+            history_storage=history_storage,
+            history_snapshot_interval=history_snapshot_interval,
+            sync_page_size=sync_page_size)
         print(settings)
-        self.connection = motor.MotorClient(tz_aware=True).open_sync()
+        database_settings = databases.get('default', {})
+        # pylint: disable=W0142
+        self.connection = motor.MotorClient(
+            **connection_options(database_settings)).open_sync()
+        self.history_write_concern = database_settings.get(
+            'HISTORY_WRITE_CONCERN')
+        if history_writer not in HISTORY_WRITERS:
+            raise ValueError("history_writer must be one of %s" % (
+                ', '.join(HISTORY_WRITERS)))
+        if history_writer == 'direct':
+            self.history_writer = None
+        else:
+            self.history_writer = HistoryWriter(
+                self.connection,
+                ioloop,
+                history_batch_size,
+                history_batch_delay,
+                wait=history_writer == 'group',
+                write_concern=self.history_write_concern)
         self.databases = databases
+        self.model_registry = ModelRegistry(model_registry_ttl or None)
+        self.permission_cache = PermissionCache(permission_cache_size,
+                                                permission_cache_ttl)
+        self.count_cache = CountCache(count_cache_size, count_cache_ttl)
+        self.sync_state_cache = SyncStateCache(sync_state_ttl)
+        if change_feed_interval:
+            self.change_feed = ChangeFeed(
+                self.connection, ioloop, change_feed_interval,
+                history_writer=self.history_writer)
+        else:
+            self.change_feed = None
+        self.query_stats_interval = query_stats_interval
+        self.media_executor = ThreadPoolExecutor(media_threads)
+        if query_stats_interval:
+            self.query_recorder = QueryRecorder()
+        else:
+            self.query_recorder = None
         # pylint: disable=W0142
         tornado.web.Application.__init__(self, handlers, **settings)
+        if compression:
+            # Compress before any other transform (e.g. chunking)
+            self.transforms.insert(0, partial(
+                CompressionTransform,
+                min_length=compression_min_length,
+                level=compression_level))
 
 
-def main(handlers, port=None, config=None):
-    """Site startup boilerplate."""
+def main(handlers, port=None, config=None, create_indexes=False,
+         production=None, processes=None):
+    """Site startup boilerplate.
+    production - run without debug and autoreload, in several
+                 processes sharing the port.
+    processes - how many processes, 0 for one per CPU."""
     magpyconf = MagpyConfigParser(config)
     if not port:
         port = getattr(magpyconf, 'port', 8000)
+    if production is None:
+        production = magpyconf.production
+    if processes is None:
+        processes = magpyconf.processes
 
     tornado.options.parse_command_line()
+    if create_indexes or magpyconf.create_indexes:
+        create_model_indexes(config, magpyconf)
+
+    sockets = None
+    if production:
+        # Bind before forking, so the processes share the socket.
+        # Everything else, the IOLoop and the database connections
+        # included, is made in each process after the fork.
+        sockets = tornado.netutil.bind_sockets(port)
+        fork_processes(processes)
+
     ioloop = tornado.ioloop.IOLoop.instance()
-    http_server = tornado.httpserver.HTTPServer(App(ioloop,
-                                                    handlers,
-                                                    magpyconf.cookie_secret,
-                                                    magpyconf.databases,
-                                                    magpyconf.google_oauth,
-                                                    magpyconf.login_redirect))
-    http_server.listen(port)
-    tornado.autoreload.start()
+    application = make_application(ioloop, handlers, config, magpyconf,
+                                    debug=not production)
+    http_server = tornado.httpserver.HTTPServer(application)
+    if sockets is not None:
+        http_server.add_sockets(sockets)
+    else:
+        http_server.listen(port)
+        tornado.autoreload.start()
+
+    def handle_signal(signum, frame):
+        """Stop cleanly."""
+        # pylint: disable=W0613
+        ioloop.add_callback_from_signal(
+            partial(stop_server, ioloop, http_server, application))
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
     ioloop.start()
 
+
+def fork_processes(processes, max_restarts=100):
+    """Start the processes, as tornado.process.fork_processes does,
+    returning in each of them. A process that dies is started again.
+    The parent passes SIGTERM and SIGINT on to the processes, so that
+    signalling only the parent (e.g. kill <pid>) still stops them
+    cleanly, then exits once they all have."""
+    if not processes:
+        processes = tornado.process.cpu_count()
+    children = {}
+    stopping = []
+
+    def start_child(number):
+        """Fork a process. Returns True in the child."""
+        pid = os.fork()
+        if pid == 0:
+            # main sets up the child's own handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return True
+        children[pid] = number
+        return False
+
+    def forward_signal(signum, frame):
+        """Stop the children, and do not start them again."""
+        # pylint: disable=W0613
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+    for number in range(processes):
+        if start_child(number):
+            return
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        number = children.pop(pid)
+        if stopping or (os.WIFEXITED(status) and
+                        os.WEXITSTATUS(status) == 0):
+            continue
+        print("Warning: process %d (pid %d) died, starting it again." % (
+            number, pid))
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError("Too many process restarts, giving up")
+        if start_child(number):
+            return
+    sys.exit(0)
+
+
+def stop_server(ioloop, http_server, application, timeout=10):
+    """Stop taking requests, write any queued history, then stop."""
+    http_server.stop()
+    if application.history_writer is None:
+        return ioloop.stop()
+    # Do not wait forever if the database has gone
+    ioloop.add_timeout(timedelta(seconds=timeout), ioloop.stop)
+    application.history_writer.flush(ioloop.stop)
+
+
+def create_model_indexes(config, magpyconf):
+    """Create any missing model indexes."""
+    database = Database(
+        database_name=magpyconf.databases['default']['NAME'],
+        config_file=config)
+    models = list(database.get_collection('_model').find())
+    # Only add indexes at startup, load_models drops old ones
+    ensure_indexes(database.database, models, drop=False)
+    database.connection.close()
+
+
+def make_application(ioloop, handlers, config, magpyconf, debug=True):
+    """Make the application, with its caches filled and
+    its periodic jobs started."""
+    application = App(
+        ioloop,
+        handlers,
+        magpyconf.cookie_secret,
+        magpyconf.databases,
+        magpyconf.google_oauth,
+        magpyconf.login_redirect,
+        permission_cache_size=magpyconf.permission_cache_size,
+        permission_cache_ttl=magpyconf.permission_cache_ttl,
+        stream_flush_bytes=magpyconf.stream_flush_bytes,
+        stream_flush_count=magpyconf.stream_flush_count,
+        count_cache_size=magpyconf.count_cache_size,
+        count_cache_ttl=magpyconf.count_cache_ttl,
+        query_stats_interval=magpyconf.query_stats_interval,
+        media_root=magpyconf.media_root,
+        media_threads=magpyconf.media_threads,
+        media_upload_max_bytes=magpyconf.media_upload_max_bytes,
+        media_accel_redirect=magpyconf.media_accel_redirect,
+        compression=magpyconf.compression,
+        compression_min_length=magpyconf.compression_min_length,
+        compression_level=magpyconf.compression_level,
+        debug=debug,
+        history_writer=magpyconf.history_writer,
+        history_batch_size=magpyconf.history_batch_size,
+        history_batch_delay=magpyconf.history_batch_delay,
+        history_storage=magpyconf.history_storage,
+        history_snapshot_interval=magpyconf.history_snapshot_interval,
+        sync_page_size=magpyconf.sync_page_size,
+        sync_state_ttl=magpyconf.sync_state_ttl,
+        change_feed_interval=magpyconf.change_feed_interval,
+        model_registry_ttl=magpyconf.model_registry_ttl)
+    database = Database(
+        database_name=magpyconf.databases['default']['NAME'],
+        config_file=config)
+    load_model_registry(application, database)
+    database.connection.close()
+    if application.query_recorder is not None:
+        tornado.ioloop.PeriodicCallback(
+            partial(application.query_recorder.flush,
+                    application.connection),
+            application.query_stats_interval * 1000,
+            io_loop=ioloop).start()
+    return application
+
+
+def load_model_registry(application, database):
+    """Fill the model registry from the database, returns the models."""
+    models = list(database.get_collection('_model').find())
+    application.model_registry.load(database.database.name, models)
+    print("Loaded %s models into the registry." % len(models))
+    return models
+
 if __name__ == '__main__':
     print ("To run the server type:\n"
            "mag.py run")
@@ -0,0 +1,360 @@
+"""In-process caches shared by the request handlers.
+
+The caches live on the application object, so each server process
+has its own. They are kept fresh by the changes written through the API,
+see DatabaseMixin.notify_change.
+"""
+
+import time
+from collections import OrderedDict
+from magpy.server.serialization import dumps
+
+
+class ModelRegistry(object):
+    """Model definitions from the _model collection, kept in memory.
+
+    Models almost never change, so rather than fetching a model from
+    the database on every request, we keep them here, per database.
+    An entry is dropped when its _model document is written through
+    the API, or (optionally) when it is older than ttl seconds.
+
+    The models handed out are shared, so treat them as read-only.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._models = {}
+        self._generations = {}
+
+    def load(self, database_name, models):
+        """Bulk load models, e.g. at server startup."""
+        self.store(database_name, models)
+
+    def generation(self, database_name):
+        """The number of invalidations so far for the database.
+        Take this before fetching models, and give it back to store(),
+        so that a fetch that raced with a write is not kept."""
+        return self._generations.get(database_name, 0)
+
+    def store(self, database_name, models, generation=None):
+        """Store models fetched from the database."""
+        if generation is not None and \
+                generation != self.generation(database_name):
+            return
+        database_models = self._models.setdefault(database_name, {})
+        now = time.time()
+        for model in models:
+            database_models[model['_id']] = (model, now)
+
+    def get(self, database_name, model_name):
+        """Get a model, or None if we do not have it."""
+        try:
+            model, loaded = self._models[database_name][model_name]
+        except KeyError:
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - loaded > self.ttl:
+            del self._models[database_name][model_name]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return model
+
+    def get_many(self, database_name, model_names):
+        """Get several models.
+        Returns a list of the models we have,
+        and a list of the names of the models we do not."""
+        found = []
+        missing = []
+        for model_name in model_names:
+            model = self.get(database_name, model_name)
+            if model is None:
+                missing.append(model_name)
+            else:
+                found.append(model)
+        return found, missing
+
+    def invalidate(self, database_name, model_names=None):
+        """Forget the named models, or all the models of the database."""
+        self._generations[database_name] = \
+            self.generation(database_name) + 1
+        if model_names is None:
+            self._models.pop(database_name, None)
+            return
+        database_models = self._models.get(database_name, {})
+        for model_name in model_names:
+            database_models.pop(model_name, None)
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'models': sum(len(models) for
+                              models in self._models.values())}
+
+
+class PermissionCache(object):
+    """Effective permissions of users on resources.
+
+    Holds the result of AuthenticationMixin._overlay_permissions for
+    each (database, user id, resource), so that permission checks do not
+    need the _user, _group and _model collections every time.
+    The cache holds at most max_size entries, dropping the least recently
+    used first, and entries expire after ttl seconds, which bounds how
+    stale an answer can be when permissions are changed outside the API.
+    """
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def generation(self, database_name):
+        """The number of invalidations so far for the database,
+        see ModelRegistry.generation."""
+        return self._generations.get(database_name, 0)
+
+    def get(self, database_name, user_id, resource):
+        """Get the permissions, or None if we do not have them."""
+        key = (database_name, user_id, resource)
+        try:
+            permissions, stored = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - stored > self.ttl:
+            self.misses += 1
+            return None
+        # Put it back at the most recently used end
+        self._entries[key] = (permissions, stored)
+        self.hits += 1
+        return permissions
+
+    def store(self, database_name, user_id, resource, permissions,
+              generation=None):
+        """Store the permissions of the user on the resource."""
+        if generation is not None and \
+                generation != self.generation(database_name):
+            return
+        key = (database_name, user_id, resource)
+        self._entries.pop(key, None)
+        self._entries[key] = (permissions, time.time())
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _discard(self, database_name, matches):
+        """Drop the database's entries for which matches(key) is true."""
+        self._generations[database_name] = \
+            self.generation(database_name) + 1
+        for key in list(self._entries):
+            if key[0] == database_name and matches(key):
+                del self._entries[key]
+
+    def invalidate_users(self, database_name, user_ids=None):
+        """Forget the permissions of the users, or of all users."""
+        if user_ids is None:
+            return self.invalidate(database_name)
+        user_ids = set(user_ids)
+        self._discard(database_name, lambda key: key[1] in user_ids)
+
+    def invalidate_resources(self, database_name, resources=None):
+        """Forget the permissions on the resources, or on all resources."""
+        if resources is None:
+            return self.invalidate(database_name)
+        resources = set(resources)
+        self._discard(database_name, lambda key: key[2] in resources)
+
+    def invalidate(self, database_name):
+        """Forget everything about the database."""
+        self._discard(database_name, lambda key: True)
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)}
+
+
+def count_key(spec):
+    """A key for the query spec, the same whatever the order of its
+    top level fields."""
+    if not spec:
+        return ''
+    return dumps(sorted(spec.items()))
+
+
+class CountCache(object):
+    """Counts of list queries, by database, collection and query spec.
+
+    Listings with _count=true would otherwise count the matching
+    documents on every page. All the counts of a collection are dropped
+    when it is written through the API, and any count expires after ttl
+    seconds, which bounds how stale it can be when the collection is
+    changed elsewhere (e.g. by another server process).
+    """
+    def __init__(self, max_size=1000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def generation(self, database_name, collection):
+        """The number of invalidations so far for the collection,
+        see ModelRegistry.generation."""
+        return self._generations.get((database_name, collection), 0)
+
+    def get(self, database_name, collection, spec):
+        """Get the count, or None if we do not have it."""
+        key = (database_name, collection, count_key(spec))
+        try:
+            count, stored = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - stored > self.ttl:
+            self.misses += 1
+            return None
+        self._entries[key] = (count, stored)
+        self.hits += 1
+        return count
+
+    def store(self, database_name, collection, spec, count,
+              generation=None):
+        """Store the count of the query."""
+        if generation is not None and \
+                generation != self.generation(database_name, collection):
+            return
+        key = (database_name, collection, count_key(spec))
+        self._entries.pop(key, None)
+        self._entries[key] = (count, time.time())
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, database_name, collection):
+        """Forget the counts of the collection."""
+        self._generations[(database_name, collection)] = \
+            self.generation(database_name, collection) + 1
+        for key in list(self._entries):
+            if key[0] == database_name and key[1] == collection:
+                del self._entries[key]
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)}
+
+
+class SyncStateCache(object):
+    """The sync state of the applications: the id of the newest history
+    entry of each model, and which models each application has.
+
+    The history is only ever added to, and its ids increase, so an
+    entry is only ever moved forward, both by the query that fills it
+    and by the history written through the API. Entries expire after
+    ttl seconds, so history written elsewhere (e.g. by another server
+    process) is picked up. The models of the applications are dropped
+    when a _model is written through the API.
+    """
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._latest = {}
+        self._applications = {}
+        self._generations = {}
+
+    def _fresh(self, stored):
+        """Is an entry stored then still good?"""
+        return self.ttl is None or time.time() - stored <= self.ttl
+
+    def generation(self, database_name):
+        """The number of model invalidations so far for the database,
+        see ModelRegistry.generation."""
+        return self._generations.get(database_name, 0)
+
+    def get_models(self, database_name, app_name):
+        """The model names of the application, or None if not known."""
+        try:
+            model_names, stored = self._applications[
+                (database_name, app_name)]
+        except KeyError:
+            return None
+        if not self._fresh(stored):
+            return None
+        return model_names
+
+    def store_models(self, database_name, app_name, model_names,
+                     generation=None):
+        """Store the model names of the application."""
+        if generation is not None and \
+                generation != self.generation(database_name):
+            return
+        self._applications[(database_name, app_name)] = (
+            list(model_names), time.time())
+
+    def invalidate_models(self, database_name):
+        """Forget the models of the applications of the database."""
+        self._generations[database_name] = \
+            self.generation(database_name) + 1
+        for key in list(self._applications):
+            if key[0] == database_name:
+                del self._applications[key]
+
+    def get(self, database_name, model_names):
+        """Get the newest history id of each model.
+        Returns the state, with the models that have history,
+        and a list of the models we do not know about."""
+        state = {}
+        missing = []
+        for model_name in model_names:
+            try:
+                history_id, stored = self._latest[
+                    (database_name, model_name)]
+            except KeyError:
+                missing.append(model_name)
+                continue
+            if not self._fresh(stored):
+                missing.append(model_name)
+            elif history_id is not None:
+                state[model_name] = history_id
+        if missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return state, missing
+
+    def store(self, database_name, latest, model_names):
+        """Store the newest history ids of the models.
+        latest - a dict of model name to history id.
+        model_names - the models asked about, those not in latest
+                      have no history."""
+        now = time.time()
+        for model_name in model_names:
+            key = (database_name, model_name)
+            history_id = latest.get(model_name)
+            current = self._latest.get(key, (None, now))[0]
+            if current is not None and \
+                    (history_id is None or current > history_id):
+                history_id = current
+            self._latest[key] = (history_id, now)
+
+    def advance(self, database_name, model_name, history_id):
+        """History has been written for the model."""
+        key = (database_name, model_name)
+        if key not in self._latest:
+            return
+        current, stored = self._latest[key]
+        if current is None or history_id > current:
+            self._latest[key] = (history_id, stored)
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._latest)}
@@ -0,0 +1,341 @@
+"""Push the changes to the instances to the sync clients.
+
+/api/_sync/changes/<app>/ is a Server-Sent Events stream of the changes
+to the app's models that the user can read (or just those listed in
+?models=<model>,<model>). Each change is a "change" event, with the
+data as given by /api/_sync/update/ (see transactions.py):
+
+    id: <history id>
+    event: change
+    data: {"_id": ..., "document_model": "book", "operation": ..., ...}
+
+A client that reconnects resumes from the last history id it saw,
+sent as Last-Event-ID (as browsers do) or ?after=<history id>.
+If it has missed more than a page of changes, it is sent a "resync"
+event, and should catch up with /api/_sync/update/ instead.
+
+Each server process polls the history for all of its clients together,
+every change_feed_interval seconds while anybody is listening. History
+ids are made before the history is written, so an entry can turn up
+after newer ones, and the newest id seen is not a safe place to carry
+on from. Instead each poll starts from the oldest history this process
+is still writing (however long that takes), or FEED_LOOKBACK seconds
+back for what other processes write, whichever is older.
+
+The feed is for speed, not for keeping count: clients only move their
+sync state on with /api/_sync/update/, which they run again whenever
+the feed reconnects or sends "resync".
+"""
+
+from __future__ import print_function
+
+import time
+from datetime import datetime, timedelta
+from functools import partial
+import tornado.web
+import tornado.ioloop
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING
+
+from magpy.server.database import DatabaseMixin
+from magpy.server.auth import AuthenticationMixin
+from magpy.server.serialization import dumps
+from magpy.server.transactions import ChangeCoalescer, fill_in_documents, \
+    DEFAULT_SYNC_PAGE_SIZE
+
+DEFAULT_FEED_INTERVAL = 1
+FEED_LOOKBACK = 5
+FEED_MAX_ENTRIES = 10000
+# Send a comment when nothing else has been sent for this long,
+# so that proxies do not close the connection.
+FEED_KEEPALIVE = 15
+FEED_RETRY_MS = 5000
+
+
+def format_event(data, event=None, event_id=None):
+    """Format a Server-Sent Event."""
+    lines = []
+    if event_id is not None:
+        lines.append('id: %s' % event_id)
+    if event is not None:
+        lines.append('event: %s' % event)
+    lines.append('data: %s' % data)
+    return '\n'.join(lines) + '\n\n'
+
+
+class ChangeFeed(object):
+    """Polls the history of each database that has listeners,
+    and passes the new changes on to them.
+    Listeners are called with a list of (change, serialised change).
+    history_writer - the process's HistoryWriter, if it has one."""
+    def __init__(self, connection, ioloop,
+                 interval=DEFAULT_FEED_INTERVAL,
+                 lookback=FEED_LOOKBACK,
+                 history_writer=None):
+        self.connection = connection
+        self.ioloop = ioloop
+        self.interval = interval
+        self.lookback = lookback
+        self.history_writer = history_writer
+        self._listeners = {}
+        self._seen = {}
+        self._writing = {}
+        self._after = {}
+        self._polling = set()
+        self._timer = None
+
+    def subscribe(self, database_name, listener):
+        """Start passing the changes in the database to the listener."""
+        self._listeners.setdefault(database_name, set()).add(listener)
+        if self._timer is None:
+            self._timer = tornado.ioloop.PeriodicCallback(
+                self.poll, self.interval * 1000, io_loop=self.ioloop)
+            self._timer.start()
+
+    def unsubscribe(self, database_name, listener):
+        """Stop passing changes to the listener."""
+        listeners = self._listeners.get(database_name, set())
+        listeners.discard(listener)
+        if not listeners:
+            self._listeners.pop(database_name, None)
+            self._seen.pop(database_name, None)
+            self._after.pop(database_name, None)
+        if not self._listeners and self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def writing(self, database_name, history_ids):
+        """The history with these ids is being written directly."""
+        self._writing.setdefault(database_name, set()).update(history_ids)
+
+    def written(self, database_name, history_ids):
+        """The history has been written (or has failed)."""
+        writing = self._writing.get(database_name, set())
+        writing.difference_update(history_ids)
+        if not writing:
+            self._writing.pop(database_name, None)
+
+    def since(self, database_name):
+        """Where a poll of the database must start from, to be sure of
+        not missing history that is written late."""
+        since = ObjectId.from_datetime(
+            datetime.utcnow() - timedelta(seconds=self.lookback))
+        unwritten = list(self._writing.get(database_name, ()))
+        if self.history_writer is not None:
+            unwritten.append(
+                self.history_writer.oldest_unwritten(database_name))
+        unwritten = [history_id for history_id in unwritten
+                     if history_id is not None]
+        if unwritten:
+            since = min(since, min(unwritten))
+        return since
+
+    def poll(self):
+        """Look for new history in each database with listeners."""
+        for database_name in list(self._listeners):
+            if database_name in self._polling:
+                # The last poll is still going
+                continue
+            self._polling.add(database_name)
+            since = self.since(database_name)
+            after = self._after.get(database_name)
+            if after is None or after < since:
+                after = since
+            history = self.connection[database_name]['_history']
+            history.find({'_id': {'$gte': after}},
+                         fields={'comment': False}).sort(
+                             '_id', ASCENDING).to_list(
+                                 length=FEED_MAX_ENTRIES,
+                                 callback=partial(
+                                     self._polled,
+                                     database_name=database_name,
+                                     since=since))
+
+    def _polled(self, entries, error, database_name, since):
+        """Coalesce the new entries and fill in their documents."""
+        if error:
+            self._polling.discard(database_name)
+            print("Warning: could not read the history: %s" % (error,))
+            return
+        entries = entries or []
+        if len(entries) == FEED_MAX_ENTRIES:
+            # Carry on from here next time
+            self._after[database_name] = entries[-1]['_id']
+        else:
+            self._after.pop(database_name, None)
+        coalescer = ChangeCoalescer()
+        for entry in self.new_entries(database_name, entries, since):
+            coalescer.add(entry)
+        fill_in_documents(self.connection[database_name], coalescer,
+                          partial(self._dispatch,
+                                  database_name=database_name,
+                                  coalescer=coalescer))
+
+    def new_entries(self, database_name, entries, since=None):
+        """The entries that have not been seen before.
+        The ids are remembered until polls start after them."""
+        seen = self._seen.setdefault(database_name, set())
+        if since is not None:
+            seen.difference_update(
+                [history_id for history_id in seen if history_id < since])
+        new = []
+        for entry in entries:
+            if entry['_id'] not in seen:
+                seen.add(entry['_id'])
+                new.append(entry)
+        return new
+
+    def _dispatch(self, error, database_name, coalescer):
+        """Pass the changes on to the listeners."""
+        self._polling.discard(database_name)
+        if error:
+            print("Warning: could not fill in the changes: %s" % (error,))
+        changes = [(change, dumps(change)) for change in coalescer]
+        for listener in list(self._listeners.get(database_name, ())):
+            listener(changes)
+
+
+class ChangeFeedHandler(tornado.web.RequestHandler,
+                        DatabaseMixin,
+                        AuthenticationMixin):
+    """Stream the changes to the models of an app to the client."""
+    # pylint: disable=W0221,R0904
+    model_names = None
+    sent = ()
+    buffered = None
+    subscribed = False
+    last_write = 0
+
+    @property
+    def change_feed(self):
+        """The application's change feed, if it has one."""
+        return getattr(self.application, 'change_feed', None)
+
+    @tornado.web.asynchronous
+    def get(self, app_name):
+        if self.change_feed is None:
+            raise tornado.web.HTTPError(404, "The change feed is off")
+        after = self.request.headers.get('Last-Event-ID') or \
+            self.get_argument('after', None)
+        if after:
+            try:
+                after = ObjectId(after)
+            except (InvalidId, TypeError):
+                raise tornado.web.HTTPError(400, "Invalid history id")
+        wanted = self.get_argument('models', None)
+        models = self.get_collection('_model')
+        models.find({'_applications': app_name},
+                    fields=['_id', ]).to_list(
+                        callback=partial(
+                            self._check_models,
+                            wanted=wanted.split(',') if wanted else None,
+                            after=after or None))
+
+    def _check_models(self, models, error, wanted, after):
+        """Find out which of the models the user can read."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        model_names = [model['_id'] for model in models
+                       if wanted is None or model['_id'] in wanted]
+        if not model_names:
+            raise tornado.web.HTTPError(404)
+        self.get_effective_permissions(
+            model_names, partial(self._start, after=after))
+
+    def _start(self, permissions, after):
+        """Start the stream, catching up first if we were given
+        where to resume from."""
+        self.model_names = set(
+            model_name for model_name, permission in permissions.items()
+            if permission.get('read'))
+        if not self.model_names:
+            return self.permission_denied()
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        # Tell Nginx not to buffer the stream
+        self.set_header("X-Accel-Buffering", "no")
+        self._send('retry: %s\n\n' % FEED_RETRY_MS)
+        # Keep any changes that arrive while we catch up
+        self.buffered = []
+        self.change_feed.subscribe(self.database_name, self._on_changes)
+        self.subscribed = True
+        if after is None:
+            return self._caught_up()
+        page_size = self.settings.get('sync_page_size',
+                                      DEFAULT_SYNC_PAGE_SIZE)
+        history = self.get_collection('_history')
+        history.find({'document_model': {'$in': list(self.model_names)},
+                      '_id': {'$gt': after}},
+                     fields={'delta': False, 'comment': False}).sort(
+                         '_id', ASCENDING).limit(page_size + 1).to_list(
+                             callback=partial(self._catch_up,
+                                              page_size=page_size))
+
+    def _catch_up(self, entries, error, page_size):
+        """Send the changes since the client was last here."""
+        if error or len(entries) > page_size:
+            # Too far behind, the client should sync instead
+            self._send(format_event('{}', 'resync'))
+            return self._caught_up()
+        self.sent = set(entry['_id'] for entry in entries)
+        coalescer = ChangeCoalescer()
+        for entry in entries:
+            coalescer.add(entry)
+        fill_in_documents(self.database, coalescer,
+                          partial(self._send_caught_up,
+                                  coalescer=coalescer))
+
+    def _send_caught_up(self, error, coalescer):
+        """Send the coalesced changes."""
+        # pylint: disable=W0613
+        self._send(''.join(
+            format_event(dumps(change), 'change', change['_id'])
+            for change in coalescer))
+        return self._caught_up()
+
+    def _caught_up(self):
+        """Send what arrived while we were catching up,
+        then send changes as they come."""
+        buffered = self.buffered or []
+        self.buffered = None
+        self._on_changes(buffered)
+
+    def _on_changes(self, changes):
+        """Send the changes to the models the client wants."""
+        if self.buffered is not None:
+            self.buffered.extend(changes)
+            return
+        events = ''.join(
+            format_event(data, 'change', change['_id'])
+            for change, data in changes
+            if change['document_model'] in self.model_names and
+            change['_id'] not in self.sent)
+        if events:
+            self._send(events)
+        elif time.time() - self.last_write > FEED_KEEPALIVE:
+            self._send(': keepalive\n\n')
+
+    def _send(self, text):
+        """Write to the client now."""
+        self.last_write = time.time()
+        try:
+            self.write(text)
+            self.flush()
+        except IOError:
+            # The client has gone
+            self._unsubscribe()
+
+    def _unsubscribe(self):
+        """Stop listening to the changes."""
+        if self.subscribed:
+            self.subscribed = False
+            self.change_feed.unsubscribe(self.database_name,
+                                         self._on_changes)
+
+    def on_connection_close(self):
+        self._unsubscribe()
+
+    def on_finish(self):
+        self._unsubscribe()
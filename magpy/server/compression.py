@@ -0,0 +1,153 @@
+"""Compress the responses.
+
+JSON compresses very well, so responses are compressed with brotli
+(if the brotli package is installed and the client accepts it) or gzip.
+The transform works on each chunk as it is flushed, so streamed lists
+are compressed as they go out.
+
+Responses with Cache-Control: no-transform, such as media files, are
+left alone. A compressed response's ETag is made weak, as its bytes
+are not the same as the uncompressed response's.
+"""
+
+import zlib
+import tornado.web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable=C0103
+
+DEFAULT_MIN_LENGTH = 1024
+DEFAULT_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = frozenset((
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml'))
+
+
+def accepted_encodings(accept_encoding):
+    """The encodings the client accepts, from an Accept-Encoding header."""
+    encodings = set()
+    for part in (accept_encoding or '').split(','):
+        pieces = part.strip().split(';')
+        name = pieces[0].strip().lower()
+        quality = 1.0
+        for parameter in pieces[1:]:
+            key, _, value = parameter.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            encodings.add(name)
+    return encodings
+
+
+def choose_encoding(accept_encoding, use_brotli=True):
+    """Return br, gzip or None for the Accept-Encoding header."""
+    accepted = accepted_encodings(accept_encoding)
+    if use_brotli and brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+class GzipCompressor(object):
+    """Gzip a stream of chunks."""
+    def __init__(self, level=DEFAULT_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk, finishing):
+        """Compress the chunk, and send it out with the rest of the data
+        so far, so it can be flushed to the client."""
+        data = self._compressor.compress(chunk)
+        if finishing:
+            return data + self._compressor.flush()
+        return data + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class BrotliCompressor(object):
+    """Brotli compress a stream of chunks."""
+    def __init__(self, quality=DEFAULT_BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, chunk, finishing):
+        """Compress the chunk, and send it out with the rest of the data
+        so far, so it can be flushed to the client."""
+        data = self._compressor.process(chunk)
+        if finishing:
+            return data + self._compressor.finish()
+        return data + self._compressor.flush()
+
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """Compress the response if the client accepts it, and it is text
+    that is big enough to be worth it.
+    Use functools.partial to give the settings."""
+    # pylint: disable=W0231
+    def __init__(self, request,
+                 min_length=DEFAULT_MIN_LENGTH,
+                 level=DEFAULT_LEVEL,
+                 brotli_quality=DEFAULT_BROTLI_QUALITY,
+                 use_brotli=True):
+        self._encoding = choose_encoding(
+            request.headers.get('Accept-Encoding'), use_brotli)
+        self._min_length = min_length
+        self._level = level
+        self._brotli_quality = brotli_quality
+        self._compressor = None
+
+    def _compressible(self, status_code, headers, chunk, finishing):
+        """Is the response worth compressing?"""
+        if self._encoding is None or status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in headers or 'Content-Range' in headers:
+            return False
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        content_type = headers.get('Content-Type', '').split(';')[0]
+        if content_type.strip().lower() not in COMPRESSIBLE_TYPES:
+            return False
+        # If the response is still coming, we cannot tell how big it is
+        return not finishing or len(chunk) >= self._min_length
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        """Decide whether to compress, and start compressing."""
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if self._compressible(status_code, headers, chunk, finishing):
+            headers['Content-Encoding'] = self._encoding
+            if self._encoding == 'br':
+                self._compressor = BrotliCompressor(self._brotli_quality)
+            else:
+                self._compressor = GzipCompressor(self._level)
+            chunk = self.transform_chunk(chunk, finishing)
+            etag = headers.get('Etag')
+            if etag and not etag.startswith('W/'):
+                headers['Etag'] = 'W/' + etag
+            if 'Content-Length' in headers:
+                if finishing:
+                    headers['Content-Length'] = str(len(chunk))
+                else:
+                    del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        """Compress the chunk, if we are compressing."""
+        if self._compressor is None:
+            return chunk
+        return self._compressor.compress(chunk, finishing)
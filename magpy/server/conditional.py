@@ -0,0 +1,81 @@
+"""Conditional GET support, i.e. ETag and If-None-Match.
+
+An instance's ETag is made from its _id and _meta._version.
+A list's ETag is made from the query and the newest _history entry
+of the resource, since every change made through the API adds one.
+"""
+
+import hashlib
+from functools import partial
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+
+# History entries are written just before the change itself,
+# so a list is not given an ETag until its newest change has settled.
+LIST_ETAG_SETTLE_TIME = timedelta(seconds=5)
+
+
+def instance_etag(instance):
+    """Return the ETag of an instance, or None if it has no version."""
+    try:
+        version = instance['_meta']['_version']
+    except (KeyError, TypeError):
+        return None
+    return '"%s-%s"' % (instance['_id'], version)
+
+
+def list_etag(history_id, query):
+    """Return the ETag for a list query, given the _id of the newest
+    _history entry of the resource, or None."""
+    if isinstance(history_id, ObjectId):
+        if datetime.now(utc) - history_id.generation_time < \
+                LIST_ETAG_SETTLE_TIME:
+            return None
+    key = '%s?%s' % (history_id, query)
+    return '"list-%s"' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def etag_matches(if_none_match, etag):
+    """Does the If-None-Match header value include the ETag?"""
+    if not if_none_match or not etag:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+class ConditionalMixin(object):
+    """Answer GET requests with 304 Not Modified when the client
+    already has the current version."""
+
+    def not_modified(self, etag):
+        """If the client has the ETag, send 304 and return True.
+        Otherwise set the ETag on the response and return False."""
+        if not etag:
+            return False
+        self.set_header('Etag', etag)
+        if etag_matches(self.request.headers.get('If-None-Match'), etag):
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def get_list_marker(self, resource, callback):
+        """Get the _id of the newest history entry of the resource.
+        Calls callback(history_id, error)."""
+        writer = getattr(self.application, 'history_writer', None)
+        if writer is not None and writer.pending(self.database_name,
+                                                 resource):
+            # The newest history is not written yet, so no marker
+            return callback(None, None)
+        history = self.get_collection('_history')
+        history.find_one({'document_model': resource},
+                         fields=['_id'],
+                         sort=[('_id', -1)],
+                         callback=partial(self._got_list_marker,
+                                          callback=callback))
+
+    @staticmethod
+    def _got_list_marker(result, error, callback):
+        """Pass on just the _id."""
+        return callback(result['_id'] if result else None, error)
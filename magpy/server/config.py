@@ -21,6 +21,32 @@ class MagpyConfigParser(object):
         self.port = 8000
         self.databases = None
         self.cookie_secret = None
+        self.permission_cache_size = 10000
+        self.permission_cache_ttl = 60
+        self.stream_flush_bytes = 65536
+        self.stream_flush_count = 1000
+        self.count_cache_size = 1000
+        self.count_cache_ttl = 30
+        self.create_indexes = False
+        self.query_stats_interval = 60
+        self.media_root = '/srv/itsee/mediamanager/restricted/'
+        self.media_threads = 4
+        self.media_upload_max_bytes = 1024 * 1024 * 1024
+        self.media_accel_redirect = None
+        self.compression = True
+        self.compression_min_length = 1024
+        self.compression_level = 6
+        self.production = False
+        self.processes = 0
+        self.history_writer = 'direct'
+        self.history_batch_size = 500
+        self.history_batch_delay = 0.05
+        self.history_storage = 'full'
+        self.history_snapshot_interval = 20
+        self.sync_page_size = 1000
+        self.sync_state_ttl = 30
+        self.change_feed_interval = 1
+        self.model_registry_ttl = 60
         if not config_file:
             config_file = os.path.join(
                 get_mag_path(), 'server', 'defaultconfig.json')
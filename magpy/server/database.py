@@ -2,19 +2,23 @@
 
 from __future__ import print_function
 
+import re
 import sys
 from copy import deepcopy
 from functools import partial
 
+import six
 import tornado.web
-#from bson.objectid import ObjectId
+from bson.objectid import ObjectId
 
 from magpy.server.utils import instance_list_to_dict
 from magpy.server.validators import validate_model_instance, \
-    ValidationError, MissingFields, parse_instance, validate_modification, \
-    get_all_modification_modelnames
+    ValidationError, MissingFields, InvalidInstance, parse_instance, \
+    validate_modification, get_all_modification_modelnames
 
 from magpy.server.config import MagpyConfigParser
+from magpy.server.deltas import make_delta, is_snapshot, rebuild_version, \
+    DEFAULT_SNAPSHOT_INTERVAL
 
 try:
     from settings import DEFAULT_DATABASE
@@ -33,33 +37,91 @@ class ModelIndexError(Exception):
     pass
 
 
+def read_preference_mode(name):
+    """The pymongo read preference for its name,
+    e.g. secondaryPreferred or SECONDARY_PREFERRED."""
+    from pymongo import ReadPreference
+    attribute = re.sub('([a-z])([A-Z])', r'\1_\2', name).upper()
+    try:
+        return getattr(ReadPreference, attribute)
+    except AttributeError:
+        raise ValueError("Unknown read preference %s" % name)
+
+
+def connection_options(database_settings):
+    """The keyword arguments for the MongoDB client of a database alias.
+    database_settings - the alias's entry in the databases setting, e.g.
+        {"ENGINE": "mongodb",
+         "NAME": "vmr",
+         "HOST": "localhost",
+         "PORT": 27017,
+         "OPTIONS": {"max_pool_size": 100},
+         "READ_PREFERENCE": "secondaryPreferred",
+         "WRITE_CONCERN": {"w": 1, "j": true},
+         "HISTORY_WRITE_CONCERN": {"w": 1}}
+    OPTIONS are passed to the client as they are.
+    The WRITE_CONCERN is the default for all writes, the
+    HISTORY_WRITE_CONCERN is used for the _history instead."""
+    options = {'tz_aware': True}
+    if 'HOST' in database_settings:
+        options['host'] = database_settings['HOST']
+    if 'PORT' in database_settings:
+        options['port'] = int(database_settings['PORT'])
+    options.update(database_settings.get('OPTIONS', {}))
+    if database_settings.get('READ_PREFERENCE'):
+        options['read_preference'] = read_preference_mode(
+            database_settings['READ_PREFERENCE'])
+    options.update(database_settings.get('WRITE_CONCERN', {}))
+    return options
+
+
+def with_write_concern(collection, write_concern):
+    """Return the collection with the write concern,
+    e.g. {'w': 0} or {'w': 'majority', 'wtimeout': 5000}."""
+    if not write_concern:
+        return collection
+    # Motor makes up a subcollection for any unknown attribute
+    if hasattr(type(collection), 'with_options'):
+        from pymongo.write_concern import WriteConcern
+        return collection.with_options(
+            write_concern=WriteConcern(**write_concern))
+    collection.write_concern = dict(write_concern)
+    return collection
+
+
 class Database(object):
     """Simple database connection for use in serverside scripts etc."""
     def __init__(self,
                  database_name=None,
                  config_file=None,
-                 database_type=None):
+                 database_type=None,
+                 alias='default'):
         # Get the configuration
         self.config = MagpyConfigParser(config_file)
+        database_settings = self.config.databases.get(alias, {})
+        self.history_write_concern = database_settings.get(
+            'HISTORY_WRITE_CONCERN')
 
         # Get the database engine type
         if not database_type:
-            database_type = self.config.databases['default']['ENGINE']
+            database_type = database_settings.get('ENGINE', 'mongodb')
 
         # Get the client class
         if database_type == 'ainodb':
             from ainodb import Client
             from ainodb.errors import ConnectionFailure
+            options = {'tz_aware': True}
         else:
             try:
                 from pymongo import MongoClient as Client
             except ImportError:
                 from pymongo import Connection as Client
             from pymongo.errors import ConnectionFailure
+            options = connection_options(database_settings)
 
         # Make a connection
         try:
-            self.connection = Client(tz_aware=True)
+            self.connection = Client(**options)  # pylint: disable=W0142
         except ConnectionFailure:
             print("Could not connect to the database.")
             print("Are you sure it is installed and is running?")
@@ -71,10 +133,10 @@ class Database(object):
         # Get the database
         if not database_name:
 
-            if DEFAULT_DATABASE:
+            if DEFAULT_DATABASE and alias == 'default':
                 database_name = DEFAULT_DATABASE
             else:
-                database_name = self.config.databases['default']['NAME']
+                database_name = database_settings['NAME']
 
         self._database_name = database_name
         self.database = self.connection[database_name]
@@ -86,6 +148,9 @@ class Database(object):
 
     def get_collection(self, collection):
         """Get a collection by name."""
+        if collection == '_history':
+            return with_write_concern(self.database[collection],
+                                      self.history_write_concern)
         return self.database[collection]
 
     def drop_collection(self, collection):
@@ -269,36 +334,262 @@ class DatabaseMixin(object):
     def get_collection(self, collection):
         """Get a collection.
         """
+        if collection == '_history':
+            return with_write_concern(
+                self.database[collection],
+                getattr(self.application, 'history_write_concern', None))
         return self.database[collection]
 
+    @property
+    def model_registry(self):
+        """The application's model registry, if it has one."""
+        return getattr(self.application, 'model_registry', None)
+
+    @property
+    def history_snapshot_interval(self):
+        """How often to keep a whole document in a delta history,
+        None if the history keeps whole documents."""
+        if self.settings.get('history_storage') != 'delta':
+            return None
+        return self.settings.get('history_snapshot_interval',
+                                 DEFAULT_SNAPSHOT_INTERVAL)
+
+    def get_version(self, model_name, document_id, version_number,
+                    callback):
+        """Rebuild a version of an instance from the history.
+        version_number - the version, or None for the newest.
+        Calls callback(document, error)."""
+        history = self.get_collection('_history')
+        history.find({'document_model': model_name,
+                      'document_id': document_id}).sort(
+                          '_id', 1).to_list(
+                              callback=partial(self._rebuild_version,
+                                               version_number=version_number,
+                                               callback=callback))
+
+    @staticmethod
+    def _rebuild_version(entries, error, version_number, callback):
+        """Put the version together from its snapshot and deltas."""
+        if error:
+            return callback(None, error)
+        return callback(rebuild_version(entries, version_number), None)
+
+    @property
+    def count_cache(self):
+        """The application's count cache, if it has one."""
+        return getattr(self.application, 'count_cache', None)
+
+    @property
+    def sync_state_cache(self):
+        """The application's sync state cache, if it has one."""
+        return getattr(self.application, 'sync_state_cache', None)
+
+    @property
+    def query_recorder(self):
+        """The application's query recorder, if it has one."""
+        return getattr(self.application, 'query_recorder', None)
+
     def get_model(self, model_name, callback):
         """Get a model."""
+        registry = self.model_registry
+        if registry is not None:
+            model = registry.get(self.database_name, model_name)
+            if model is not None:
+                return callback(model, None)
+            callback = partial(
+                self._store_models,
+                callback=callback,
+                generation=registry.generation(self.database_name))
         models = self.get_collection('_model')
         models.find_one({'_id': model_name},
                         callback=callback)
 
     def get_models(self, model_names, callback):
         """Get a set of models by name."""
+        registry = self.model_registry
+        if registry is None:
+            found = []
+            missing = model_names
+        else:
+            found, missing = registry.get_many(self.database_name,
+                                               model_names)
+            if not missing:
+                return callback(found, None)
+            callback = partial(
+                self._store_models,
+                callback=callback,
+                generation=registry.generation(self.database_name),
+                found=found)
         models = self.get_collection('_model')
-        models.find(spec={'_id': {'$in': tuple(model_names)}}).to_list(
+        models.find(spec={'_id': {'$in': tuple(missing)}}).to_list(
             callback=callback)
 
+    def _store_models(self, result, error, callback, generation,
+                      found=None):
+        """Keep the fetched model(s) in the registry."""
+        if result:
+            models = result if isinstance(result, list) else [result]
+            self.model_registry.store(self.database_name,
+                                      models,
+                                      generation)
+        if found is not None:
+            result = found + (result or [])
+        return callback(result, error)
+
+    def notify_change(self, collection, ids=None):
+        """Tell the in-process caches that documents in the collection
+        have been written through the API.
+        ids - the ids of the changed documents, None if not known."""
+        counts = self.count_cache
+        if counts is not None:
+            counts.invalidate(self.database_name, collection)
+
+        if collection == '_model':
+            registry = self.model_registry
+            if registry is not None:
+                registry.invalidate(self.database_name, ids)
+            sync_state = self.sync_state_cache
+            if sync_state is not None:
+                sync_state.invalidate_models(self.database_name)
+
+        if collection in ('_model', '_user', '_group'):
+            cache = getattr(self.application, 'permission_cache', None)
+            if cache is not None:
+                if collection == '_model':
+                    cache.invalidate_resources(self.database_name, ids)
+                elif collection == '_user':
+                    cache.invalidate_users(self.database_name, ids)
+                else:
+                    # Any user could be in the group
+                    cache.invalidate(self.database_name)
+
+    def notify_instances_changed(self, instances):
+        """Notify the changes to a list of instances."""
+        changed = {}
+        for instance in instances:
+            changed.setdefault(instance['_model'], []).append(
+                instance['_id'])
+        for collection, ids in six.iteritems(changed):
+            self.notify_change(collection, ids)
+
+    def _written(self, response, error, collection, ids=None):
+        """Callback for writes that have nothing more to do."""
+        # pylint: disable=W0613
+        self.notify_change(collection, ids)
+
+    def replace_instances(self, collection_name, instances, callback):
+        """Replace each of the instances, found by _id.
+        With a driver that has the bulk write API, this is one ordered
+        bulk write, otherwise all the updates are sent at once rather than
+        waiting for each in turn. Calls callback(response, error)."""
+        coll = self.get_collection(collection_name)
+        if not instances:
+            return callback(None, None)
+        # Look on the class, as the collection makes up attributes
+        if hasattr(type(coll), 'initialize_ordered_bulk_op'):
+            bulk = coll.initialize_ordered_bulk_op()
+            for instance in instances:
+                bulk.find({'_id': instance['_id']}).replace_one(instance)
+            return bulk.execute(callback=callback)
+
+        progress = {'waiting': len(instances), 'error': None}
+        done = partial(self._replaced,
+                       progress=progress,
+                       callback=callback)
+        for instance in instances:
+            coll.update({'_id': instance['_id']},
+                        instance,
+                        callback=done)
+
+    @staticmethod
+    def _replaced(response, error, progress, callback):
+        """Count the updates in, callback when they are all done."""
+        # pylint: disable=W0613
+        progress['waiting'] -= 1
+        if error and not progress['error']:
+            progress['error'] = error
+        if not progress['waiting']:
+            return callback(None, progress['error'])
+
     def update_history(self,
                        instance,
                        operation,
                        success,
-                       versional_comment=None):
-        """Add version or versions to history."""
-
+                       versional_comment=None,
+                       previous=None):
+        """Add version or versions to history.
+        previous - the instance (or instances) as they were before,
+                   which lets an update be stored as a delta."""
+        snapshot_interval = self.history_snapshot_interval
+        writer = getattr(self.application, 'history_writer', None)
+        if snapshot_interval and previous is not None and \
+                writer is not None:
+            # Keep the whole instance if a version before was lost
+            if isinstance(instance, dict):
+                if self._version_dropped(writer, instance):
+                    previous = None
+            else:
+                previous = [None if self._version_dropped(writer, item)
+                            else old
+                            for item, old in zip(instance, previous)]
         if isinstance(instance, dict):
             # We have a single instance
-            version = create_version(instance, operation, versional_comment)
+            version = create_version(instance, operation, versional_comment,
+                                     previous, snapshot_interval)
         else:
             # We have multiple versions (or junk)
-            version = create_versions(instance, operation, versional_comment)
+            version = create_versions(instance, operation, versional_comment,
+                                      previous, snapshot_interval)
+        # Give the versions their ids now, so the sync state
+        # can be moved on to them even when the insert is done later.
+        for item in version if isinstance(version, list) else [version]:
+            item['_id'] = ObjectId()
+        callback = partial(self._history_updated,
+                           instance=instance,
+                           success=success,
+                           version=version)
+        if writer is not None:
+            return writer.add(self.database_name, version, callback)
+        change_feed = getattr(self.application, 'change_feed', None)
+        if change_feed is not None:
+            # Hold the feed back until this is written
+            change_feed.writing(
+                self.database_name,
+                [item['_id'] for item in
+                 (version if isinstance(version, list) else [version])])
         history_collection = self.get_collection('_history')
         history_collection.insert(version,
-                                  callback=success)
+                                  callback=callback)
+
+    def _version_dropped(self, writer, instance):
+        """Did the history writer drop a version of the instance?"""
+        if not isinstance(instance, dict):
+            return False
+        return writer.take_dropped(self.database_name,
+                                   instance.get('_model'),
+                                   instance.get('_id'))
+
+    def _history_updated(self, response, error, instance, success,
+                         version=None):
+        """The history is written, so the change is done (or nearly)."""
+        self.notify_change('_history')
+        change_feed = getattr(self.application, 'change_feed', None)
+        if change_feed is not None and version is not None:
+            change_feed.written(
+                self.database_name,
+                [item['_id'] for item in
+                 (version if isinstance(version, list) else [version])])
+        sync_state = self.sync_state_cache
+        if sync_state is not None and version is not None and not error:
+            for item in version if isinstance(version, list) else [version]:
+                sync_state.advance(self.database_name,
+                                   item['document_model'],
+                                   item['_id'])
+        if isinstance(instance, dict):
+            self.notify_instances_changed([instance])
+        else:
+            self.notify_instances_changed(instance)
+        return success(response, error)
 
 
 class ValidationMixin(object):
@@ -385,7 +676,6 @@ class ValidationMixin(object):
 
     def _request_model(self, instance, success, get_embedded=True):
         """Get the model from the database."""
-        coll = self.get_collection('_model')
         if get_embedded:
             callback = partial(self._get_embedded_model_names,
                                instance=instance,
@@ -397,8 +687,8 @@ class ValidationMixin(object):
             instance['_model']
         except KeyError:
             raise tornado.web.HTTPError(400, 'Missing model key')
-        coll.find_one({'_id': instance['_model']},
-                      callback=callback)
+        self.get_model(instance['_model'],
+                       callback=callback)
 
     def _get_embedded_model_names(self, model, error, instance, success):
         """Get the names of the embedded instance models."""
@@ -470,27 +760,92 @@ class ValidationMixin(object):
             raise tornado.web.HTTPError(400, "Validation Error")
         success(instance)
 
+    def validate_instances(self, instances, callback):
+        """Validate a batch of instances, getting all the models
+        they use in one go.
+        Calls callback(problems), where problems has, for each instance,
+        None if it is valid, otherwise a message saying why it is not."""
+        model_names = set()
+        for instance in instances:
+            parse_instance(instance, model_names)
+        self.get_models(model_names=list(model_names),
+                        callback=partial(self._validate_batch,
+                                         instances=instances,
+                                         callback=callback))
+
+    @staticmethod
+    def _validate_batch(models, error, instances, callback):
+        """Validate each instance against the fetched models."""
+        # pylint: disable=W0613
+        models = instance_list_to_dict(models or [])
+        return callback([validation_problem(models, instance)
+                         for instance in instances])
+
+
+def validation_problem(models, instance):
+    """Return why the instance does not validate, or None if it does.
+    models - a dictionary of every model the instance uses, by name."""
+    model = models.get(instance.get('_model'))
+    if model is None:
+        return "Unknown model"
+    try:
+        validate_model_instance(model,
+                                instance,
+                                embedded_models=models)
+    except MissingFields as fields:
+        return "Missing Fields %s" % fields
+    except InvalidInstance as fields:
+        return "Invalid Fields %s" % fields
+    except ValidationError:
+        return "Validation Error"
+    return None
+
 
 def create_version(instance,
                    operation,
-                   versional_comment=None):
+                   versional_comment=None,
+                   previous=None,
+                   snapshot_interval=None):
     """Create a version dictionary for an instance.
     operation - one of 'create', 'update' or 'delete'.
+    previous - the instance before the update, if known.
+    snapshot_interval - if given, an update is stored as a delta
+                        from previous, except every snapshot_interval
+                        versions, when the whole instance is kept.
     """
     if not versional_comment:
         versional_comment = "Instance %sd" % operation
 
-    return {
+    version_number = instance.get('_meta', {}).get('_version')
+    version = {
         #'_id': str(ObjectId()),
         #'_id': ObjectId(),
         'document_id': instance['_id'],
         'document_model': instance['_model'],
-        'document': instance,
+        'document_version': version_number,
         'comment': versional_comment,
         'operation': operation}
-
-
-def create_versions(instances, operation, versional_comment):
-    """Create a version dictionaries for a list of instances."""
-    return [create_version(instance, operation, versional_comment)
-            for instance in instances]
+    if snapshot_interval and operation == 'update' and \
+            previous is not None and \
+            not is_snapshot(version_number, snapshot_interval):
+        version['delta'] = make_delta(previous, instance)
+        version['base_version'] = previous.get('_meta', {}).get('_version')
+    else:
+        version['document'] = instance
+    return version
+
+
+def create_versions(instances, operation, versional_comment,
+                    previous=None, snapshot_interval=None):
+    """Create a version dictionaries for a list of instances.
+    versional_comment can also be a list, with a comment for each instance.
+    previous - the instances before the update, in the same order.
+    """
+    if not isinstance(versional_comment, list):
+        versional_comment = [versional_comment] * len(instances)
+    if previous is None:
+        previous = [None] * len(instances)
+    return [create_version(instance, operation, comment,
+                           old_instance, snapshot_interval)
+            for instance, comment, old_instance
+            in zip(instances, versional_comment, previous)]
@@ -0,0 +1,114 @@
+"""Store the history of an instance as changes rather than copies.
+
+With the history_storage setting at "delta", an update's history entry
+has a delta against the version before, instead of the whole document:
+
+    {'set': [[['title'], 'Emma'], [['author', 'name'], 'Jane Austen']],
+     'unset': [['subtitle']]}
+
+Each change has the path to the value as a list of keys, as the keys
+of a stored document cannot contain dots. Embedded documents are
+compared key by key, anything else (lists included) is replaced whole.
+
+The entry also has the base_version that the delta was made against.
+
+Every snapshot_interval versions (and when the version before is not
+known), the whole document is kept instead, so any version can be
+rebuilt from the nearest snapshot before it, as long as none of the
+versions in between are missing.
+"""
+
+from copy import deepcopy
+
+DEFAULT_SNAPSHOT_INTERVAL = 20
+
+
+def make_delta(old, new):
+    """Return the delta that turns the old document into the new one."""
+    delta = {'set': [], 'unset': []}
+    _compare(old, new, [], delta)
+    return delta
+
+
+def _compare(old, new, path, delta):
+    """Add the differences between two documents to the delta."""
+    for key, value in new.items():
+        if key not in old:
+            delta['set'].append([path + [key], value])
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            _compare(old[key], value, path + [key], delta)
+        elif value != old[key] or type(value) != type(old[key]):
+            delta['set'].append([path + [key], value])
+    for key in old:
+        if key not in new:
+            delta['unset'].append(path + [key])
+
+
+def apply_delta(document, delta):
+    """Return a copy of the document with the delta applied."""
+    document = deepcopy(document)
+    for path, value in delta.get('set', []):
+        target = document
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = deepcopy(value)
+    for path in delta.get('unset', []):
+        target = document
+        for key in path[:-1]:
+            target = target.get(key)
+            if not isinstance(target, dict):
+                break
+        else:
+            target.pop(path[-1], None)
+    return document
+
+
+def is_snapshot(version_number, snapshot_interval):
+    """Should the whole document be kept for this version number?
+    The first version always is, then every snapshot_interval."""
+    if not version_number or not snapshot_interval:
+        return True
+    return (version_number - 1) % snapshot_interval == 0
+
+
+def entry_version(entry):
+    """The version number of the instance in a history entry."""
+    if entry.get('document_version') is not None:
+        return entry['document_version']
+    return entry.get('document', {}).get('_meta', {}).get('_version')
+
+
+def rebuild_version(entries, version_number=None):
+    """Rebuild a version of an instance from its history.
+    entries - the history entries of the instance, oldest first.
+    version_number - the version wanted, or None for the newest.
+    Returns the document, or None if there is no such version,
+    or it cannot be rebuilt because a version before it is missing."""
+    if version_number is not None:
+        wanted = None
+        for position, entry in enumerate(entries):
+            if entry_version(entry) == version_number:
+                wanted = position
+        if wanted is None:
+            return None
+        entries = entries[:wanted + 1]
+    # Start from the nearest snapshot
+    start = None
+    for position in range(len(entries) - 1, -1, -1):
+        if 'document' in entries[position]:
+            start = position
+            break
+    if start is None:
+        return None
+    document = deepcopy(entries[start]['document'])
+    current = entry_version(entries[start])
+    for entry in entries[start + 1:]:
+        number = entry_version(entry)
+        # A delta is only right on top of the version it was made from
+        if current is not None and (
+                entry.get('base_version', current) != current or
+                (number is not None and number != current + 1)):
+            return None
+        document = apply_delta(document, entry['delta'])
+        current = number
+    return document
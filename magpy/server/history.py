@@ -0,0 +1,247 @@
+"""Writing versions to the _history.
+
+By default each request inserts its versions itself, before it answers.
+The HistoryWriter instead collects the versions from concurrent requests
+and inserts them together, in batches of up to batch_size, at most
+batch_delay seconds after the first one arrives.
+
+In write behind mode, the request is answered as soon as its versions
+are queued. In group mode, the request waits for its batch to be
+inserted, so nothing is answered before its history is written.
+
+A write behind batch that fails is tried again, without the versions
+that did get written, up to max_retries times. While the database is
+away, at most max_queued versions are kept waiting; batches beyond
+that are dropped (and logged) rather than filling the memory. If the
+history is stored as deltas, the next version of an instance that had
+a version dropped is kept whole, so the versions after it can still be
+rebuilt.
+
+Any version of an instance can be fetched from
+/api/_version/<resource>/<id>/<version number>, which rebuilds it if
+the history is stored as deltas (see deltas.py).
+"""
+
+from __future__ import print_function
+
+from copy import deepcopy
+from functools import partial
+from datetime import timedelta
+import tornado.web
+
+from magpy.server.database import DatabaseMixin, with_write_concern
+from magpy.server.auth import AuthenticationMixin, permission_required
+from magpy.server.serialization import dumps
+
+HISTORY_WRITERS = ('direct', 'group', 'write_behind')
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_DELAY = 0.05
+DEFAULT_MAX_RETRIES = 10
+DEFAULT_MAX_QUEUED = 100000
+
+
+class HistoryWriter(object):
+    """Insert versions into the _history in batches.
+    connection - the (Motor) client.
+    ioloop - the IOLoop to run the flushes on.
+    wait - if True, callbacks are run once the batch is inserted,
+           otherwise straight away.
+    write_concern - the write concern of the _history, if any.
+    max_retries - how many times to retry a failed write behind batch.
+    max_queued - the most versions to keep waiting for a retry."""
+    def __init__(self, connection, ioloop,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 batch_delay=DEFAULT_BATCH_DELAY,
+                 wait=False,
+                 write_concern=None,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 max_queued=DEFAULT_MAX_QUEUED):
+        self.connection = connection
+        self.max_retries = max_retries
+        self.max_queued = max_queued
+        self.ioloop = ioloop
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.wait = wait
+        self.write_concern = write_concern
+        self._queues = {}
+        self._timeout = None
+        self._writing = 0
+        self._in_flight = {}
+        self._when_written = []
+        self._dropped = set()
+
+    def add(self, database_name, versions, callback):
+        """Queue the versions to be inserted.
+        Calls callback(None, error) when they are written
+        (or straight away if we are not waiting)."""
+        if isinstance(versions, dict):
+            versions = [versions]
+        if not self.wait:
+            # The request carries on with its instances,
+            # so keep them as they are now.
+            versions = deepcopy(versions)
+        queue = self._queues.setdefault(database_name, [])
+        # Each item is (versions, callback, attempts so far)
+        queue.append((versions, callback if self.wait else None, 0))
+        if sum(len(item[0]) for item in queue) >= self.batch_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self.ioloop.add_timeout(
+                timedelta(seconds=self.batch_delay), self.flush)
+        if not self.wait:
+            return callback(None, None)
+
+    def pending(self, database_name, model_name):
+        """Are there versions of the model still to be written?"""
+        for item in self._queues.get(database_name, []):
+            for version in item[0]:
+                if version.get('document_model') == model_name:
+                    return True
+        return False
+
+    def take_dropped(self, database_name, model_name, document_id):
+        """Has a version of the instance been dropped?
+        Forgets the instance, as its next version is to be kept whole."""
+        key = (database_name, model_name, document_id)
+        if key in self._dropped:
+            self._dropped.discard(key)
+            return True
+        return False
+
+    def oldest_unwritten(self, database_name):
+        """The smallest history id that is queued or being written,
+        or None if everything given to us has been written."""
+        queues = list(self._queues.get(database_name, []))
+        for queue in self._in_flight.get(database_name, {}).values():
+            queues.extend(queue)
+        ids = [version['_id'] for item in queues for version in item[0]
+               if '_id' in version]
+        return min(ids) if ids else None
+
+    def flush(self, callback=None):
+        """Insert everything queued now.
+        callback - called once all the inserts have finished."""
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        if callback is not None:
+            self._when_written.append(callback)
+        queues = self._queues
+        self._queues = {}
+        for database_name, queue in queues.items():
+            versions = [version for item in queue for version in item[0]]
+            callbacks = [item[1] for item in queue if item[1] is not None]
+            collection = with_write_concern(
+                self.connection[database_name]['_history'],
+                self.write_concern)
+            self._writing += 1
+            self._in_flight.setdefault(database_name, {})[id(queue)] = queue
+            # Carry on past any that fail, e.g. those already written
+            # by an earlier attempt, which are duplicates now
+            collection.insert(versions,
+                              continue_on_error=True,
+                              callback=partial(self._inserted,
+                                               database_name=database_name,
+                                               queue=queue,
+                                               callbacks=callbacks))
+        self._check_written()
+
+    def _inserted(self, response, error, database_name, queue, callbacks):
+        """Tell the requests that their history is written."""
+        # pylint: disable-msg=W0613
+        for callback in callbacks:
+            callback(None, error)
+        if error and not self.wait:
+            # Nobody is waiting to hear, so try again,
+            # once we know which versions did get written
+            print("Warning: could not write history, will retry: %s" % (
+                error,))
+            ids = [version['_id'] for item in queue for version in item[0]
+                   if '_id' in version]
+            collection = self.connection[database_name]['_history']
+            return collection.find({'_id': {'$in': ids}},
+                                   fields=['_id']).to_list(
+                                       length=len(ids),
+                                       callback=partial(
+                                           self._requeue,
+                                           database_name=database_name,
+                                           queue=queue))
+        self._done(database_name, queue)
+
+    def _requeue(self, written, error, database_name, queue):
+        """Put the versions that were not written back in the queue,
+        unless they have been tried too often or too much is waiting."""
+        # If we cannot tell, the written ones will fail as duplicates
+        # next time, and be found then.
+        written = set(document['_id'] for document in written or [])
+        waiting = self._queues.setdefault(database_name, [])
+        queued = sum(len(item[0]) for item in waiting)
+        retry = []
+        for versions, callback, attempts in queue:
+            versions = [version for version in versions
+                        if version.get('_id') not in written]
+            if not versions:
+                continue
+            if attempts >= self.max_retries:
+                print("Error: giving up on %s history versions after "
+                      "%s attempts" % (len(versions), attempts + 1))
+            elif queued + len(versions) > self.max_queued:
+                print("Error: dropping %s history versions, %s are "
+                      "already waiting" % (len(versions), queued))
+            else:
+                queued += len(versions)
+                retry.append((versions, None, attempts + 1))
+                continue
+            self._dropped.update(
+                (database_name, version.get('document_model'),
+                 version.get('document_id')) for version in versions)
+        waiting[:0] = retry
+        if not waiting:
+            del self._queues[database_name]
+        elif self._timeout is None:
+            self._timeout = self.ioloop.add_timeout(
+                timedelta(seconds=self.batch_delay), self.flush)
+        self._done(database_name, queue)
+
+    def _done(self, database_name, queue):
+        """The insert of the queue has finished."""
+        in_flight = self._in_flight.get(database_name, {})
+        in_flight.pop(id(queue), None)
+        if not in_flight:
+            self._in_flight.pop(database_name, None)
+        self._writing -= 1
+        self._check_written()
+
+    def _check_written(self):
+        """Run the flush callbacks once nothing is being written."""
+        if self._writing or self._queues or not self._when_written:
+            return
+        when_written = self._when_written
+        self._when_written = []
+        for callback in when_written:
+            callback()
+
+
+class VersionHandler(tornado.web.RequestHandler,
+                     DatabaseMixin,
+                     AuthenticationMixin):
+    """Get a version of an instance from the history."""
+    # pylint: disable=W0221,R0904
+
+    @tornado.web.asynchronous
+    @permission_required('read')
+    def get(self, resource, objectid, version_number):
+        """Rebuild the version and return it."""
+        self.get_version(resource, objectid, int(version_number),
+                         self._return_version)
+
+    def _return_version(self, document, error):
+        """Return the version."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        if document is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(dumps(document))
+        self.finish()
@@ -0,0 +1,131 @@
+"""Create the indexes that the models ask for.
+
+A field is indexed when its definition has index set, e.g.:
+
+    'title': {'field': 'Char', 'index': True}
+
+index can be True (or 1) for ascending, or -1 for descending, and
+'unique': True makes a unique index. Compound indexes go in the
+model's _indexes list:
+
+    '_indexes': [{'fields': [['author', 1], ['year', -1]],
+                  'unique': True}]
+
+The indexes made here are named with a magpy_ prefix, so that we can
+tell which ones to drop when a model no longer asks for them.
+"""
+
+from __future__ import print_function
+
+import six
+from pymongo.errors import OperationFailure
+
+INDEX_PREFIX = 'magpy_'
+
+# The history is read by document and by model, newest first.
+HISTORY_INDEXES = (
+    {'fields': [('document_model', 1), ('_id', 1)]},
+    {'fields': [('document_id', 1)]},
+    )
+
+
+def index_name(fields, prefix=INDEX_PREFIX):
+    """The name of our index on the fields."""
+    return prefix + '_'.join(
+        '%s_%s' % (field, direction) for field, direction in fields)
+
+
+def model_indexes(model):
+    """Return the indexes the model asks for,
+    as a list of {'fields': [(field, direction), ...], 'unique': bool}."""
+    indexes = []
+    for field, definition in six.iteritems(model):
+        if field == '_id' or field.startswith('_') or \
+                not isinstance(definition, dict):
+            continue
+        direction = definition.get('index')
+        unique = bool(definition.get('unique', False))
+        if direction is None or direction is False:
+            if not unique:
+                continue
+            direction = 1
+        if direction is True:
+            direction = 1
+        indexes.append({'fields': [(field, direction)],
+                        'unique': unique})
+
+    for index in model.get('_indexes', []):
+        indexes.append({'fields': [tuple(pair) for pair in index['fields']],
+                        'unique': bool(index.get('unique', False))})
+    return indexes
+
+
+def sync_indexes(collection, wanted, drop=True):
+    """Make the collection's indexes match the wanted ones.
+    collection - a pymongo collection
+    wanted - a list of index definitions, see model_indexes.
+    drop - also drop our indexes that are no longer wanted.
+    Returns a list of (action, index name) for what was done.
+    An index that cannot be made (e.g. a unique index over duplicates,
+    or one clashing with an index of another name) is reported as a
+    conflict, and the others are still made."""
+    report = []
+    existing = collection.index_information()
+    existing_keys = dict(
+        (tuple(tuple(pair) for pair in info['key']),
+         (name, bool(info.get('unique', False))))
+        for name, info in six.iteritems(existing))
+    wanted_names = set()
+
+    for index in wanted:
+        fields = [tuple(pair) for pair in index['fields']]
+        unique = bool(index.get('unique', False))
+        name = index_name(fields)
+        wanted_names.add(name)
+        present = existing_keys.get(tuple(fields))
+        if present is not None:
+            present_name, present_unique = present
+            if present_unique == unique:
+                wanted_names.add(present_name)
+                continue
+            if not present_name.startswith(INDEX_PREFIX):
+                report.append(('conflict', present_name))
+                continue
+            # Ours, but the uniqueness has changed
+            collection.drop_index(present_name)
+            report.append(('dropped', present_name))
+        try:
+            collection.create_index(fields,
+                                    name=name,
+                                    unique=unique,
+                                    background=True)
+        except OperationFailure as err:
+            print("Warning: could not create index %s: %s" % (name, err))
+            report.append(('conflict', name))
+            continue
+        report.append(('created', name))
+
+    if drop:
+        for name in existing:
+            if name.startswith(INDEX_PREFIX) and name not in wanted_names:
+                collection.drop_index(name)
+                report.append(('dropped', name))
+    return report
+
+
+def ensure_indexes(database, models, drop=True, verbose=True):
+    """Create the indexes for the models, and for the history.
+    database - a pymongo database.
+    Returns a dictionary of reports by collection name."""
+    reports = {}
+    for model in models:
+        reports[model['_id']] = sync_indexes(
+            database[model['_id']], model_indexes(model), drop)
+    reports['_history'] = sync_indexes(
+        database['_history'], HISTORY_INDEXES, drop)
+
+    if verbose:
+        for collection_name in sorted(reports):
+            for action, name in reports[collection_name]:
+                print("Index %s: %s.%s" % (action, collection_name, name))
+    return reports
@@ -0,0 +1,494 @@
+"""Media files of instances.
+
+Instances with file fields store a /media/ URL in the field, and the
+file itself is kept under the media root. Reading, writing and deleting
+the files is done on a thread pool, so that a large upload or a bulk
+delete does not hold up the other requests.
+
+Files can be sent as base64 data URIs in the _file_data of an instance,
+or (better for large files) as the body of a PUT to
+/api/<resource>/<id>/_file/<field>, which is written to disk as it
+arrives. The files are served back at their /media/ URLs to users who
+can read the resource.
+"""
+
+import os
+import re
+import uuid
+import base64
+import hashlib
+from copy import deepcopy
+from datetime import datetime
+from functools import partial
+import tornado.web
+import tornado.ioloop
+from tornado import stack_context
+from tornado.concurrent import Future
+from magpy.server.auth import AuthenticationMixin, WhoAmIMixin, \
+    permission_required
+from magpy.server.database import DatabaseMixin
+from magpy.server.conditional import instance_etag
+from magpy.server.serialization import dumps
+
+MEDIA_URL = '/media/'
+DEFAULT_MEDIA_ROOT = '/srv/itsee/mediamanager/restricted/'
+DEFAULT_MEDIA_THREADS = 4
+DEFAULT_UPLOAD_MAX_BYTES = 1024 * 1024 * 1024
+
+EXTENSION_RE = re.compile(r"^[a-zA-Z0-9.+-]+$")
+
+DATA_URI_RE = re.compile("data:.*?/(.*?);base64")
+
+
+def parse_data_uri(data):
+    """Split a base64 data URI into the file extension and the
+    (still encoded) content."""
+    meta, content = data.split(',', 1)
+    ext_m = DATA_URI_RE.match(meta)
+    if not ext_m or not EXTENSION_RE.match(ext_m.group(1)):
+        raise ValueError("Can't parse base64 file data ({})".format(meta))
+    return ext_m.group(1), content
+
+
+def media_url(instance, label, extension):
+    """The URL of the file in the field label of the instance."""
+    return '%s%s/%s_%s.%s' % (MEDIA_URL, instance['_model'],
+                              instance['_id'], label, extension)
+
+
+def content_type_extension(content_type):
+    """The file extension for a Content-Type, e.g. png for image/png,
+    in the same way as for data URIs."""
+    if content_type:
+        subtype = content_type.split(';', 1)[0].strip().split('/', 1)[-1]
+        if EXTENSION_RE.match(subtype):
+            return subtype
+    return 'bin'
+
+
+def media_path(media_root, url):
+    """The file path of a media URL.
+    Raises ValueError if it is not a media URL under the media root."""
+    if not url.startswith(MEDIA_URL):
+        raise ValueError("Not a media URL (%s)" % url)
+    root = os.path.normpath(media_root)
+    path = os.path.normpath(os.path.join(root, url[len(MEDIA_URL):]))
+    if not path.startswith(root + os.sep):
+        raise ValueError("Not a media URL (%s)" % url)
+    return path
+
+
+def resource_media_path(media_root, resource, path):
+    """The path of a media file of a resource, relative to the media root,
+    as resource/<path>.
+    Raises ValueError if the path leaves the resource's directory
+    (e.g. with ..), once resolved, symbolic links and all."""
+    directory = os.path.realpath(os.path.join(media_root, resource))
+    full_path = os.path.realpath(os.path.join(directory, path))
+    if not full_path.startswith(directory + os.sep):
+        raise ValueError("Not a media file of %s (%s)" % (resource, path))
+    return '%s/%s' % (resource,
+                      full_path[len(directory) + 1:].replace(os.sep, '/'))
+
+
+def instance_media_path(media_root, resource, url):
+    """The file path of the media URL of an instance of the resource.
+    Raises ValueError if it is not a media URL in the resource's
+    directory, e.g. because the instance's _id has a / or .. in it."""
+    prefix = '%s%s/' % (MEDIA_URL, resource)
+    if not url.startswith(prefix):
+        raise ValueError("Not a media URL of %s (%s)" % (resource, url))
+    return os.path.join(media_root, resource_media_path(
+        media_root, resource, url[len(prefix):]))
+
+
+def write_files(media_root, instance, files):
+    """Write the base64 file data of an instance to the media files.
+    files - a dictionary of field name to data URI."""
+    for label, data in files.items():
+        content = parse_data_uri(data)[1]
+        path = instance_media_path(media_root, instance['_model'],
+                                   instance[label])
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as media_file:
+            media_file.write(base64.b64decode(content))
+
+
+def write_many_files(media_root, items):
+    """Write the files of several instances.
+    items - a list of (instance, files)
+    Returns a list of the errors, None where the files were written."""
+    errors = []
+    for instance, files in items:
+        try:
+            write_files(media_root, instance, files)
+        except (IOError, OSError, ValueError) as err:
+            errors.append(str(err))
+        else:
+            errors.append(None)
+    return errors
+
+
+def delete_files(media_root, resource, urls):
+    """Delete the media files of the resource at the URLs,
+    if they exist."""
+    for url in urls:
+        if not url:
+            continue
+        path = instance_media_path(media_root, resource, url)
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+def replace_files(media_root, instance, files, old_urls):
+    """Delete the old files of an instance, then write the new ones."""
+    delete_files(media_root, instance['_model'], old_urls)
+    write_files(media_root, instance, files)
+
+
+class MediaUpload(object):
+    """A file being uploaded. It is written to a temporary file next to
+    where it will go, and hashed as it arrives."""
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = '%s.upload-%s' % (path, uuid.uuid4().hex)
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.finished = False
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(self.temporary_path, 'wb')
+
+    def write(self, chunk):
+        """Add a chunk of the file."""
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        """The whole file has arrived, but leave it out of place for now.
+        Returns the SHA-256 of the content."""
+        self.file.close()
+        return self.hash.hexdigest()
+
+    def finish(self):
+        """Put the file in place. Returns the SHA-256 of the content."""
+        self.close()
+        os.rename(self.temporary_path, self.path)
+        self.finished = True
+        return self.hash.hexdigest()
+
+    def abort(self):
+        """Throw away what has been uploaded."""
+        self.file.close()
+        if os.path.exists(self.temporary_path):
+            os.unlink(self.temporary_path)
+
+
+class MediaMixin(object):
+    """Run media file operations on the application's thread pool."""
+
+    @property
+    def media_root(self):
+        """The directory that media files are kept in."""
+        return self.settings.get('media_root', DEFAULT_MEDIA_ROOT)
+
+    def run_media(self, function, callback, *args):
+        """Call function(*args) on the media thread pool,
+        then callback(result, error) back on the IOLoop.
+        Without a thread pool, the function is just called."""
+        executor = getattr(self.application, 'media_executor', None)
+        if executor is None:
+            try:
+                result = function(*args)
+            except (IOError, OSError, ValueError) as err:
+                return callback(None, err)
+            return callback(result, None)
+
+        ioloop = self.settings.get('io_loop') or \
+            tornado.ioloop.IOLoop.instance()
+        # Keep the request's context, so errors in the callback
+        # still reach the handler.
+        done = partial(self._media_done,
+                       callback=stack_context.wrap(callback))
+        future = executor.submit(function, *args)
+        future.add_done_callback(
+            lambda finished: ioloop.add_callback(partial(done, finished)))
+
+    @staticmethod
+    def _media_done(future, callback):
+        """Pass on the result of the media operation."""
+        error = future.exception()
+        if error is not None:
+            return callback(None, error)
+        return callback(future.result(), None)
+
+    def submit_media(self, function, *args):
+        """Call function(*args) on the media thread pool and return
+        the future, or just call it if there is no thread pool."""
+        executor = getattr(self.application, 'media_executor', None)
+        if executor is None:
+            function(*args)
+            return None
+        return executor.submit(function, *args)
+
+
+@tornado.web.stream_request_body
+class FileUploadHandler(tornado.web.RequestHandler,
+                        DatabaseMixin,
+                        AuthenticationMixin,
+                        WhoAmIMixin,
+                        MediaMixin):
+    """Upload the file of a file field. The request body is the file,
+    and its Content-Type gives the file extension.
+    The body is written to the media root as it arrives, rather than
+    being kept in memory."""
+    # pylint: disable=W0221,R0904
+    upload = None
+    instance = None
+    user = None
+    extension = None
+    prepared = None
+
+    def prepare(self):
+        """Check that the upload is allowed, and get ready for it,
+        before the body arrives."""
+        if self.request.method not in ('PUT', 'POST'):
+            return None
+        resource, objectid, field = self.path_args
+        max_bytes = self.settings.get('media_upload_max_bytes',
+                                      DEFAULT_UPLOAD_MAX_BYTES)
+        length = self.request.headers.get('Content-Length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid Content-Length")
+            if length > max_bytes:
+                raise tornado.web.HTTPError(413)
+        self.request.connection.set_max_body_size(max_bytes)
+
+        self.prepared = Future()
+        success = partial(self.get_model, resource,
+                          callback=partial(self._check_field,
+                                           resource=resource,
+                                           objectid=objectid,
+                                           field=field))
+        self.check_permission(resource, 'update', success,
+                              failure=partial(self._refuse, 401))
+        return self.prepared
+
+    def _refuse(self, status, message=None):
+        """Stop the upload before it starts."""
+        self.prepared.set_exception(tornado.web.HTTPError(status, message))
+
+    def _check_field(self, model, error, resource, objectid, field):
+        """The field must be one of the model's file fields."""
+        # pylint: disable-msg=W0613
+        if not model:
+            return self._refuse(404)
+        if field not in model.get('_file_fields', {}).get('fields', []):
+            return self._refuse(400, "%s is not a file field" % field)
+        coll = self.get_collection(resource)
+        coll.find_one({'_id': objectid},
+                      callback=partial(self._got_instance, field=field))
+
+    def _got_instance(self, instance, error, field):
+        """Then find out who is uploading."""
+        if not instance:
+            return self._refuse(404)
+        self.instance = instance
+        success = partial(self._start_upload, field=field)
+        failure = partial(success,
+                          {"_id": "unknown", "name": "unknown"},
+                          None)
+        self.who_am_i(success, failure)
+
+    def _start_upload(self, user, error, field):
+        """Open the file to upload into."""
+        # pylint: disable-msg=W0613
+        self.user = user
+        self.extension = content_type_extension(
+            self.request.headers.get('Content-Type'))
+        try:
+            path = instance_media_path(
+                self.media_root, self.instance['_model'],
+                media_url(self.instance, field, self.extension))
+        except ValueError as err:
+            return self._refuse(400, str(err))
+        self.run_media(MediaUpload, self._upload_started, path)
+
+    def _upload_started(self, upload, error):
+        """Now the body can come."""
+        if error:
+            return self._refuse(500, str(error))
+        self.upload = upload
+        self.prepared.set_result(None)
+
+    def data_received(self, chunk):
+        """Write the chunk. The next one is not read until it is written."""
+        return self.submit_media(self.upload.write, chunk)
+
+    @tornado.web.asynchronous
+    def put(self, resource, objectid, field):
+        """The whole file has arrived."""
+        callback = partial(self._uploaded,
+                           resource=resource,
+                           field=field)
+        self.run_media(self.upload.close, callback)
+
+    post = put
+
+    def _uploaded(self, sha256, error, resource, field):
+        """Point the instance at its new file, leaving the rest alone."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        instance = self.instance
+        previous = deepcopy(instance)
+        old_url = instance.get(field)
+        old_meta = instance.get('_meta') or {
+            '_version': 1,
+            '_created_time': datetime(1970, 1, 1)}
+        instance[field] = media_url(instance, field, self.extension)
+        instance['_meta'] = {
+            '_created_time': old_meta['_created_time'],
+            '_last_modified_time': datetime.now(),
+            '_last_modified_by': self.user['_id'],
+            '_last_modified_by_display': self.user['name'],
+            '_version': old_meta['_version'] + 1}
+        details = {'_id': instance['_id'],
+                   '_model': resource,
+                   'field': field,
+                   'url': instance[field],
+                   'size': self.upload.size,
+                   'sha256': sha256}
+        # Only change the instance if nobody else has since
+        if '_meta' in previous:
+            spec = {'_id': instance['_id'],
+                    '_meta._version': old_meta['_version']}
+        else:
+            spec = {'_id': instance['_id'], '_meta': {'$exists': False}}
+        callback = partial(self._instance_updated,
+                           details=details,
+                           old_url=old_url,
+                           previous=previous)
+        coll = self.get_collection(resource)
+        coll.update(spec,
+                    {'$set': {field: instance[field],
+                              '_meta': instance['_meta']}},
+                    callback=callback)
+
+    def _instance_updated(self, response, error, details, old_url, previous):
+        """Then put the file in place. Until now it has been kept at
+        its temporary path, so the old file is still there if the
+        instance changed while the file was uploading."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        if not (response or {}).get('n'):
+            # on_finish throws away the upload
+            raise tornado.web.HTTPError(
+                409, "The instance has changed, upload again")
+        callback = partial(self._file_placed,
+                           details=details,
+                           old_url=old_url,
+                           previous=previous)
+        self.run_media(self.upload.finish, callback)
+
+    def _file_placed(self, sha256, error, details, old_url, previous):
+        """Add the new version to the history."""
+        # pylint: disable-msg=W0613
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        callback = partial(self._history_written,
+                           details=details,
+                           old_url=old_url)
+        self.update_history(self.instance, 'update', callback,
+                            'File uploaded', previous)
+
+    def _history_written(self, response, error, details, old_url):
+        """Remove the old file if it had another name, and return
+        the details of the new one."""
+        # pylint: disable-msg=W0613
+        self.notify_change(details['_model'], [details['_id']])
+        if old_url and old_url != details['url']:
+            self.submit_media(delete_files, self.media_root,
+                              details['_model'], [old_url])
+        self.set_header("Etag", instance_etag(self.instance))
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(dumps(details))
+        self.finish()
+
+    def on_finish(self):
+        """Clean up after an upload that did not complete."""
+        if self.upload is not None and not self.upload.finished:
+            self.submit_media(self.upload.abort)
+
+    on_connection_close = on_finish
+
+
+class MediaHandler(tornado.web.StaticFileHandler,
+                   DatabaseMixin,
+                   AuthenticationMixin):
+    """Serve the media files of a resource to users who can read it.
+    Files are sent in chunks, with Range requests, and with an ETag and
+    Last-Modified for conditional requests.
+    If media_accel_redirect is set, the file is left to the front end
+    server (e.g. Nginx) to send, using an X-Accel-Redirect header."""
+    # pylint: disable=W0221,R0904
+
+    def initialize(self, path=None, default_filename=None):
+        """The files are under the media root."""
+        if path is None:
+            path = self.settings.get('media_root', DEFAULT_MEDIA_ROOT)
+        super(MediaHandler, self).initialize(path, default_filename)
+
+    @tornado.web.asynchronous
+    @permission_required('read')
+    def get(self, resource, path, include_body=True):
+        """Send the file."""
+        # The permission is for the resource, so the file must be its own
+        try:
+            path = resource_media_path(self.root, resource, path)
+        except ValueError:
+            raise tornado.web.HTTPError(404)
+        redirect = self.settings.get('media_accel_redirect')
+        if redirect:
+            self.set_header('X-Accel-Redirect', redirect + path)
+            return self.finish()
+        future = super(MediaHandler, self).get(path, include_body)
+        if future is None:
+            return self._served(None)
+        ioloop = self.settings.get('io_loop') or \
+            tornado.ioloop.IOLoop.instance()
+        ioloop.add_future(future, self._served)
+
+    @tornado.web.asynchronous
+    def head(self, resource, path):
+        """Send the headers of the file."""
+        return self.get(resource, path, include_body=False)
+
+    def _served(self, future):
+        """Finish once the file is sent."""
+        if future is not None:
+            # Raise any error to the request
+            future.result()
+        if not self._finished:
+            self.finish()
+
+    def compute_etag(self):
+        """A strong ETag from the size and modification time,
+        rather than reading the whole file to hash it."""
+        if self.absolute_path is None:
+            return None
+        stat = os.stat(self.absolute_path)
+        return '"%x-%x"' % (stat.st_size, int(stat.st_mtime * 1000000))
+
+    def set_extra_headers(self, path):
+        """The files are only for users who can read them,
+        so only the browser can cache them, and it must check
+        they have not changed. They are sent as they are, not compressed,
+        so that Range requests and the ETag refer to the file's bytes."""
+        self.set_header('Cache-Control', 'private, no-cache, no-transform')
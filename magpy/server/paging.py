@@ -0,0 +1,130 @@
+"""Keyset pagination of resource lists.
+
+Rather than skipping over the previous pages, which makes MongoDB walk
+every skipped document, the list API hands back an opaque _after token
+made from the sort values of the last document in the page. Giving the
+token back asks for the documents that sort after that one.
+
+The sort always ends with _id, so that every document has a unique
+place in the order.
+
+MongoDB sorts null (and missing) values before all others, but they
+do not match $gt or $lt, so they are asked for separately.
+"""
+
+import base64
+import six
+from magpy.server.serialization import dumps, loads
+
+
+def paging_sort(sort=None):
+    """Return the sort as a list of (key, direction), ending with _id."""
+    if not sort:
+        sort = []
+    elif isinstance(sort, six.string_types):
+        sort = [(sort, 1)]
+    sort = [(key, direction) for key, direction in sort]
+    if '_id' not in [key for key, direction in sort]:
+        sort.append(('_id', 1))
+    return sort
+
+
+def get_sort_value(document, key):
+    """Get the (possibly dotted) key from the document."""
+    value = document
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def make_after_token(document, sort):
+    """Make the token for the documents after this one.
+    The token keeps the sort, as well as the values."""
+    values = [get_sort_value(document, key) for key, direction in sort]
+    keys = [[key, direction] for key, direction in sort]
+    token = base64.urlsafe_b64encode(
+        dumps({'sort': keys, 'values': values}).encode('utf-8'))
+    return token.decode('ascii')
+
+
+def parse_after_token(token, sort):
+    """Get the sort values back out of a token.
+    Raises ValueError if the token is not one of ours,
+    or was made with a different sort."""
+    if isinstance(token, six.binary_type):
+        token = token.decode('ascii')
+    try:
+        content = loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid _after token.')
+    if not isinstance(content, dict) or not \
+            isinstance(content.get('values'), list):
+        raise ValueError('Invalid _after token.')
+    if content.get('sort') != [[key, direction] for key, direction in sort]:
+        raise ValueError('The _after token was made with another sort.')
+    return content['values']
+
+
+def value_after(key, direction, value):
+    """The query for values of the key that sort after the value,
+    or None if nothing does."""
+    if key == '_id':
+        # Never null
+        return {key: {'$lt' if direction < 0 else '$gt': value}}
+    if value is None:
+        if direction < 0:
+            # Nulls come last
+            return None
+        return {key: {'$ne': None}}
+    if direction < 0:
+        return {'$or': [{key: {'$lt': value}}, {key: None}]}
+    return {key: {'$gt': value}}
+
+
+def after_spec(sort, values):
+    """The query for documents that sort after the values.
+    E.g. for a sort of [('name', 1), ('_id', 1)]:
+    {'$or': [{'name': {'$gt': name}},
+             {'name': name, '_id': {'$gt': _id}}]}
+    A None value matches null and missing values.
+    """
+    clauses = []
+    for position, (key, direction) in enumerate(sort):
+        after = value_after(key, direction, values[position])
+        if after is None:
+            continue
+        clause = dict((previous_key, value) for (previous_key, _), value
+                      in zip(sort[:position], values[:position]))
+        clause.update(after)
+        clauses.append(clause)
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
+
+
+def add_after_to_spec(spec, sort, values):
+    """Restrict the spec to the documents after the values."""
+    condition = after_spec(sort, values)
+    if not spec:
+        return condition
+    return {'$and': [spec, condition]}
+
+
+def include_sort_fields(fields, sort):
+    """Make sure the fields returned include the sort keys,
+    as the token is made from them."""
+    if fields is None:
+        return None
+    keys = [key for key, direction in sort]
+    if isinstance(fields, dict):
+        if any(fields.values()):
+            fields = dict(fields)
+            for key in keys:
+                fields[key] = 1
+            return fields
+        fields = dict((key, value) for key, value in six.iteritems(fields)
+                      if key not in keys)
+        return fields or None
+    return list(fields) + [key for key in keys if key not in fields]
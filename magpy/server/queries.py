@@ -0,0 +1,244 @@
+"""Record the shapes of the list queries that clients make.
+
+A query's shape is its spec with the values taken out, e.g.
+{'author': 'austen', 'year': {'$gt': 1800}} has the shape
+{'author': 1, 'year': {'$gt': 1}}. Each server process counts how often
+each shape (with its sort and fields) is used and how long it takes,
+and every so often adds its counts to the _query_stats collection.
+mag.py index_advice uses them to suggest indexes.
+
+Only the shapes are kept, never the values, which may be private.
+"""
+
+from __future__ import print_function
+import time
+import json
+import hashlib
+from functools import partial
+import six
+from magpy.server.serialization import dumps
+
+QUERY_STATS_COLLECTION = '_query_stats'
+
+LOGICAL_OPERATORS = frozenset(('$and', '$or', '$nor'))
+SUBQUERY_OPERATORS = frozenset(('$elemMatch', '$not'))
+EQUALITY_OPERATORS = frozenset(('$eq', '$in', '$all'))
+# Placeholders for operators that do not take any value
+PLACEHOLDERS = {'$in': [None], '$nin': [None], '$all': [None],
+                '$exists': True, '$regex': '', '$options': '',
+                '$size': 0, '$mod': [1, 0], '$type': 10}
+
+
+def query_shape(spec):
+    """Return the spec with the values replaced by 1."""
+    if not isinstance(spec, dict):
+        return 1
+    shape = {}
+    for key in sorted(spec):
+        value = spec[key]
+        if key in LOGICAL_OPERATORS and isinstance(value, list):
+            shape[key] = [query_shape(clause) for clause in value]
+        elif key in SUBQUERY_OPERATORS:
+            shape[key] = query_shape(value)
+        elif isinstance(value, dict) and \
+                any(name.startswith('$') for name in value):
+            shape[key] = query_shape(value)
+        else:
+            shape[key] = 1
+    return shape
+
+
+def placeholder_spec(shape):
+    """Turn a shape back into a query that can be explained,
+    with placeholders where the values were."""
+    if not isinstance(shape, dict):
+        return None
+    spec = {}
+    for key, value in shape.items():
+        if key in LOGICAL_OPERATORS and isinstance(value, list):
+            spec[key] = [placeholder_spec(clause) for clause in value]
+        elif isinstance(value, dict):
+            spec[key] = placeholder_spec(value)
+        else:
+            spec[key] = PLACEHOLDERS.get(key)
+    return spec
+
+
+def sort_shape(sort):
+    """Return the sort as a list of [field, direction]."""
+    if not sort:
+        return []
+    if isinstance(sort, six.string_types):
+        return [[sort, 1]]
+    return [[field, direction] for field, direction in sort]
+
+
+def fields_shape(fields):
+    """Return the names of the fields asked for."""
+    if not fields:
+        return []
+    return sorted(fields)
+
+
+def shape_id(resource, shape, sort, fields):
+    """A stable id for the shape, to store it by."""
+    return hashlib.sha1(dumps(
+        [resource, shape, sort, fields]).encode('utf-8')).hexdigest()
+
+
+def load_shape(stored):
+    """The shape stored in _query_stats. Shapes are stored as JSON,
+    as their keys (e.g. $gt or _meta._version) are not allowed as
+    field names of a document."""
+    if isinstance(stored, six.string_types):
+        return json.loads(stored)
+    # Stored by older versions
+    return stored
+
+
+class QueryRecorder(object):
+    """Counts the query shapes used in this process,
+    until they are flushed to the database.
+    At most max_shapes different shapes are kept between flushes."""
+    def __init__(self, max_shapes=1000):
+        self.max_shapes = max_shapes
+        self._shapes = {}
+
+    def record(self, database_name, resource, spec, sort, fields,
+               duration):
+        """Record one run of a query, duration is in seconds."""
+        shape = query_shape(spec or {})
+        sort = sort_shape(sort)
+        fields = fields_shape(fields)
+        key = (database_name, shape_id(resource, shape, sort, fields))
+        entry = self._shapes.get(key)
+        if entry is None:
+            if len(self._shapes) >= self.max_shapes:
+                return
+            entry = self._shapes[key] = {
+                'resource': resource,
+                'shape': shape,
+                'sort': sort,
+                'fields': fields,
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0}
+        milliseconds = duration * 1000.0
+        entry['count'] += 1
+        entry['total_ms'] += milliseconds
+        entry['max_ms'] = max(entry['max_ms'], milliseconds)
+
+    def drain(self):
+        """Return the recorded shapes by (database name, id),
+        and start again."""
+        shapes = self._shapes
+        self._shapes = {}
+        return shapes
+
+    def flush(self, connection):
+        """Add the recorded counts to the _query_stats collections.
+        connection - the (Motor) client."""
+        for (database_name, identifier), entry in \
+                self.drain().items():
+            collection = connection[database_name][QUERY_STATS_COLLECTION]
+            collection.update(
+                {'_id': identifier},
+                {'$inc': {'count': entry['count'],
+                          'total_ms': entry['total_ms']},
+                 '$max': {'last_max_ms': entry['max_ms']},
+                 '$set': {'resource': entry['resource'],
+                          'shape': dumps(entry['shape']),
+                          'sort': entry['sort'],
+                          'fields': entry['fields'],
+                          'last_seen': time.time()},
+                 # Recorded by older versions
+                 '$unset': {'example': ''}},
+                upsert=True,
+                callback=partial(self._flushed, identifier=identifier))
+
+    @staticmethod
+    def _flushed(response, error, identifier):
+        """Nobody is waiting, so just say if the counts were lost."""
+        # pylint: disable-msg=W0613
+        if error:
+            print("Warning: could not record query shape %s: %s" % (
+                identifier, error))
+
+
+def split_shape(shape):
+    """Split the fields of a shape into equality and range fields.
+    Returns None if the shape has logical operators at the top level,
+    which a single index cannot be suggested for."""
+    equality = []
+    ranges = []
+    for field, value in shape.items():
+        if field.startswith('$'):
+            return None
+        if value == 1 or (isinstance(value, dict) and
+                          set(value) <= EQUALITY_OPERATORS):
+            equality.append(field)
+        else:
+            ranges.append(field)
+    return equality, ranges
+
+
+def suggest_index(shape, sort):
+    """Suggest an index for the query shape and sort, as a list of
+    (field, direction): the equality fields, then the sort, then the
+    range fields. Returns None if there is nothing to suggest."""
+    fields = split_shape(shape)
+    if fields is None:
+        return None
+    equality, ranges = fields
+    index = [(field, 1) for field in equality]
+    for field, direction in sort:
+        if field not in equality:
+            index.append((field, direction))
+    for field in ranges:
+        if field not in [name for name, direction in index]:
+            index.append((field, 1))
+    if not index or index == [('_id', 1)]:
+        return None
+    return index
+
+
+def explain_summary(explain):
+    """Summarise explain output, from old or new versions of MongoDB.
+    Returns a dictionary with:
+    index - the name of the index used, or None for a collection scan
+    examined - the number of documents or keys looked at
+    returned - the number of documents matched
+    in_memory_sort - True if the results were sorted without an index."""
+    if 'queryPlanner' in explain:
+        stages = []
+        plan = explain['queryPlanner'].get('winningPlan', {})
+        while plan:
+            stages.append(plan)
+            plan = plan.get('inputStage')
+        index = None
+        for stage in stages:
+            if stage.get('stage') == 'IXSCAN':
+                index = stage.get('indexName')
+        stats = explain.get('executionStats', {})
+        return {'index': index,
+                'examined': max(stats.get('totalDocsExamined', 0),
+                                stats.get('totalKeysExamined', 0)),
+                'returned': stats.get('nReturned', 0),
+                'in_memory_sort': any(stage.get('stage') == 'SORT'
+                                      for stage in stages)}
+    cursor = explain.get('cursor', '')
+    index = None
+    if cursor.startswith('BtreeCursor'):
+        index = cursor.split(' ', 1)[1]
+    return {'index': index,
+            'examined': explain.get('nscannedObjects',
+                                    explain.get('nscanned', 0)),
+            'returned': explain.get('n', 0),
+            'in_memory_sort': bool(explain.get('scanAndOrder', False))}
+
+
+def needs_index(summary):
+    """Does the explained query look like it needs a (better) index?"""
+    if summary['index'] is None or summary['in_memory_sort']:
+        return True
+    return summary['examined'] > 10 * max(summary['returned'], 1)
@@ -0,0 +1,88 @@
+"""Converting to and from JSON, for the API.
+
+All the handlers use dumps() and loads() from here, rather than
+json with the bson.json_util hooks. The BSON types that Magpy
+stores are converted directly, in the format that mag.js expects:
+
+ObjectId - {"$oid": "<hex>"}
+datetime - {"$date": <milliseconds since the epoch>}
+Decimal - a number
+
+Anything else is left to bson.json_util.
+If orjson is installed, it is used to make the JSON, it is much faster.
+"""
+
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # pylint: disable=C0103
+
+EPOCH_AWARE = datetime.fromtimestamp(0, utc)
+EPOCH_NAIVE = datetime.utcfromtimestamp(0)
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+    ORJSON_ERRORS = (TypeError, orjson.JSONEncodeError)
+
+
+def datetime_to_millis(value):
+    """Milliseconds since the epoch, naive datetimes are taken as UTC."""
+    if value.utcoffset() is None:
+        delta = value - EPOCH_NAIVE
+    else:
+        delta = value - EPOCH_AWARE
+    return (delta.days * 86400 + delta.seconds) * 1000 + \
+        delta.microseconds // 1000
+
+
+def default(value):
+    """Convert a value that JSON does not know about."""
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return {"$date": datetime_to_millis(value)}
+    if isinstance(value, Decimal):
+        return float(value)
+    return json_util.default(value)
+
+
+def object_hook(dct):
+    """Convert a decoded JSON object back to the BSON type it stands for."""
+    if '$oid' in dct:
+        return ObjectId(str(dct['$oid']))
+    if '$date' in dct and isinstance(dct['$date'], six.integer_types):
+        return EPOCH_AWARE + timedelta(milliseconds=dct['$date'])
+    for key in dct:
+        if key.startswith('$'):
+            return json_util.object_hook(dct)
+        # Only the first key matters
+        break
+    return dct
+
+
+def dumps(obj):
+    """Serialise obj to a JSON string."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj,
+                                default=default,
+                                option=ORJSON_OPTIONS).decode('utf-8')
+        except ORJSON_ERRORS:
+            # E.g. integers too big for 64 bits, let json have a go
+            pass
+    return json.dumps(obj, default=default)
+
+
+def loads(text):
+    """Deserialise a JSON string or bytes."""
+    if isinstance(text, six.binary_type):
+        text = text.decode('utf-8')
+    return json.loads(text, object_hook=object_hook)
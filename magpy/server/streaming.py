@@ -0,0 +1,87 @@
+"""Stream long lists of documents out as a JSON response."""
+
+from magpy.server.serialization import dumps
+
+# Flush once this many bytes or documents are waiting.
+STREAM_FLUSH_BYTES = 65536
+STREAM_FLUSH_COUNT = 1000
+
+
+class ListStreamWriter(object):
+    """Writes documents out inside the list response envelope:
+
+    {"count":10, "results":[{...}, {...}]}
+
+    Serialised documents are buffered, encoded as UTF-8, until
+    flush_bytes or flush_count is reached, and then written and flushed
+    to the socket together, rather than flushing each document on its own.
+    """
+    def __init__(self, handler,
+                 flush_bytes=STREAM_FLUSH_BYTES,
+                 flush_count=STREAM_FLUSH_COUNT):
+        self.handler = handler
+        self.flush_bytes = flush_bytes
+        self.flush_count = flush_count
+        self.written = 0
+        self.last = None
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_count = 0
+
+    @classmethod
+    def for_handler(cls, handler):
+        """Make a writer using the handler's application settings."""
+        return cls(handler,
+                   handler.settings.get('stream_flush_bytes',
+                                        STREAM_FLUSH_BYTES),
+                   handler.settings.get('stream_flush_count',
+                                        STREAM_FLUSH_COUNT))
+
+    def start(self, count=None):
+        """Open the envelope, with the count if we have one."""
+        self.handler.set_header("Content-Type",
+                                "application/json; charset=UTF-8")
+        output_wrapper = '{'
+        if count is not None:
+            output_wrapper += '"count":%s, ' % count
+        output_wrapper += '"results":['
+        self._buffer.append(output_wrapper.encode('utf-8'))
+
+    def add(self, document):
+        """Add a document to the results."""
+        chunk = dumps(document)
+        if self.written:
+            chunk = ',' + chunk
+        chunk = chunk.encode('utf-8')
+        self._buffer.append(chunk)
+        self._buffered_bytes += len(chunk)
+        self._buffered_count += 1
+        self.written += 1
+        self.last = document
+        if self._buffered_bytes >= self.flush_bytes or \
+                self._buffered_count >= self.flush_count:
+            self.flush()
+
+    def flush(self):
+        """Send whatever is buffered."""
+        if not self._buffer:
+            return
+        self.handler.write(b''.join(self._buffer))
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_count = 0
+        self.handler.flush()
+
+    def finish(self, **extra):
+        """Close the results list and the envelope, and finish.
+        Any keyword arguments are added to the envelope after the results.
+        """
+        tail = ']'
+        for key in sorted(extra):
+            tail += ', "%s":%s' % (
+                key, dumps(extra[key]))
+        tail += '}'
+        self._buffer.append(tail.encode('utf-8'))
+        self.handler.write(b''.join(self._buffer))
+        self._buffer = []
+        self.handler.finish()
@@ -1,101 +1,268 @@
 """Transactions support."""
 
-import json
 from functools import partial
+from collections import OrderedDict
 import tornado.web
 
-from bson import json_util
 from bson.objectid import ObjectId
-from pymongo import DESCENDING
+from bson.errors import InvalidId
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING
 
 from magpy.server.database import DatabaseMixin
-from magpy.server.auth import AuthenticationMixin
+from magpy.server.auth import AuthenticationMixin, permission_required
+from magpy.server.serialization import dumps
+from magpy.server.streaming import ListStreamWriter
+
+DEFAULT_SYNC_PAGE_SIZE = 1000
 
 #class TransactionMixin(object):
 #    """Mix into class to get transaction support."""
 #    pass
 
 
+class ChangeCoalescer(object):
+    """Collects the history entries of a page, keeping only the latest
+    change to each instance, in the order of their latest changes."""
+    def __init__(self):
+        self.changes = OrderedDict()
+        self.scanned = 0
+        self.last_id = None
+
+    def add(self, entry):
+        """Add a history entry, replacing any earlier change
+        to the same instance."""
+        self.scanned += 1
+        self.last_id = entry['_id']
+        change = {'_id': entry['_id'],
+                  'document_id': entry['document_id'],
+                  'document_model': entry['document_model'],
+                  'operation': entry['operation']}
+        if entry['operation'] != 'delete' and 'document' in entry:
+            change['document'] = entry['document']
+        key = (entry['document_model'], entry['document_id'])
+        self.changes.pop(key, None)
+        self.changes[key] = change
+
+    def _needs_document(self, change, model_name=None):
+        """Is the change an update stored as a delta?"""
+        return change['operation'] != 'delete' and \
+            'document' not in change and \
+            (model_name is None or change['document_model'] == model_name)
+
+    def missing(self):
+        """The ids of the instances whose latest change has no document,
+        i.e. updates stored as deltas, by model."""
+        missing = OrderedDict()
+        for change in self.changes.values():
+            if self._needs_document(change):
+                missing.setdefault(change['document_model'], []).append(
+                    change['document_id'])
+        return missing
+
+    def fill_in(self, instances, model_name):
+        """Give the changes of the model without a document the instance
+        as it is now. If it has gone since, it is deleted instead."""
+        current = dict((instance['_id'], instance)
+                       for instance in instances or [])
+        for change in self.changes.values():
+            if not self._needs_document(change, model_name):
+                continue
+            if change['document_id'] in current:
+                change['document'] = current[change['document_id']]
+            else:
+                change['operation'] = 'delete'
+
+    def __iter__(self):
+        return iter(self.changes.values())
+
+
+def fill_in_documents(database, coalescer, callback):
+    """Fill in the changes that need the current instances,
+    then call callback(error)."""
+    missing = coalescer.missing()
+    if not missing:
+        return callback(None)
+    progress = {'waiting': len(missing), 'error': None}
+    for model_name, ids in missing.items():
+        database[model_name].find({'_id': {'$in': ids}}).to_list(
+            length=len(ids),
+            callback=partial(_filled_in,
+                             coalescer=coalescer,
+                             model_name=model_name,
+                             progress=progress,
+                             callback=callback))
+
+
+def _filled_in(instances, error, coalescer, model_name, progress, callback):
+    """Fill in the instances of one model, callback when all are done."""
+    progress['waiting'] -= 1
+    if error:
+        progress['error'] = progress['error'] or error
+    else:
+        coalescer.fill_in(instances, model_name)
+    if not progress['waiting']:
+        return callback(progress['error'])
+
+
 class TransactionUpdateHandler(tornado.web.RequestHandler,
                                DatabaseMixin,
                                AuthenticationMixin):
-    """Given a model_name and an objectid, get all history newer than that."""
+    """Given a model_name and an objectid, get the changes to the
+    model's instances in the history newer than that.
+
+    The history is read a page (of up to sync_page_size entries, or _limit
+    if smaller) at a time, and the changes to each instance in the page
+    are coalesced into its latest state:
+
+    {"results":[{"_id": ..., "document_id": ..., "document_model": ...,
+                 "operation": ..., "document": {...}}, ...],
+     "after": "<history id>", "more": true}
+
+    Deletes have no document. The next page is fetched with the after
+    token in place of the objectid, while more is true."""
+    # pylint: disable=W0221,R0904
+    coalescer = None
+
     @tornado.web.asynchronous
-    def get(self, model_name, objectid):  # pylint: disable=W0221
-        print ("model name is", model_name)
-        print ("object id is", objectid)
+    @permission_required('read')
+    def get(self, model_name, objectid):
+        try:
+            after = ObjectId(objectid)
+        except (InvalidId, TypeError):
+            raise tornado.web.HTTPError(400, "Invalid history id")
+        page_size = self.settings.get('sync_page_size',
+                                      DEFAULT_SYNC_PAGE_SIZE)
+        try:
+            limit = int(self.get_argument('_limit', page_size))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid _limit")
+        limit = max(1, min(limit, page_size))
 
+        self.coalescer = ChangeCoalescer()
         history = self.get_collection('_history')
-        history.find({'document_model': model_name,
-                      '_id': {'$gt': ObjectId(objectid)}}).to_list(
-                          length=32767,
-                          callback=self._return_instance)
-
-    def _return_instance(self, instance, error=None):
-        """Return a single instance or anything else that can become JSON."""
-        print ("instance is", instance)
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(instance, default=json_util.default))
-        self.finish()
+        cursor = history.find(
+            {'document_model': model_name, '_id': {'$gt': after}},
+            fields={'delta': False, 'comment': False})
+        cursor.sort('_id', ASCENDING).limit(limit).each(
+            partial(self._add_entry,
+                    objectid=objectid,
+                    limit=limit))
+
+    def _add_entry(self, entry, error, objectid, limit):
+        """Add each entry to the page, then fill in the documents."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        if entry is not None:
+            self.coalescer.add(entry)
+            return
+        fill_in_documents(self.database, self.coalescer,
+                          partial(self._return_changes,
+                                  objectid=objectid,
+                                  limit=limit))
+
+    def _return_changes(self, error, objectid, limit):
+        """Stream the changes out, followed by the resume token."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        writer = ListStreamWriter.for_handler(self)
+        writer.start()
+        for change in self.coalescer:
+            writer.add(change)
+        last_id = self.coalescer.last_id
+        writer.finish(
+            after=str(last_id) if last_id is not None else objectid,
+            more=self.coalescer.scanned == limit)
 
 
 class TransactionSyncHandler(tornado.web.RequestHandler,
                              DatabaseMixin,
                              AuthenticationMixin):
     """Given app_name, gives a list of relevant models and the
-    current collection version numbers. """
+    current collection version numbers, i.e. the id of the newest
+    history entry of each model.
+
+    The state is kept in the sync state cache, so usually no query is
+    needed at all. Otherwise it is found with one aggregation over the
+    history, rather than a query per model."""
+    # pylint: disable=W0221,R0904
+
     @tornado.web.asynchronous
-    def get(self, app_name):  # pylint: disable=W0221
-        print ("1. me me")
+    def get(self, app_name):
         return self.find_relevant_models(app_name)
 
     def find_relevant_models(self, app_name):
         """Find the relevant models for the app."""
-        print ("2. me me")
+        cache = self.sync_state_cache
+        callback = self.find_all_last_instances
+        if cache is not None:
+            model_names = cache.get_models(self.database_name, app_name)
+            if model_names is not None:
+                return callback(model_names, None)
+            callback = partial(
+                self._store_models,
+                app_name=app_name,
+                generation=cache.generation(self.database_name))
         models = self.get_collection('_model')
         models.find({'_applications': app_name},
                     fields=['_id', ]).to_list(
-                        callback=self.find_all_last_instances)
+                        callback=partial(self._model_names,
+                                         callback=callback))
+
+    @staticmethod
+    def _model_names(models, error, callback):
+        """Pass on just the names of the models."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        return callback([model['_id'] for model in models], None)
 
-    def find_all_last_instances(self, models, error=None):
+    def _store_models(self, model_names, error, app_name, generation):
+        """Keep the models of the app for next time."""
+        self.sync_state_cache.store_models(self.database_name, app_name,
+                                           model_names, generation)
+        return self.find_all_last_instances(model_names, error)
+
+    def find_all_last_instances(self, model_names, error=None):
         """Find all the last instances of the models."""
-        print ("3. me me")
-        model_names = [model['_id'] for model in models]
-        return self.find_the_next_one(
-            None, None, model_names, [], model_names)
-
-    def find_the_next_one(self, result, error, remaining, results, models):
-        """Find the next instance in remaining models."""
-        print ("4. me me")
-        if result:
-            results.append(result)
-        if remaining:
-            model_name = remaining.pop()
-
-            callback = partial(self.find_the_next_one,
-                               remaining=remaining,
-                               results=results,
-                               models=models)
-            return self.find_the_last_use(model_name, callback)
-
-        complete = {
-            result['document_model']: str(result['_id']) for
-            result in results}
-
-        return self._return_instance({'state': complete})
-
-    def find_the_last_use(self, model_name, callback):
-        """Find the last use of the model in the history."""
-        print ("5. me me")
+        # pylint: disable=W0613
+        cache = self.sync_state_cache
+        if cache is None:
+            state, missing = {}, model_names
+        else:
+            state, missing = cache.get(self.database_name, model_names)
+        if not missing:
+            return self._return_state(state)
         history = self.get_collection('_history')
-        history.find_one({'document_model': model_name},
-                         sort=[('_id', DESCENDING)],
-                         fields=['document_model', '_id'],
-                         callback=callback)
-
-    def _return_instance(self, instance, error=None):
-        """Return a single instance or anything else that can become JSON."""
-        print ("6. me me")
+        # Sorted the same way as the document_model, _id index (reversed),
+        # the first of each group can be read straight from the index.
+        history.aggregate(
+            [{'$match': {'document_model': {'$in': missing}}},
+             {'$sort': SON([('document_model', DESCENDING),
+                            ('_id', DESCENDING)])},
+             {'$group': {'_id': '$document_model',
+                         'last': {'$first': '$_id'}}}],
+            callback=partial(self._aggregated,
+                             state=state,
+                             missing=missing))
+
+    def _aggregated(self, result, error, state, missing):
+        """Add the found history ids to the state and the cache."""
+        if error:
+            raise tornado.web.HTTPError(500, str(error))
+        if isinstance(result, dict):
+            # Older servers answer with a single document
+            result = result.get('result', [])
+        latest = dict((row['_id'], row['last']) for row in result or [])
+        cache = self.sync_state_cache
+        if cache is not None:
+            cache.store(self.database_name, latest, missing)
+        state.update(latest)
+        return self._return_state(state)
+
+    def _return_state(self, state):
+        """Return the state of the models."""
         self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(json.dumps(instance, default=json_util.default))
+        self.write(dumps({'state': dict(
+            (model_name, str(history_id))
+            for model_name, history_id in state.items())}))
         self.finish()
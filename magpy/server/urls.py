@@ -7,15 +7,22 @@ from magpy.server.auth import AuthLoginHandler, AuthLogoutHandler, \
     AuthWhoAmIHandler, AuthPermissionHandler, AuthPermissionsHandler,\
     AuthWhoAreTheyHandler
 
+from magpy.server.media import FileUploadHandler, MediaHandler
+from magpy.server.history import VersionHandler
 from magpy.server.transactions import TransactionSyncHandler, \
     TransactionUpdateHandler
+from magpy.server.changes import ChangeFeedHandler
 
 URLS = [
     (r"/api/_sync/state/(\w+)/?", TransactionSyncHandler),
+    (r"/api/_sync/changes/(\w+)/?", ChangeFeedHandler),
     (r"/api/_sync/update/([a-zA-Z0-9_-]+)/([a-zA-Z0-9_-]+)/?", TransactionUpdateHandler),
+    (r"/api/_version/(\w+)/([a-zA-Z0-9_-]+)/(\d+)/?", VersionHandler),
+    (r"/api/(\w+)/([a-zA-Z0-9_-]+)/_file/(\w+)/?", FileUploadHandler),
     (r"/api/(\w+)/([a-zA-Z0-9_-]+)/([a-zA-Z0-9_-]+)/?", CommandHandler),
     (r"/api/(\w+)/([a-zA-Z0-9_-]+)/?", ResourceHandler),
     (r"/api/(\w+)/?", ResourceTypeHandler),
+    (r"/media/(\w+)/(.+)", MediaHandler),
     (r"/auth/login/", AuthLoginHandler),
     (r"/auth/logout/", AuthLogoutHandler),
     (r"/auth/whoami/", AuthWhoAmIHandler),
@@ -1,19 +1,18 @@
 """Common simple utils."""
 import os
 from pkgutil import get_loader
-import json
-from bson import json_util
 import base64
 import uuid
 import six
+from magpy.server.serialization import loads
+
 
 def dejsonify(value):
     """Converts from JSON when it is JSON, otherwise return it."""
     if six.PY2:
         if value.startswith('JSON:'):
             value = value.strip('JSON:')
-            value = json.loads(value,
-                               object_hook=json_util.object_hook)
+            value = loads(value)
     else:
         # Weird things in Python 3 happening with types
         # Seems to start as bytes
@@ -21,8 +20,7 @@ def dejsonify(value):
             value = value.strip(b'JSON:')
             # But the next line seems to want a unicode str
             value = value.decode(encoding='UTF-8')
-            value = json.loads(value,
-                               object_hook=json_util.object_hook)
+            value = loads(value)
     return value
 
 
@@ -4,6 +4,8 @@ import six
 
 # Import half of the friggin stdlib :)
 import re
+import json
+import hashlib
 import operator
 import types
 import datetime
@@ -50,18 +52,65 @@ def validate_model_instance(model,
     to validate embedded instances.
     * callback - an optional callback to run after validation.
     """
-    model_validator = ModelValidator(model,
-                                     handle_none=handle_none,
-                                     embedded_models=embedded_models)
+    plan = get_model_plan(model)
     if callback:
         try:
-            model_validator.validate_instance(instance)
+            plan.validate(instance, handle_none, embedded_models)
         except ValidationError:
             callback(False, instance)
         else:
             callback(True, instance)
     else:
-        model_validator.validate_instance(instance)
+        plan.validate(instance, handle_none, embedded_models)
+
+
+def model_fingerprint(model):
+    """Identify a version of a model definition, by a hash of its content.
+    _meta._version is not enough, as a model can be changed directly in
+    the database (e.g. by load_models) without it moving on."""
+    content = dict((key, value) for key, value in six.iteritems(model)
+                   if key != '_meta')
+    return hashlib.sha1(json.dumps(
+        content, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+def get_model_fingerprint(model):
+    """The fingerprint of the model, worked out once per model object.
+    Models are shared read-only (e.g. from the model registry), so
+    one that is changed must be a new object, not changed in place."""
+    try:
+        held, fingerprint = _MODEL_FINGERPRINTS[id(model)]
+    except KeyError:
+        held = None
+    # Holding the model stops its id being reused by another
+    if held is not model:
+        fingerprint = model_fingerprint(model)
+        if len(_MODEL_FINGERPRINTS) >= MODEL_PLAN_CACHE_SIZE:
+            _MODEL_FINGERPRINTS.clear()
+        _MODEL_FINGERPRINTS[id(model)] = (model, fingerprint)
+    return fingerprint
+
+
+def get_model_plan(model):
+    """Get the compiled plan for the model,
+    compiling it the first time a version of the model is seen."""
+    key = (model.get('_id'), get_model_fingerprint(model))
+    try:
+        return _MODEL_PLANS[key]
+    except KeyError:
+        pass
+    plan = ModelPlan(model)
+    if len(_MODEL_PLANS) >= MODEL_PLAN_CACHE_SIZE:
+        # Models rarely change, so just start again.
+        _MODEL_PLANS.clear()
+    _MODEL_PLANS[key] = plan
+    return plan
+
+
+def clear_model_plans():
+    """Forget all the compiled model plans."""
+    _MODEL_PLANS.clear()
+    _MODEL_FINGERPRINTS.clear()
 
 
 def parse_instance(instance, result_set):
@@ -106,6 +155,110 @@ def validate_modification(model,
             return callback(True, modification)
 
 
+class ModelPlan(object):
+    """A model definition compiled for validation.
+
+    The field sets are worked out once, and each field is bound
+    straight to its validator function, so validating many instances
+    of the same model does not repeat the work.
+    Use get_model_plan() to share plans between validations.
+    """
+    def __init__(self, model, dispatcher=None):
+        if dispatcher is None:
+            dispatcher = DISPATCH_TABLE
+        self.dispatcher = dispatcher
+        self.model = model
+        self.model_keys = frozenset(model.keys()) - MODEL_META_KEYS
+
+        required_keys = set()
+        self.validators = {}
+        for field in self.model_keys:
+            definition = model[field]
+            try:
+                if definition['required'] == True:
+                    required_keys.add(field)
+            except (KeyError, TypeError):
+                required_keys.add(field)
+            try:
+                field_type = definition['field']
+                validator = dispatcher[field_type]
+            except (KeyError, TypeError):
+                # Broken field definition, only complain
+                # if an instance actually uses the field.
+                continue
+            self.validators[field] = (validator,
+                                      field_type in EMBEDDED_FIELD_TYPES)
+        self.required_keys = frozenset(required_keys)
+        self.optional_keys = self.model_keys - self.required_keys
+
+    def validate(self, instance, handle_none=False, embedded_models=None):
+        """Validate that the instance meets the requirements of the model."""
+        instance_keys = set(instance.keys())
+        try:
+            instance_keys.remove('_model')
+        except KeyError:
+            raise OrphanedInstance('The instance does not have a model key.')
+        instance_keys -= INSTANCE_META_KEYS
+
+        # Sanity checks
+        self.check_for_unknown_fields(instance_keys)
+        self.check_for_missing_fields(instance_keys)
+
+        # Check for valid fields
+        try:
+            for field in instance_keys:
+                self.validate_field(field,
+                                    instance[field],
+                                    handle_none,
+                                    embedded_models)
+        except TypeError:
+            print("Died on %s " % instance['_id'])
+            print("Perhaps invalid model?")
+            raise
+
+        # If they are all valid, then do nothing
+        return None
+
+    def validate_field(self, field, field_data,
+                       handle_none=False, embedded_models=None):
+        """Validate if the field_data is valid for the field."""
+        try:
+            validator, embedded = self.validators[field]
+        except KeyError:
+            # Raises the error for the broken definition.
+            validator = self.dispatcher[self.model[field]['field']]
+            embedded = False
+        try:
+            if embedded:
+                validator(field_data, embedded_models)
+            else:
+                validator(field_data)
+        except ValidationError:
+            if field_data is None and handle_none:
+                pass
+            else:
+                raise
+
+    def check_for_unknown_fields(self, instance_keys):
+        """Check for nonsense extra fields."""
+        extra_fields = instance_keys - self.model_keys
+
+        if extra_fields:
+            if len(extra_fields) == 1:
+                raise InvalidFields(extra_fields.pop())
+            else:
+                raise InvalidFields(tuple(extra_fields))
+
+    def check_for_missing_fields(self, instance_keys):
+        """Some fields are allowed to be missing, others are just AWOL."""
+        awol = self.required_keys - instance_keys
+        if awol:
+            if len(awol) == 1:
+                raise MissingFields(next(iter(awol)))
+            else:
+                raise MissingFields(tuple(awol))
+
+
 class ModelValidator(object):
     """Validates instances according to a model."""
     def __init__(self,
@@ -115,41 +268,18 @@ class ModelValidator(object):
                  embedded_models=None):
         if dispatcher:
             self.dispatch = dispatcher
+            self.plan = ModelPlan(model, dispatcher)
         else:
-            self.dispatch = dict(DISPATCHER)
+            self.dispatch = DISPATCH_TABLE
+            self.plan = get_model_plan(model)
         self.model = model
-        self.model_keys = set(model.keys())
+        self.model_keys = self.plan.model_keys
         self.handle_none = handle_none
-
         self.embedded_models = embedded_models
-        try:
-            self.model_keys.remove('modeldescription')
-        except KeyError:
-            pass
-        try:
-            self.model_keys.remove(u'_id')
-        except KeyError:
-            pass
-        try:
-            self.model_keys.remove('_permissions')
-        except KeyError:
-            pass
-        try:
-            self.model_keys.remove('_view')
-        except KeyError:
-            pass
-        try:
-            self.model_keys.remove('_model')
-        except KeyError:
-            pass
-        try:
-            self.model_keys.remove('_applications')
-        except KeyError:
-            pass
 
     def do_dispatch(self, field_type, field_data):
         """Do the dispatch."""
-        if field_type == 'Embedded' or field_type == 'EmbeddedList':
+        if field_type in EMBEDDED_FIELD_TYPES:
             return self.dispatch[field_type](field_data,
                                              self.embedded_models)
         self.dispatch[field_type](field_data)
@@ -166,84 +296,17 @@ class ModelValidator(object):
 
     def validate_instance(self, instance):
         """Validate that the instance meets the requirements of the model."""
-        instance_keys = set(instance.keys())
-        try:
-            instance_keys.remove('_model')
-        except KeyError:
-            raise OrphanedInstance('The instance does not have a model key.')
-        try:
-            instance_keys.remove('_id')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_file_data')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_meta')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_view')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_versional_comment')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_operation')
-        except KeyError:
-            pass
-        try:
-            instance_keys.remove('_permissions')
-        except KeyError:
-            pass
-
-        # Sanity checks
-        self.check_for_unknown_fields(instance_keys)
-        self.check_for_missing_fields(instance_keys)
-
-        # Check for valid fields
-        try:
-            validity = [self.validate_field(self.model[field]['field'],
-                                            instance[field]) for \
-                            field in instance_keys]
-        except TypeError:
-            print("Died on %s " % instance['_id'])
-            print("Perhaps invalid model?")
-            raise
-
-        # If they are all valid, then do nothing
-        return None
+        return self.plan.validate(instance,
+                                  self.handle_none,
+                                  self.embedded_models)
 
     def check_for_unknown_fields(self, instance_keys):
         """Check for nonsense extra fields."""
-        extra_fields = instance_keys - self.model_keys
-
-        if extra_fields:
-            if len(extra_fields) == 1:
-                raise InvalidFields(extra_fields.pop())
-            else:
-                raise InvalidFields(tuple(extra_fields))
+        self.plan.check_for_unknown_fields(instance_keys)
 
     def check_for_missing_fields(self, instance_keys):
         """Some fields are allowed to be missing, others are just AWOL."""
-        missing_fields = self.model_keys - instance_keys
-        if missing_fields:
-            # Some fields are allowed to be missing, others are just AWOL.
-            awol = set()
-            for field in missing_fields:
-                try:
-                    if self.model[field]['required'] == True:
-                        awol.add(field)
-                except KeyError:
-                    awol.add(field)
-            if awol:
-                if len(awol) == 1:
-                    raise MissingFields(awol.pop())
-                else:
-                    raise MissingFields(tuple(awol))
+        self.plan.check_for_missing_fields(instance_keys)
 
     def validate_modification(self, model, modification):
         for modification_name, \
@@ -1385,10 +1448,9 @@ def validate_embedded(data,
         model = embedded_models[data['_model']]
     except KeyError:
         raise ValidationError('Missing _model key on embedded data.')
-    validate_model_instance(model,
-                            data,
-                            handle_none=handle_none,
-                            embedded_models=embedded_models)
+    get_model_plan(model).validate(data,
+                                   handle_none=handle_none,
+                                   embedded_models=embedded_models)
 
 
 def validate_embedded_list(data,
@@ -1399,16 +1461,21 @@ def validate_embedded_list(data,
         data.insert
     except AttributeError:
         raise ValidationError('Not an embedded list.')
-    for embedded_model in data:
+    # Look each model up once, not once per item.
+    plans = {}
+    for embedded_instance in data:
         try:
-            model = embedded_models[embedded_model['_model']]
+            model_name = embedded_instance['_model']
+            plan = plans.get(model_name)
+            if plan is None:
+                plan = get_model_plan(embedded_models[model_name])
+                plans[model_name] = plan
         except KeyError:
             raise ValidationError('Missing _model key on embedded data.')
 
-        validate_model_instance(model,
-                                embedded_model,
-                                handle_none=handle_none,
-                                embedded_models=embedded_models)
+        plan.validate(embedded_instance,
+                      handle_none=handle_none,
+                      embedded_models=embedded_models)
 
 
 def validate_set_modifier(model_validator, model, field, field_type, value):
@@ -1528,3 +1595,24 @@ DISPATCHER = (
     ('VerifiedURL', validate_verified_url),
     ('XML', validate_xml),
     )
+
+DISPATCH_TABLE = dict(DISPATCHER)
+
+# Keys of a model definition that describe the model, rather than a field.
+MODEL_META_KEYS = frozenset((
+    'modeldescription', '_id', '_permissions', '_view',
+    '_model', '_applications', '_indexes'))
+
+# Keys of an instance that are not checked against the model.
+INSTANCE_META_KEYS = frozenset((
+    '_id', '_file_data', '_meta', '_view',
+    '_versional_comment', '_operation', '_permissions'))
+
+EMBEDDED_FIELD_TYPES = frozenset(('Embedded', 'EmbeddedList'))
+
+# Compiled model plans, keyed by model _id and fingerprint.
+MODEL_PLAN_CACHE_SIZE = 512
+_MODEL_PLANS = {}
+
+# Fingerprints of model objects, keyed by id(model).
+_MODEL_FINGERPRINTS = {}
@@ -1,5 +1,5 @@
 /*global window, document, localStorage, XMLHttpRequest, Element,
-  ActiveXObject, SITE_DOMAIN:true, APP_NAME:true */
+  ActiveXObject, SITE_DOMAIN:true, APP_NAME:true, LOCAL_DB_NAME:true */
 /*jslint nomen: true*/
 
 /**
@@ -381,7 +381,7 @@ var MAG = (function () {
                 apply_to_resource: function (resource,
                                              id,
                                              options) {
-                    var url, api_url, callback, request;
+                    var url, request;
                     if (typeof options === "undefined") {
                         options = {};
                     }
@@ -395,38 +395,9 @@ var MAG = (function () {
                         resource + '/' + id,
                         [resource, id]
                     );
-                    api_url = 'api:' + url;
-
-                    if (typeof options.success === 'undefined') {
-                        // No optional callback
-                        // Just cache the resource
-//                        if (
-//                            !MAG._STORAGE.is_stored_item(api_url) ||
-//                                (options.force_reload === true)
-//                        ) {
-//                            options.success = MAG._REST.cache_api_data;
-//                        } // End if 
-
-                    } else {
-                        // We have an optional callback so use it.
-
-//                        if (
-//                            MAG._STORAGE.is_stored_item(api_url) &&
-//                                options.force_reload === false
-//                        ) {
-//                            options.success(
-//                                MAG._STORAGE.get_data_from_storage(api_url)
-//                            );
-//                            return;
-//                        }
-
-                        callback = options.success;
-                        options.success = function (data) {
-//                            MAG._REST.cache_api_data(data);
-                            callback(data);
-                        };
-                    } // if (typeof optional_callback === 'undefined')
-                    // So now we have a callback.
+                    // Keep a copy, and next time only fetch it again
+                    // if the server says it has changed.
+                    options.cache_key = 'api:' + url;
 
                     options.method = "GET";
                     MAG._REQUEST.request(url, options);
@@ -441,12 +412,17 @@ var MAG = (function () {
                    - fields - a list of field names that should be returned
                    in the result set (“_id” will always be included)
                    - force_reload - do not return any locally cached version
+                   - limit - the number of instances in a page
+                   - after - the after token of the previous page, the
+                   results continue from where that page stopped.
+                   A page that may be followed by another has an after
+                   token in the data given to the success callback.
 
                 */
                 apply_to_list_of_resources: function (resource,
                                                       options) {
-                    var base_url, url, api_url, full_url,
-                    callback, request, criteria, query;
+                    var base_url, url, full_url,
+                    request, criteria, query;
                     if (typeof options === "undefined") {
                         options = {};
                     }
@@ -469,47 +445,22 @@ var MAG = (function () {
                         query['_fields'] = options.fields
                         delete options.fields;
                     }
+                    if (typeof options.limit !== 'undefined') {
+                        query['_limit'] = options.limit;
+                        delete options.limit;
+                    }
+                    if (typeof options.after !== 'undefined') {
+                        query['_after'] = options.after;
+                        delete options.after;
+                    }
                     if (!(MAG.TYPES.is_empty_object(query))) {
                         url += '?';
                         url += MAG.URL.build_query_string(query);
                     }
 
-                    api_url = 'api:' + url;
-                    if (typeof options.success === 'undefined') {
-                        // No optional callback
-                        // Just cache the resource list
-                        if (
-                            MAG._STORAGE.is_stored_item(api_url)
-                                && (options.force_reload === false)
-                        ) {
-                            // Nothing to do
-                            return;
-                        }
-                        options.success = function (data) {
-//                            MAG._REST.cache_api_list(data,
-//                                                     resource,
-//                                                     criteria);
-                        };
-                    } else {
-                        if (
-                            MAG._STORAGE.is_stored_item(api_url) &&
-                                options.force_reload === false
-                        ) {
-                            options.success(
-                                MAG._STORAGE.get_data_from_storage(
-                                    api_url
-                                )
-                            );
-                            return;
-                        }
-                        callback = options.success;
-                        options.success = function (data) {
-//                            MAG._REST.cache_api_list(data,
-//                                                     resource,
-//                                                     criteria);
-                            callback(data);
-                        };
-                    } // End if (typeof optional_callback === 'undefined')
+                    // Keep a copy, and next time only fetch it again
+                    // if the server says it has changed.
+                    options.cache_key = 'api:' + url;
 
                     options.method = "GET";
                     MAG._REQUEST.request(url, options);
@@ -881,11 +832,14 @@ var MAG = (function () {
 
                 /** Log the user out. */
                 log_user_out: function (next) {
-                    localStorage.clear();
                     if (typeof next === "undefined") {
                         next = '/';
                     }
-                    window.location.href = "/auth/logout/?next=" + next;
+                    localStorage.clear();
+                    /* Leave once the cache has really gone */
+                    MAG._CACHE.clear(function () {
+                        window.location.href = "/auth/logout/?next=" + next;
+                    });
                 },
 
                 /** Log the user in. */
@@ -894,7 +848,6 @@ var MAG = (function () {
                     if (typeof next === "undefined") {
                         next = '/';
                     }
-                    window.location.href = "/auth/login/?next=" + next;
                     /* Get rid of any permissions in localStorage */
                     for (item in localStorage) {
                         if (localStorage.hasOwnProperty(item)) {
@@ -903,7 +856,11 @@ var MAG = (function () {
                             }
                         }
                     }
-                    
+                    /* What we could read depends on who we are,
+                       so leave once the cache has gone */
+                    MAG._CACHE.clear(function () {
+                        window.location.href = "/auth/login/?next=" + next;
+                    });
                 },
                 
                 /** Resolve a list of user ids to real names
@@ -1361,7 +1318,7 @@ var MAG = (function () {
                         );
                     return api_url + resource + '/' + id + '/';
                 },
-                /** Cache the api data into the localStorage */
+                /** Cache the api data */
                 cache_api_data: function (data) {
                     var storagekey;
                     storagekey = "api:" +
@@ -1370,7 +1327,7 @@ var MAG = (function () {
                             data._model + '/' + data._id,
                             [data._model, data._id]
                         );
-                    MAG._STORAGE.store_data(storagekey, data);
+                    MAG._CACHE.put(storagekey, data);
                 },
 
                 /** Cache multiple instances individually.
@@ -1394,7 +1351,7 @@ var MAG = (function () {
                     if (typeof query !== 'undefined') {
                         storagekey += '?' + MAG.URL.build_query_string(query);
                     }
-                    MAG._STORAGE.store_data(storagekey, data);
+                    MAG._CACHE.put(storagekey, data);
                 },
 
                 /** Delete cached data */
@@ -1406,28 +1363,21 @@ var MAG = (function () {
                             data._model + '/' + data._id,
                             [data._model, data._id]
                         );
-                    if (localStorage[storagekey] !== 'undefined') {
-                    	localStorage.removeItem(storagekey);
-                    	//this is no longer supported in FF. Replaced by line above
-                        //delete localStorage[storagekey];
-                    }
+                    MAG._CACHE.remove([storagekey]);
                 },
                 /** Delete multiple cached data by ids */
                 delete_multiple_cached_data: function (resource, ids) {
-                    var storagekey, instance_key, length, i;
+                    var storagekey, keys, length, i;
                     storagekey = "api:" +
                         MAG._STORAGE.get_data_from_storage_or_function(
                             "MAG._REST.get_api_url"
                         ) + resource + '/';
+                    keys = [];
                     length = ids.length;
                     for (i = 0; i < length; i += 1) {
-                        instance_key = storagekey + ids[i] + '/';
-                        if (localStorage[instance_key] !== 'undefined') {
-                        	localStorage.removeItem(instance_key);
-                        	//this is no longer supported in FF. Replaced by line above
-                            //delete localStorage[instance_key];
-                        }
+                        keys.push(storagekey + ids[i] + '/');
                     }
+                    MAG._CACHE.remove(keys);
                 }
                 // End of submodule _REST
             };
@@ -1449,6 +1399,34 @@ var MAG = (function () {
                         options.method = "GET";
                     }
 
+                    // Look for our copy first, and use it if it is fresh,
+                    // otherwise ask the server whether it has changed.
+                    if (
+                        typeof options.cache_key !== "undefined" &&
+                            typeof options.cached === "undefined"
+                    ) {
+                        MAG._CACHE.get(options.cache_key, function (entry) {
+                            options.cached = (
+                                typeof entry === "undefined"
+                            ) ? null : entry;
+                            if (
+                                options.cached !== null &&
+                                    options.force_reload !== true &&
+                                    MAG._CACHE.is_fresh(entry)
+                            ) {
+                                if (typeof options.success !== 'undefined') {
+                                    // Still answer later, as the server would
+                                    window.setTimeout(function () {
+                                        options.success(entry.data);
+                                    }, 0);
+                                }
+                                return;
+                            }
+                            MAG._REQUEST.request(url, options);
+                        });
+                        return;
+                    }
+
                     if (typeof options.mime !== "undefined") {
                         mime = options.mime;
                         delete options.mime;
@@ -1456,7 +1434,7 @@ var MAG = (function () {
                         mime = 'json'
                     }
 
-                    var xhr, trimPosition, header, default_headers;
+                    var xhr, trimPosition, header, default_headers, writing;
 
                     // Remove any hash fragment in the URL
                     trimPosition = url.lastIndexOf('/');
@@ -1506,11 +1484,27 @@ var MAG = (function () {
                         xhr.withCredentials = true;
                     }
                     /** Set up the success callback */
+                    writing = options.method.toUpperCase() !== 'GET';
                     xhr.onreadystatechange = function () {
                         var success_response;
                         if (xhr.readyState !== 4) {
                             return;
                         }
+                        if (writing) {
+                            // Forget anything read while we were writing
+                            MAG._CACHE.url_changed(url);
+                        }
+                        if (
+                            xhr.status === 304 &&
+                                options.cached
+                        ) {
+                            // Not modified, use our copy
+                            MAG._CACHE.touch(options.cached);
+                            if (typeof options.success !== 'undefined') {
+                                options.success(options.cached.data);
+                            }
+                            return;
+                        }
                         if (
                             (xhr.status >= 200 && xhr.status < 300) ||
                                 xhr.status === 304
@@ -1530,13 +1524,29 @@ var MAG = (function () {
                                 		throw new Error("response format error");
                                 	    }
                                 	} 
+                                        if (typeof options.cache_key !== 'undefined') {
+                                            MAG._REQUEST.cache_response(
+                                                options.cache_key,
+                                                xhr,
+                                                success_response
+                                            );
+                                        }
                                     } else {
                                         success_response = xhr.responseText;
                                     }
                                     options.success(success_response);
                                 }
                             } else {
-                                // No callback, do nothing
+                                // No callback, just keep a copy
+                                if (
+                                    typeof options.cache_key !== 'undefined' &&
+                                        mime === 'json'
+                                ) {
+                                    MAG._REQUEST.cache_response(
+                                        options.cache_key,
+                                        xhr
+                                    );
+                                }
                                 return;
                             }
                         } else {
@@ -1568,10 +1578,42 @@ var MAG = (function () {
                             'application/x-www-form-urlencoded; charset=utf8'
                         );
                     }
+                    // Ask for the data only if our copy is out of date
+                    if (
+                        options.cached &&
+                            options.cached.etag &&
+                            options.force_reload !== true
+                    ) {
+                        xhr.setRequestHeader('If-None-Match',
+                                             options.cached.etag);
+                    }
+                    if (writing) {
+                        MAG._CACHE.url_changed(url);
+                    }
                     xhr.send(options.data);
                     return xhr;
                 },
 
+                /** Keep the response, with its ETag if it has one,
+                    so that it can be revalidated next time.
+                    data - the parsed response, if we have it already */
+                cache_response: function (cache_key, xhr, data) {
+                    var etag;
+                    etag = xhr.getResponseHeader('Etag') || undefined;
+                    if (xhr.responseText === "") {
+                        return;
+                    }
+                    try {
+                        if (typeof data === "undefined") {
+                            data = JSON.parse(xhr.responseText);
+                        }
+                    } catch (err) {
+                        // Not JSON, just don't keep it
+                        return;
+                    }
+                    MAG._CACHE.put(cache_key, data, etag);
+                },
+
                 _default_headers: {
                     'X-Requested-With': 'XMLHttpRequest',
                     'Accept': 'application/json',
@@ -1748,6 +1790,321 @@ var MAG = (function () {
             };
         }()),
 
+        /** Responses to API GETs, by cache key ('api:' + URL).
+            The newest are kept in memory, and everything is kept
+            in IndexedDB too (when we have it), so it lasts across
+            page loads. A response is used as it is for max_age
+            milliseconds after it was last checked, and after that only
+            once the server says it has not changed (by its ETag).
+            Writes through MAG, and the changes brought in by SYNC,
+            throw away the responses they affect. */
+        _CACHE: (function () {
+            return {
+                /** How many responses to keep in memory. */
+                max_entries: 200,
+
+                /** How long a response is used without asking
+                    the server if it has changed, in milliseconds. */
+                max_age: 10000,
+
+                /** If more instances than this change at once,
+                    forget the whole resource rather than each one. */
+                max_changes: 100,
+
+                /** The longest to wait for IndexedDB to be cleared,
+                    before leaving the page anyway, in milliseconds. */
+                clear_timeout: 2000,
+
+                _entries: {},
+                _order: [],
+                _db: null,
+                _no_db: false,
+                _db_waiting: null,
+
+                /** Get the cache database, or null if we cannot. */
+                open_database: function (callback) {
+                    var request, finish;
+                    if (MAG._CACHE._db !== null) {
+                        return callback(MAG._CACHE._db);
+                    }
+                    if (MAG._CACHE._no_db ||
+                            typeof window.indexedDB === "undefined") {
+                        return callback(null);
+                    }
+                    if (MAG._CACHE._db_waiting !== null) {
+                        MAG._CACHE._db_waiting.push(callback);
+                        return;
+                    }
+                    MAG._CACHE._db_waiting = [callback];
+                    finish = function (db) {
+                        var waiting, i;
+                        waiting = MAG._CACHE._db_waiting;
+                        MAG._CACHE._db_waiting = null;
+                        if (db === null) {
+                            // e.g. private browsing, keep to memory
+                            MAG._CACHE._no_db = true;
+                        }
+                        for (i = 0; i < waiting.length; i += 1) {
+                            waiting[i](db);
+                        }
+                    };
+                    try {
+                        request = window.indexedDB.open(
+                            LOCAL_DB_NAME + '_cache', 1);
+                    } catch (err) {
+                        return finish(null);
+                    }
+                    request.onupgradeneeded = function (event) {
+                        event.target.result.createObjectStore(
+                            'responses', {keyPath: 'key'});
+                    };
+                    request.onsuccess = function (event) {
+                        var db = event.target.result;
+                        db.onversionchange = function () {
+                            db.close();
+                            MAG._CACHE._db = null;
+                        };
+                        MAG._CACHE._db = db;
+                        finish(db);
+                    };
+                    request.onerror = function () {
+                        finish(null);
+                    };
+                },
+
+                /** Run write(object_store) in a readwrite transaction,
+                    if we have the database. Failures (e.g. when the
+                    quota is used up) just mean less is kept.
+                    done - called once the transaction has finished
+                    (or failed, or there is no database). */
+                _write: function (write, done) {
+                    if (typeof done === "undefined") {
+                        done = function () {};
+                    }
+                    MAG._CACHE.open_database(function (db) {
+                        var transaction;
+                        if (db === null) {
+                            return done();
+                        }
+                        try {
+                            transaction = db.transaction(
+                                ['responses'], 'readwrite');
+                            write(transaction.objectStore('responses'));
+                        } catch (err) {
+                            return done();
+                        }
+                        transaction.oncomplete = function () {
+                            done();
+                        };
+                        transaction.onerror = function () {
+                            done();
+                        };
+                        transaction.onabort = function () {
+                            done();
+                        };
+                    });
+                },
+
+                /** Keep the entry in memory, as the most recently used. */
+                _remember: function (entry) {
+                    var position, oldest;
+                    position = MAG._CACHE._order.indexOf(entry.key);
+                    if (position !== -1) {
+                        MAG._CACHE._order.splice(position, 1);
+                    }
+                    MAG._CACHE._order.push(entry.key);
+                    MAG._CACHE._entries[entry.key] = entry;
+                    while (MAG._CACHE._order.length > MAG._CACHE.max_entries) {
+                        oldest = MAG._CACHE._order.shift();
+                        delete MAG._CACHE._entries[oldest];
+                    }
+                },
+
+                /** Forget the entries from memory. */
+                _forget: function (keys) {
+                    var i, position;
+                    for (i = 0; i < keys.length; i += 1) {
+                        if (MAG._CACHE._entries.hasOwnProperty(keys[i])) {
+                            delete MAG._CACHE._entries[keys[i]];
+                            position = MAG._CACHE._order.indexOf(keys[i]);
+                            if (position !== -1) {
+                                MAG._CACHE._order.splice(position, 1);
+                            }
+                        }
+                    }
+                },
+
+                /** Get the entry for the key, from memory or IndexedDB.
+                    callback(entry) gets undefined if we do not have it.
+                    An entry has data, etag, version and validated. */
+                get: function (key, callback) {
+                    if (MAG._CACHE._entries.hasOwnProperty(key)) {
+                        MAG._CACHE._remember(MAG._CACHE._entries[key]);
+                        return callback(MAG._CACHE._entries[key]);
+                    }
+                    MAG._CACHE.open_database(function (db) {
+                        var request;
+                        if (db === null) {
+                            return callback(undefined);
+                        }
+                        try {
+                            request = db.transaction('responses').objectStore(
+                                'responses').get(key);
+                        } catch (err) {
+                            return callback(undefined);
+                        }
+                        request.onsuccess = function (event) {
+                            var entry = event.target.result;
+                            if (typeof entry !== "undefined") {
+                                MAG._CACHE._remember(entry);
+                            }
+                            callback(entry);
+                        };
+                        request.onerror = function () {
+                            callback(undefined);
+                        };
+                    });
+                },
+
+                /** Keep a response.
+                    etag - the ETag it was served with, if any. */
+                put: function (key, data, etag) {
+                    var entry = {key: key,
+                                 data: data,
+                                 etag: etag,
+                                 version: MAG._CACHE.get_version(data),
+                                 validated: new Date().getTime()};
+                    MAG._CACHE._remember(entry);
+                    MAG._CACHE._write(function (object_store) {
+                        object_store.put(entry);
+                    });
+                },
+
+                /** The server says the entry has not changed. */
+                touch: function (entry) {
+                    entry.validated = new Date().getTime();
+                    MAG._CACHE._remember(entry);
+                },
+
+                /** Can the entry be used without asking the server? */
+                is_fresh: function (entry) {
+                    return new Date().getTime() - entry.validated <
+                        MAG._CACHE.max_age;
+                },
+
+                /** The _meta._version of an instance, if it is one. */
+                get_version: function (data) {
+                    if (data && typeof data._meta !== "undefined" &&
+                            data._meta !== null) {
+                        return data._meta._version;
+                    }
+                    return undefined;
+                },
+
+                /** Forget the responses with the keys. */
+                remove: function (keys) {
+                    MAG._CACHE._forget(keys);
+                    MAG._CACHE._write(function (object_store) {
+                        var i;
+                        for (i = 0; i < keys.length; i += 1) {
+                            object_store['delete'](keys[i]);
+                        }
+                    });
+                },
+
+                /** Forget the responses whose keys start with prefix. */
+                remove_prefix: function (prefix) {
+                    var keys, key;
+                    keys = [];
+                    for (key in MAG._CACHE._entries) {
+                        if (MAG._CACHE._entries.hasOwnProperty(key) &&
+                                key.indexOf(prefix) === 0) {
+                            keys.push(key);
+                        }
+                    }
+                    MAG._CACHE._forget(keys);
+                    MAG._CACHE._write(function (object_store) {
+                        object_store['delete'](window.IDBKeyRange.bound(
+                            prefix, prefix + '\uffff'));
+                    });
+                },
+
+                /** Forget the responses about a resource that has changed.
+                    changes - the changed instances, as SYNC items
+                    ({document_id, document} or {document}), or leave
+                    out to forget everything about the resource.
+                    The lists of the resource are always forgotten,
+                    an instance is kept if it is still the same version.
+                */
+                resource_changed: function (resource, changes) {
+                    var prefix, keys, i, id, key, version;
+                    prefix = 'api:' + MAG._STORAGE.get_data_from_storage_or_function(
+                        "MAG._REST.get_api_url"
+                    ) + resource + '/';
+                    if (typeof changes === "undefined" ||
+                            changes.length > MAG._CACHE.max_changes) {
+                        return MAG._CACHE.remove_prefix(prefix);
+                    }
+                    keys = [prefix];
+                    for (i = 0; i < changes.length; i += 1) {
+                        id = changes[i].document_id;
+                        if (typeof id === "undefined" && changes[i].document) {
+                            id = changes[i].document._id;
+                        }
+                        key = prefix + id + '/';
+                        version = MAG._CACHE.get_version(changes[i].document);
+                        if (!(MAG._CACHE._entries.hasOwnProperty(key) &&
+                              typeof version !== "undefined" &&
+                              MAG._CACHE._entries[key].version === version)) {
+                            keys.push(key);
+                        }
+                    }
+                    MAG._CACHE.remove(keys);
+                    MAG._CACHE.remove_prefix(prefix + '?');
+                },
+
+                /** Something has been written to the API URL,
+                    so forget the responses about its resource. */
+                url_changed: function (url) {
+                    var base_url, resource;
+                    base_url = MAG._STORAGE.get_data_from_storage_or_function(
+                        "MAG._REST.get_api_url"
+                    );
+                    if (url.indexOf(base_url) !== 0) {
+                        return;
+                    }
+                    resource = url.substr(base_url.length).split(/[\/?]/)[0];
+                    if (resource) {
+                        MAG._CACHE.resource_changed(resource);
+                    }
+                },
+
+                /** Forget everything, e.g. when the user changes.
+                    callback - called once IndexedDB has been cleared
+                    too, so it is safe to leave the page. If that takes
+                    longer than clear_timeout, it is called anyway. */
+                clear: function (callback) {
+                    var called = false, done;
+                    MAG._CACHE._entries = {};
+                    MAG._CACHE._order = [];
+                    done = function () {
+                        if (!called && typeof callback !== "undefined") {
+                            called = true;
+                            callback();
+                        }
+                    };
+                    if (typeof callback !== "undefined") {
+                        window.setTimeout(done, MAG._CACHE.clear_timeout);
+                    }
+                    MAG._CACHE._write(function (object_store) {
+                        object_store.clear();
+                    }, done);
+                }
+
+                // End of submodule _CACHE
+            };
+        }()),
+
         EVENT: (function () {
             return {
 
@@ -1,9 +1,7 @@
 /*global window, document, localStorage, XMLHttpRequest, Element,
-  ActiveXObject, SITE_DOMAIN, APP_NAME, MAG */
+  ActiveXObject, EventSource, SITE_DOMAIN, APP_NAME, MAG */
 /*jslint nomen: true*/
 
-var db;
-
 var EXAMPLE_STATE = {
     author: "51a40ce2c6ec494fcbf56e46",
     citationwork: "50ffee9249d52407f946d879",
@@ -21,6 +19,20 @@ var EXAMPLE_STATE = {
 2. Create object stores
 3. Fill object stores
 
+The database is opened once and the handle kept in SYNC.db.
+If another page needs to upgrade the database, we close ours
+and open it again when we next need it.
+
+Instances are written in batches of SYNC.batch_size, each in one
+readwrite transaction, and the local state of the resource is
+updated in the same transaction as its instances, so the state
+never gets ahead of (or behind) the data.
+
+Once every resource has caught up, we listen to the change feed.
+Changes from the feed are written straight away, but only
+/_sync/update/ moves the local state on, so anything the feed
+misses is picked up by the next sync.
+
 */
 
 var SYNC = (function () {
@@ -28,47 +40,102 @@ var SYNC = (function () {
     return {
         // body of module here
 
+        /** The open database, once we have it. */
+        db: null,
+
+        /** The change feed, once we are listening. */
+        source: null,
+
+        /** How many instances to write in each transaction. */
+        batch_size: 5000,
+
+        /** Changes from the feed waiting to be written. */
+        pending_changes: [],
 
         init: function() {
             SYNC.check_for_meta_store()
         },
 
-        /** 1. We need a meta store. */
-        check_for_meta_store: function() {
-            var request = indexedDB.open(LOCAL_DB_NAME);
-            request.onerror = function(event) {
+        /** 0. Get the open database, opening it if need be.
+            Give a version to upgrade the database,
+            with upgrade(db) to make the changes. */
+        open_database: function(callback, version, upgrade) {
+            var open_request;
+            if (SYNC.db !== null && typeof version === "undefined") {
+                return callback(SYNC.db);
+            }
+            if (SYNC.db !== null) {
+                // We have to let go to upgrade
+                SYNC.db.close();
+                SYNC.db = null;
+            }
+            if (typeof version === "undefined") {
+                open_request = indexedDB.open(LOCAL_DB_NAME);
+            } else {
+                open_request = indexedDB.open(LOCAL_DB_NAME, version);
+            }
+            open_request.onupgradeneeded = function(event) {
+                if (typeof upgrade !== "undefined") {
+                    upgrade(event.target.result);
+                }
+            };
+            open_request.onblocked = function(event) {
+                console.log("Waiting for other pages to close the database.");
+            };
+            open_request.onerror = function(event) {
                 alert("Why didn't you allow my web app to use IndexedDB?!");
             };
-            request.onsuccess = function(event) {
-                var db, transaction;
-                db = request.result;
+            open_request.onsuccess = function(event) {
+                var db = event.target.result;
+                db.onversionchange = function(event) {
+                    // Another page wants to upgrade, so let it
+                    db.close();
+                    if (SYNC.db === db) {
+                        SYNC.db = null;
+                    }
+                };
+                SYNC.db = db;
+                callback(db);
+            };
+        },
+
+        /** 0a. Add object stores to the database. */
+        create_object_stores: function(names, callback) {
+            SYNC.open_database(function (db) {
+                SYNC.open_database(callback, db.version + 1, function (db) {
+                    var i, length;
+                    length = names.length;
+                    for (i = 0; i < length; i += 1) {
+                        if (!db.objectStoreNames.contains(names[i])) {
+                            console.log('Missing object store: ' + names[i]);
+                            db.createObjectStore(names[i], { keyPath: "_id" });
+                        }
+                    }
+                });
+            });
+        },
+
+        /** 1. We need a meta store. */
+        check_for_meta_store: function() {
+            SYNC.open_database(function (db) {
                 if (db.objectStoreNames.contains('_meta')) {
                     SYNC.check_local_state();
                 } else {
-                    SYNC.create_meta_store(db.version);
+                    SYNC.create_meta_store();
                 }
-            };
+            });
         },
 
         /** 1a. Make the meta store. */
-        create_meta_store: function(version) {
-            var new_version, open_request;
-            new_version = version + 1;
-            open_request = indexedDB.open(LOCAL_DB_NAME, new_version);
-            open_request.onupgradeneeded = function(event) { 
-                var db = event.target.result;
-                var object_store = db.createObjectStore("_meta", { keyPath: "_id" });
-            };
-            open_request.onsuccess = function(event) {
+        create_meta_store: function() {
+            SYNC.create_object_stores(["_meta"], function (db) {
                 SYNC.check_local_state();
-            };
+            });
         },
-        
+
         /** 2. We need a local state object. */
         check_local_state: function() {
-            var request = indexedDB.open(LOCAL_DB_NAME);
-            request.onsuccess = function(event) {
-                var db = event.target.result;
+            SYNC.open_database(function (db) {
                 db.transaction("_meta").objectStore("_meta").get("state").onsuccess = function(event) {
                     var status = event.target.result;
                     if (typeof status == "undefined") {
@@ -78,23 +145,20 @@ var SYNC = (function () {
                         SYNC.get_remote_state(status)
                     }
                 };
-            };
+            });
         },
- 
+
         /** 2a. Make the local state object. */
         create_local_state: function() {
-            var request = indexedDB.open(LOCAL_DB_NAME);
-            request.onsuccess = function(event) {
-                var db = event.target.result;
+            SYNC.open_database(function (db) {
                 var transaction = db.transaction(["_meta"], "readwrite");
-                var object_store = transaction.objectStore("_meta");
                 var blank_state = {'_id': 'state'};
-                var add_request = object_store.add(blank_state);
-                add_request.onsuccess = function(event) {
+                transaction.objectStore("_meta").put(blank_state);
+                transaction.oncomplete = function(event) {
                     // Go to the next step
                     SYNC.get_remote_state(blank_state);
                 };
-            };   
+            });
         },
 
         /** 3. Try to get the remote state object,
@@ -117,14 +181,12 @@ var SYNC = (function () {
 
         /** 4. Check for object stores */
         check_for_relevant_object_stores: function(info) {
-            var open_request;
-            open_request = indexedDB.open(LOCAL_DB_NAME);
-            open_request.onsuccess = function(event) {
-                var db, resource_type;
-                db = event.target.result;
-                info.version = db.version;
+            SYNC.open_database(function (db) {
+                var resource_type;
                 info.present = []
                 info.missing = []
+                // Held until all the syncs have been started
+                info.syncing = 1;
 
                 // Check for resources
                 for (resource_type in info.remote_state) {
@@ -140,35 +202,32 @@ var SYNC = (function () {
                     SYNC.create_missing_object_stores(info);
                 } else {
                     // skip to the next step.
+                    SYNC.update_existing_object_stores(info);
                 }
-            };
+            });
+        },
+
+        /** 4a. A resource has started syncing. */
+        start_syncing: function(info) {
+            info.syncing += 1;
+        },
+
+        /** 4b. A resource has caught up, once they all have,
+            listen for changes. */
+        done_syncing: function(info) {
+            info.syncing -= 1;
+            if (info.syncing === 0) {
+                SYNC.listen(info);
+            }
         },
 
         /** 5. Create missing stores **/
         create_missing_object_stores: function(info) {
-            var new_version, open_request, resource_type;
-            info.version += 1;
-            open_request = indexedDB.open(LOCAL_DB_NAME, info.version);
-            open_request.onupgradeneeded = function(event) {
-                var db, object_store, resource_type, i, length;
-                db = event.target.result;
-                
-                // Create resource stores
-                length = info.missing.length;
-                for (i = 0; i < length; i += 1) {
-                    resource_type = info.missing[i];
-                    console.log('Missing object store: ' + resource_type);
-                    object_store = db.createObjectStore(
-                        resource_type, { keyPath: "_id" });
-                    console.log('Created object store for: ' + resource_type);
-                }
-            };
-
-            open_request.onsuccess = function() {
+            SYNC.create_object_stores(info.missing, function (db) {
                 console.log('We have the stores');
                 SYNC.populate_empty_stores(info);
                 SYNC.update_existing_object_stores(info);
-            };
+            });
         },
 
         /** 6. Populate empty stores. */
@@ -176,6 +235,7 @@ var SYNC = (function () {
             var length, i;
             length = info.missing.length;
             for (i = 0; i < length; i += 1) {
+                SYNC.start_syncing(info);
                 SYNC.get_all_instances(info.missing[i], info);
             }
         },
@@ -192,40 +252,78 @@ var SYNC = (function () {
             );
             url = base_url + resource + '/';
             MAG._REQUEST.request(url, options);
-        },        
+        },
 
         /** 6b. Populate the empty stores with the remote instances. */
         populate_instances: function (instances, resource, info) {
-            var open_request;
-            open_request = indexedDB.open(LOCAL_DB_NAME);
-            open_request.onsuccess = function(e) {
-                var length, i, transaction, object_store, add_request;
-                console.log('Populating: ' + resource);
-                db = e.target.result;
-                var transaction = db.transaction([resource], "readwrite");
+            var items, i, length;
+            console.log('Populating: ' + resource);
+            items = [];
+            length = instances.length;
+            for (i = 0; i < length; i += 1) {
+                items[i] = {operation: "create", document: instances[i]};
+            }
+            SYNC.write_items(resource, items, info.remote_state[resource],
+                             function () {
+                                 SYNC.done_syncing(info);
+                             });
+        },
 
+        /** 6c. Write the items to the store, a batch to a transaction.
+            The last batch updates the local state of the resource too. */
+        write_items: function (resource, items, new_state, callback) {
+            SYNC.open_database(function (db) {
+                var batch, last, transaction, object_store, updates, i, length;
+                batch = items.slice(0, SYNC.batch_size);
+                last = batch.length === items.length;
+                if (last && typeof new_state !== "undefined") {
+                    transaction = db.transaction([resource, "_meta"], "readwrite");
+                    updates = {};
+                    updates[resource] = new_state;
+                    SYNC.put_local_state(transaction, updates);
+                } else {
+                    transaction = db.transaction([resource], "readwrite");
+                }
+                object_store = transaction.objectStore(resource);
+                length = batch.length;
+                for (i = 0; i < length; i += 1) {
+                    SYNC.apply_item(object_store, batch[i]);
+                }
                 transaction.oncomplete = function(event) {
-                    SYNC.update_local_state(
-                        resource,
-                        info.remote_state[resource]);
+                    SYNC.forget_cached(resource, batch);
+                    if (!last) {
+                        SYNC.write_items(resource, items.slice(batch.length),
+                                         new_state, callback);
+                    } else if (typeof callback !== "undefined") {
+                        callback();
+                    }
                 };
- 
                 transaction.onerror = function(event) {
                     // Don't forget to handle errors!
-                    console.log("Error!");
+                    console.log("Error writing " + resource + "!");
                 };
- 
-                object_store = transaction.objectStore(resource);
+            });
+        },
 
-                length = instances.length;
-                for (i = 0; i < length; i += 1) {
-                    add_request = object_store.add(instances[i]);
-                    add_request.onsuccess = function(event) {};
-                }
-            };
-            open_request.onerror = function(event) {
-                alert("Database error: " + event.target.errorCode);
-                console.log("Database error: " + event.target.errorCode);
+        /** Tell MAG's response cache which instances have changed. */
+        forget_cached: function (resource, items) {
+            if (typeof MAG !== "undefined" && typeof MAG._CACHE !== "undefined") {
+                MAG._CACHE.resource_changed(resource, items);
+            }
+        },
+
+        /** Apply a create, update or delete to the object store. */
+        apply_item: function (object_store, item) {
+            switch (item.operation) {
+                case "create":
+                    SYNC.add_instance(object_store, item)
+                    break;
+                case "delete":
+                    SYNC.delete_instance(object_store, item)
+                    break;
+                case "update":
+                    SYNC.update_instance(object_store, item)
+                    break;
             };
         },
 
@@ -241,102 +339,173 @@ var SYNC = (function () {
                     console.log(resource_type + " is up to date.");
                 } else {
                     console.log(resource_type + " needs to be updated.");
-                    SYNC.get_update(resource, old_state, new_state);
+                    SYNC.start_syncing(info);
+                    SYNC.get_update(resource_type, old_state, new_state, info);
                 }
             }
+            SYNC.done_syncing(info);
         },
 
-        /** 7a. get the updated instances. */
-        get_update: function (resource, objectid, new_state) {
+        /** 7a. get the updated instances, a page at a time.
+            The server coalesces the changes in each page,
+            and gives us the history id to carry on after. */
+        get_update: function (resource, objectid, new_state, info) {
             var base_url, url;
             base_url = MAG._STORAGE.get_data_from_storage_or_function(
                 "MAG._REST.get_api_url"
             );
             url = base_url + '_sync/update/' + resource + '/' + objectid + '/';
             MAG._REQUEST.request(url, {
-                success: function (items) {
-                    SYNC.do_update_store(items, resource, new_state);
+                success: function (page) {
+                    SYNC.do_update_store(page, resource, new_state, info);
                 }
             });
         },
 
-        /** 7b. store the updated instances */
-        do_update_store: function(items, resource, new_state) {
-            var open_db_request, object_store, up_transaction, item;
-            open_db_request = indexedDB.open(LOCAL_DB_NAME);
-            open_db_request.onsuccess = function(event) {
-                var db, i, length, up_transaction;
-                db = event.target.result;
-                up_transaction = db.transaction([resource], "readwrite");
-                up_transaction.oncomplete = function(event) {
-                    SYNC.update_local_state(
-                        resource,
-                        new_state);
-                };
-                up_transaction.onerror = function(event) {
-                    // Don't forget to handle errors!
-                    console.log("Up transaction error!");
-                };
-                object_store = up_transaction.objectStore(resource);
-                // Main loop!
-                length = items.length;
-                for (i = 0; i < length; i += 1) {
-                    item = items[i];
-                    console.log('Made it here!');
-                    switch (item.operation) {
-                        case "create":
-                            SYNC.add_instance(object_store, item)
-                            break;
-                        case "delete":
-                            SYNC.delete_instance(object_store, item)
-                            break;
-                        case "update":
-                            SYNC.update_instance(object_store, item)
-                            break;
-                    };
+        /** 7b. store the updated instances, along with how far we got
+            in case we are interrupted, then ask for the next page
+            if there is one */
+        do_update_store: function(page, resource, new_state, info) {
+            SYNC.write_items(resource, page.results, page.after, function () {
+                if (page.more) {
+                    SYNC.get_update(resource, page.after, new_state, info);
+                } else {
+                    SYNC.done_syncing(info);
                 }
-            };
+            });
         },
 
+        /* A page may be fetched again after an interruption,
+           so creates must not fail if the instance is already here. */
         add_instance: function(object_store, item) {
-            object_store.add(item.document);
+            object_store.put(item.document);
         },
 
         delete_instance: function(object_store, item) {
-            object_store.delete(item.document);
+            object_store.delete(item.document_id);
         },
 
         update_instance: function(object_store, item) {
             object_store.put(item.document);
         },
 
-        /** 8. Update local meta state */
-        update_local_state: function(resource, objectid) {
-            var request = indexedDB.open(LOCAL_DB_NAME);
-            request.onsuccess = function(event) {
-                var db = event.target.result;
-                db.transaction("_meta").objectStore("_meta").get("state").onsuccess = function(event) {
-                    var state = event.target.result;
-                    var put_request = indexedDB.open(LOCAL_DB_NAME);
-                    put_request.onsuccess = function(event) {
-                        state[resource] = objectid;
-                        console.log('state is...');
-                        console.log(state);
-                        db = request.result;
-                        var transaction = db.transaction(["_meta"], "readwrite");
-                        transaction.oncomplete = function(event) {
-                            console.log("Meta updated for " + resource);
-                        };
-                        var object_store = transaction.objectStore("_meta");
-                        object_store.put(state);
-                    };
-
-                };
+        /** 8. Update local meta state, as part of the transaction
+            that writes the instances.
+            updates - the new history id of each resource. */
+        put_local_state: function(transaction, updates) {
+            var object_store = transaction.objectStore("_meta");
+            object_store.get("state").onsuccess = function(event) {
+                var state, resource;
+                state = event.target.result;
+                if (typeof state === "undefined") {
+                    state = {'_id': 'state'};
+                }
+                for (resource in updates) {
+                    if (updates.hasOwnProperty(resource)) {
+                        state[resource] = updates[resource];
+                    }
+                }
+                object_store.put(state);
             };
         },
 
+        /** 9. Listen for changes as they happen, from after the
+            newest history in the state we are syncing to. */
+        listen: function (info) {
+            var url, after, resource, source, opened;
+            if (typeof EventSource === "undefined" || SYNC.source !== null) {
+                return;
+            }
+            after = '';
+            for (resource in info.remote_state) {
+                if (info.remote_state.hasOwnProperty(resource) &&
+                        info.remote_state[resource] > after) {
+                    after = info.remote_state[resource];
+                }
+            }
+            url = 'http://' + SITE_DOMAIN + '/api/_sync/changes/' + APP_NAME + '/';
+            if (after) {
+                url += '?after=' + after;
+            }
+            source = new EventSource(url, {withCredentials: true});
+            source.addEventListener('change', function (event) {
+                SYNC.apply_change(JSON.parse(event.data), event.lastEventId);
+            });
+            // After a dropped connection, sync again in case
+            // the feed missed anything
+            opened = false;
+            source.addEventListener('open', function () {
+                if (opened) {
+                    SYNC.init();
+                }
+                opened = true;
+            });
+            // We have missed too much, so sync again
+            source.addEventListener('resync', function () {
+                source.close();
+                SYNC.source = null;
+                SYNC.init();
+            });
+            SYNC.source = source;
+        },
+
+        /** 9a. Queue a change from the feed, the changes that
+            arrive together are written together. */
+        apply_change: function (item, history_id) {
+            item.history_id = history_id;
+            SYNC.pending_changes.push(item);
+            if (SYNC.pending_changes.length === 1) {
+                window.setTimeout(SYNC.write_changes, 0);
+            }
+        },
+
+        /** 9b. Write the queued changes in one transaction.
+            The local state is left alone, it is only moved on
+            by /_sync/update/. */
+        write_changes: function () {
+            var changes = SYNC.pending_changes;
+            SYNC.pending_changes = [];
+            SYNC.open_database(function (db) {
+                var resources, resource, transaction, i, length, item;
+                resources = [];
+                length = changes.length;
+                for (i = 0; i < length; i += 1) {
+                    resource = changes[i].document_model;
+                    if (db.objectStoreNames.contains(resource) &&
+                            resources.indexOf(resource) === -1) {
+                        resources.push(resource);
+                    }
+                }
+                if (resources.length === 0) {
+                    return;
+                }
+                transaction = db.transaction(resources, "readwrite");
+                for (i = 0; i < length; i += 1) {
+                    item = changes[i];
+                    if (resources.indexOf(item.document_model) !== -1) {
+                        SYNC.apply_item(
+                            transaction.objectStore(item.document_model),
+                            item);
+                    }
+                }
+                transaction.oncomplete = function(event) {
+                    var j, resource_changes;
+                    for (i = 0; i < resources.length; i += 1) {
+                        resource_changes = [];
+                        for (j = 0; j < length; j += 1) {
+                            if (changes[j].document_model === resources[i]) {
+                                resource_changes.push(changes[j]);
+                            }
+                        }
+                        SYNC.forget_cached(resources[i], resource_changes);
+                    }
+                };
+                transaction.onerror = function(event) {
+                    console.log("Error applying the changes!");
+                };
+            });
+        },
 
         // End of module SYNC
     };
 }());
-
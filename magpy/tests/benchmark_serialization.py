@@ -0,0 +1,82 @@
+"""Compare magpy.server.serialization with json and bson.json_util.
+
+Run it directly:
+
+python -m magpy.tests.benchmark_serialization
+
+It times serialising and deserialising documents like the ones we
+usually store, from about 5 KB up to about 50 KB.
+"""
+
+from __future__ import print_function
+
+import json
+import random
+import timeit
+from datetime import datetime, timedelta
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+from magpy.server import serialization
+
+# The number of times to repeat each measurement
+REPEAT = 5
+
+
+def make_document(size):
+    """Make a document of roughly size bytes of JSON,
+    with nested instances, dates, ids and numbers.
+    (No Decimals, as json_util cannot serialise them.)"""
+    randomiser = random.Random(size)
+    start = datetime(2013, 1, 1, tzinfo=utc)
+    document = {
+        '_id': str(ObjectId()),
+        '_model': 'transcription',
+        '_meta': {'_created_time': start,
+                  '_last_modified_time': start + timedelta(days=3),
+                  '_last_modified_by': 'editor',
+                  '_last_modified_by_display': 'Editor',
+                  '_version': 4},
+        'witness': ObjectId(),
+        'verses': []}
+    while len(json.dumps(document, default=json_util.default)) < size:
+        document['verses'].append({
+            '_model': 'verse',
+            'reference': ObjectId(),
+            'checked': start + timedelta(minutes=randomiser.randint(0, 9999)),
+            'confidence': randomiser.random(),
+            'words': [{'text': 'word%s' % randomiser.randint(0, 9999),
+                       'position': position}
+                      for position in range(10)]})
+    return document
+
+
+def time_it(function, number):
+    """Best time per call, in milliseconds."""
+    return min(timeit.repeat(function, number=number,
+                             repeat=REPEAT)) / number * 1000
+
+
+def main():
+    """Print the comparison."""
+    print("Backend: %s" % (
+        'orjson' if serialization.orjson is not None else 'json'))
+    print("%8s %12s %12s %12s %12s" % (
+        'size', 'old dumps', 'new dumps', 'old loads', 'new loads'))
+    for size in (5000, 10000, 20000, 50000):
+        document = make_document(size)
+        text = serialization.dumps(document)
+        number = max(10, 2000000 // size)
+        old_dumps = time_it(
+            lambda: json.dumps(document, default=json_util.default), number)
+        new_dumps = time_it(lambda: serialization.dumps(document), number)
+        old_loads = time_it(
+            lambda: json.loads(text, object_hook=json_util.object_hook),
+            number)
+        new_loads = time_it(lambda: serialization.loads(text), number)
+        print("%7dB %10.3fms %10.3fms %10.3fms %10.3fms" % (
+            len(text), old_dumps, new_dumps, old_loads, new_loads))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 """Test api.py."""
 
 from unittest import TestCase, main
-from magpy.server.api import CommandHandler
+from magpy.server.api import CommandHandler, ResourceTypeHandler
+from magpy.server.database import DatabaseMixin, validation_problem, \
+    create_versions
 
 class TestCommandHandler(TestCase):
     """Test advanced commands."""
@@ -24,5 +26,114 @@ class TestCommandHandler(TestCase):
             ['10001_1', '10001_2', '10003_2'], '10001')
 
 
+BOOK_MODEL = {'_id': 'book',
+              '_model': '_model',
+              'title': {'field': 'Char',
+                        'required': True}}
+
+
+class TestBulkCreate(TestCase):
+    """Test the parts of bulk create that do not need a database."""
+    def test_prepare_new_instance(self):
+        """New instances get an _id and _meta, the comment comes out."""
+        instance = {'_model': 'book',
+                    'title': 'Emma',
+                    '_versional_comment': 'Imported'}
+        files, comment = ResourceTypeHandler._prepare_new_instance(
+            instance, {'_id': 'jane', 'name': 'Jane'})
+        self.assertEqual(files, None)
+        self.assertEqual(comment, 'Imported')
+        self.assertTrue('_id' in instance)
+        self.assertFalse('_versional_comment' in instance)
+        self.assertEqual(instance['_meta']['_version'], 1)
+        self.assertEqual(instance['_meta']['_last_modified_by'], 'jane')
+
+    def test_validation_problem(self):
+        """Each instance gets its own answer."""
+        models = {'book': BOOK_MODEL}
+        self.assertEqual(
+            validation_problem(models, {'_model': 'book', 'title': 'Emma'}),
+            None)
+        self.assertTrue(
+            validation_problem(models, {'_model': 'book'}).startswith(
+                'Missing Fields'))
+        self.assertEqual(
+            validation_problem(models, {'_model': 'magazine'}),
+            'Unknown model')
+
+    def test_create_versions_with_comments(self):
+        """Each version can have its own comment."""
+        versions = create_versions(
+            [{'_id': 'one', '_model': 'book'},
+             {'_id': 'two', '_model': 'book'}],
+            'create',
+            ['First', 'Second'])
+        self.assertEqual([version['comment'] for version in versions],
+                         ['First', 'Second'])
+
+
+class FailingHistory(object):
+    """A _history collection that cannot be written to."""
+    # pylint: disable=R0903
+    def insert(self, versions, callback):
+        """Fail."""
+        # pylint: disable=W0613
+        callback(None, Exception('Gone away'))
+
+
+class FakeApplication(object):
+    """An application without caches."""
+    # pylint: disable=R0903
+    settings = {}
+
+
+class BulkCreateHandler(ResourceTypeHandler):
+    """Just enough of a handler to record the bulk create history."""
+    # pylint: disable=W0231
+    _database_name = 'vmr'
+
+    def __init__(self):
+        self.application = FakeApplication()
+        self.returned = None
+
+    def get_collection(self, name):
+        """Only the history is needed."""
+        # pylint: disable=W0613
+        return FailingHistory()
+
+    def _return_data(self, data):
+        """Keep the response."""
+        self.returned = data
+
+
+class TestBulkCreateHistory(TestCase):
+    """Test a bulk create whose history cannot be written."""
+    def test_history_failed(self):
+        """The instances are not reported as created."""
+        handler = BulkCreateHandler()
+        results = [{'_id': 'emma'}, {'_id': 'persuasion'}]
+        batch = [(result, {'_id': result['_id'], '_model': 'book',
+                           'title': result['_id']}) for result in results]
+        handler._bulk_record_history(None, None, 'book', batch, results,
+                                     ['Created', 'Created'], [None, None])
+        self.assertEqual([result['status'] for result in
+                          handler.returned['results']], [500, 500])
+        self.assertTrue('Gone away' in results[0]['error'])
+
+
+class TestReplaceInstances(TestCase):
+    """Test waiting for a batch of updates."""
+    def test_replaced(self):
+        """The callback comes once, after the last update,
+        with the first error."""
+        calls = []
+        progress = {'waiting': 3, 'error': None}
+        for error in (None, 'first', 'second'):
+            DatabaseMixin._replaced(
+                None, error, progress,
+                lambda response, error: calls.append(error))
+        self.assertEqual(calls, ['first'])
+
+
 if __name__ == '__main__':
     main()
@@ -5,6 +5,7 @@ import unittest
 import time
 
 from magpy.server.instances import InstanceLoader
+from magpy.server.auth import AuthenticationMixin
 from magpy.tests.test_magjs import open_test_collection, MagTestCase
 
 import six
@@ -125,5 +126,60 @@ class MagUnauthorisedAuthTestCase(MagTestCase):
                           NOTFOUND)
 
 
+class FakeUsers(object):
+    """Just enough of the _user collection."""
+    def __init__(self, users):
+        self.users = users
+
+    def find_one(self, spec, callback, fields=None):
+        """Find the user."""
+        # pylint: disable=W0613
+        callback(self.users.get(spec['_id']), None)
+
+
+class PermissionChecker(AuthenticationMixin):
+    """A handler with a logged in user."""
+    def __init__(self, user_id, users):
+        self.user_id = user_id
+        self.users = users
+
+    def get_user_id(self):
+        """The logged in user."""
+        return self.user_id
+
+    def get_collection(self, name):
+        """Only the users are needed."""
+        # pylint: disable=W0613
+        return FakeUsers(self.users)
+
+
+class TestResourceWithoutModel(unittest.TestCase):
+    """A resource without a model can still be granted to a user."""
+    users = {'ann': {'_id': 'ann',
+                     '_permissions': {'report': {'read': True,
+                                                 'update': False}}}}
+
+    def check(self, user_id, permission):
+        """Check the permission on the report, which has no model."""
+        results = []
+        checker = PermissionChecker(user_id, self.users)
+        checker._check_effective_permission(
+            {}, 'report', permission,
+            lambda: results.append(True),
+            lambda: results.append(False))
+        return results
+
+    def test_user_permission(self):
+        """The user's own permissions are used."""
+        self.assertEqual(self.check('ann', 'read'), [True])
+        self.assertEqual(self.check('ann', 'update'), [False])
+        self.assertEqual(self.check('ann', 'delete'), [False])
+
+    def test_no_user_permission(self):
+        """Otherwise there are no permissions."""
+        self.assertEqual(self.check('bob', 'read'), [False])
+        self.assertEqual(self.check(None, 'read'), [False])
+
+
 if __name__ == '__main__':
     unittest.main()
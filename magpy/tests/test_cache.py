@@ -0,0 +1,203 @@
+"""Test cache.py."""
+
+from unittest import TestCase, main
+from magpy.server.cache import ModelRegistry, PermissionCache, CountCache, \
+    SyncStateCache
+
+# pylint: disable=R0904
+
+MODELS = (
+    {'_id': 'author',
+     '_model': '_model',
+     'name': {'field': 'Char'}},
+    {'_id': 'book',
+     '_model': '_model',
+     'title': {'field': 'Char'}},
+    )
+
+
+class TestModelRegistry(TestCase):
+    """Test the in-process model registry."""
+    def setUp(self):  # pylint: disable=C0103
+        self.registry = ModelRegistry()
+        self.registry.load('test', MODELS)
+
+    def test_get(self):
+        """Loaded models are served from memory."""
+        self.assertEqual(self.registry.get('test', 'author'), MODELS[0])
+        self.assertEqual(self.registry.get('test', 'magazine'), None)
+        self.assertEqual(self.registry.get('other', 'author'), None)
+        self.assertEqual(self.registry.stats(),
+                         {'hits': 1, 'misses': 2, 'models': 2})
+
+    def test_get_many(self):
+        """Get several models, reporting what is missing."""
+        found, missing = self.registry.get_many(
+            'test', ['author', 'magazine'])
+        self.assertEqual(found, [MODELS[0]])
+        self.assertEqual(missing, ['magazine'])
+
+    def test_invalidate(self):
+        """Invalidated models are forgotten."""
+        self.registry.invalidate('test', ['author'])
+        self.assertEqual(self.registry.get('test', 'author'), None)
+        self.assertEqual(self.registry.get('test', 'book'), MODELS[1])
+        self.registry.invalidate('test')
+        self.assertEqual(self.registry.get('test', 'book'), None)
+
+    def test_racing_fetch_is_not_stored(self):
+        """A fetch that started before an invalidation is not kept."""
+        generation = self.registry.generation('test')
+        self.registry.invalidate('test', ['author'])
+        self.registry.store('test', [MODELS[0]], generation)
+        self.assertEqual(self.registry.get('test', 'author'), None)
+
+    def test_ttl(self):
+        """Old entries expire when there is a ttl."""
+        registry = ModelRegistry(ttl=-1)
+        registry.load('test', MODELS)
+        self.assertEqual(registry.get('test', 'author'), None)
+
+
+READ_ONLY = {'read': True, 'create': False, 'update': False, 'delete': False}
+
+
+class TestPermissionCache(TestCase):
+    """Test the effective permission cache."""
+    def setUp(self):  # pylint: disable=C0103
+        self.cache = PermissionCache(max_size=3, ttl=60)
+        self.cache.store('test', 'alice', 'author', READ_ONLY)
+        self.cache.store('test', 'bob', 'author', READ_ONLY)
+        self.cache.store('test', None, 'book', READ_ONLY)
+
+    def test_get(self):
+        """Stored permissions are returned by user and resource."""
+        self.assertEqual(self.cache.get('test', 'alice', 'author'),
+                         READ_ONLY)
+        self.assertEqual(self.cache.get('test', 'alice', 'book'), None)
+        self.assertEqual(self.cache.get('other', 'alice', 'author'), None)
+
+    def test_bounded(self):
+        """The least recently used entry goes first."""
+        self.cache.get('test', 'alice', 'author')
+        self.cache.store('test', 'carol', 'author', READ_ONLY)
+        self.assertEqual(self.cache.get('test', 'bob', 'author'), None)
+        self.assertEqual(self.cache.get('test', 'alice', 'author'),
+                         READ_ONLY)
+
+    def test_ttl(self):
+        """Old entries expire."""
+        cache = PermissionCache(ttl=-1)
+        cache.store('test', 'alice', 'author', READ_ONLY)
+        self.assertEqual(cache.get('test', 'alice', 'author'), None)
+
+    def test_invalidate_users(self):
+        """Changing a user forgets only their permissions."""
+        self.cache.invalidate_users('test', ['alice'])
+        self.assertEqual(self.cache.get('test', 'alice', 'author'), None)
+        self.assertEqual(self.cache.get('test', 'bob', 'author'), READ_ONLY)
+
+    def test_invalidate_resources(self):
+        """Changing a model forgets the permissions on it."""
+        self.cache.invalidate_resources('test', ['author'])
+        self.assertEqual(self.cache.get('test', 'bob', 'author'), None)
+        self.assertEqual(self.cache.get('test', None, 'book'), READ_ONLY)
+
+    def test_racing_store_is_ignored(self):
+        """Permissions worked out before a change are not kept."""
+        generation = self.cache.generation('test')
+        self.cache.invalidate('test')
+        self.cache.store('test', 'alice', 'author', READ_ONLY, generation)
+        self.assertEqual(self.cache.get('test', 'alice', 'author'), None)
+
+
+class TestCountCache(TestCase):
+    """Test the list count cache."""
+    def setUp(self):  # pylint: disable=C0103
+        self.cache = CountCache(max_size=10, ttl=60)
+        self.cache.store('test', 'book', {'author': 'austen', 'year': 1815},
+                         2)
+        self.cache.store('test', 'book', None, 10)
+        self.cache.store('test', 'author', None, 4)
+
+    def test_get(self):
+        """The order of the criteria does not matter."""
+        self.assertEqual(
+            self.cache.get('test', 'book', {'year': 1815,
+                                            'author': 'austen'}),
+            2)
+        self.assertEqual(self.cache.get('test', 'book', {}), 10)
+        self.assertEqual(self.cache.get('test', 'book', {'year': 1816}),
+                         None)
+
+    def test_invalidate(self):
+        """Writing to a collection forgets only its counts."""
+        self.cache.invalidate('test', 'book')
+        self.assertEqual(self.cache.get('test', 'book', None), None)
+        self.assertEqual(self.cache.get('test', 'author', None), 4)
+
+    def test_racing_count_is_not_stored(self):
+        """A count that started before a write is not kept."""
+        generation = self.cache.generation('test', 'book')
+        self.cache.invalidate('test', 'book')
+        self.cache.store('test', 'book', None, 9, generation)
+        self.assertEqual(self.cache.get('test', 'book', None), None)
+
+    def test_ttl(self):
+        """Old counts expire."""
+        cache = CountCache(ttl=-1)
+        cache.store('test', 'book', None, 10)
+        self.assertEqual(cache.get('test', 'book', None), None)
+
+
+class TestSyncStateCache(TestCase):
+    """Test the SyncStateCache."""
+
+    def setUp(self):
+        self.cache = SyncStateCache()
+        self.cache.store('test', {'book': 5, 'author': 3},
+                         ['book', 'author', 'series'])
+
+    def test_get(self):
+        """Models without history are known, but not in the state."""
+        state, missing = self.cache.get('test',
+                                        ['book', 'series', 'edition'])
+        self.assertEqual(state, {'book': 5})
+        self.assertEqual(missing, ['edition'])
+
+    def test_advance(self):
+        """Written history moves the state on, never back."""
+        self.cache.advance('test', 'book', 7)
+        self.cache.advance('test', 'book', 6)
+        self.cache.advance('test', 'series', 2)
+        self.cache.advance('test', 'edition', 1)
+        state, missing = self.cache.get('test',
+                                        ['book', 'series', 'edition'])
+        self.assertEqual(state, {'book': 7, 'series': 2})
+        self.assertEqual(missing, ['edition'])
+
+    def test_racing_store_does_not_go_back(self):
+        """A query that started before a write does not undo it."""
+        self.cache.advance('test', 'book', 7)
+        self.cache.store('test', {'book': 5}, ['book'])
+        self.assertEqual(self.cache.get('test', ['book'])[0], {'book': 7})
+
+    def test_models(self):
+        """The models of an app are dropped when models are written."""
+        generation = self.cache.generation('test')
+        self.cache.store_models('test', 'app', ['book'], generation)
+        self.assertEqual(self.cache.get_models('test', 'app'), ['book'])
+        self.cache.invalidate_models('test')
+        self.assertEqual(self.cache.get_models('test', 'app'), None)
+        self.cache.store_models('test', 'app', ['book'], generation)
+        self.assertEqual(self.cache.get_models('test', 'app'), None)
+
+    def test_ttl(self):
+        """Old states are checked again."""
+        cache = SyncStateCache(ttl=-1)
+        cache.store('test', {'book': 5}, ['book'])
+        self.assertEqual(cache.get('test', ['book']), ({}, ['book']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Test changes.py."""
+
+from datetime import datetime, timedelta
+from unittest import TestCase, main
+from bson.objectid import ObjectId
+from magpy.server.changes import ChangeFeed, format_event
+
+# pylint: disable=R0904
+
+
+class ChangeFeedTestCase(TestCase):
+    """Test the change feed."""
+
+    def test_format_event(self):
+        """Events have an id and a type if given."""
+        self.assertEqual(format_event('{}'), 'data: {}\n\n')
+        self.assertEqual(format_event('{"a":1}', 'change', 'abc'),
+                         'id: abc\nevent: change\ndata: {"a":1}\n\n')
+
+    def test_new_entries(self):
+        """Entries seen by an earlier poll are not passed on again."""
+        feed = ChangeFeed(None, None)
+        first = feed.new_entries('test', [{'_id': 1}, {'_id': 2}])
+        self.assertEqual(first, [{'_id': 1}, {'_id': 2}])
+        second = feed.new_entries('test', [{'_id': 2}, {'_id': 3}])
+        self.assertEqual(second, [{'_id': 3}])
+        other = feed.new_entries('other', [{'_id': 2}])
+        self.assertEqual(other, [{'_id': 2}])
+
+    def test_seen_expire(self):
+        """Ids are forgotten once polls start after them."""
+        feed = ChangeFeed(None, None)
+        feed.new_entries('test', [{'_id': 1}])
+        self.assertEqual(feed.new_entries('test', [{'_id': 1}], 1), [])
+        self.assertEqual(feed.new_entries('test', [{'_id': 1}], 2),
+                         [{'_id': 1}])
+
+    def test_since(self):
+        """Polls go back to the oldest history still being written."""
+        class FakeWriter(object):
+            """Has some history waiting."""
+            oldest = {}
+
+            def oldest_unwritten(self, database_name):
+                """The oldest waiting id."""
+                return self.oldest.get(database_name)
+
+        writer = FakeWriter()
+        feed = ChangeFeed(None, None, lookback=5, history_writer=writer)
+        recent = ObjectId.from_datetime(
+            datetime.utcnow() - timedelta(seconds=6))
+        self.assertTrue(feed.since('test') > recent)
+
+        old = ObjectId.from_datetime(
+            datetime.utcnow() - timedelta(seconds=60))
+        feed.writing('test', [old])
+        self.assertEqual(feed.since('test'), old)
+        feed.written('test', [old])
+        self.assertTrue(feed.since('test') > recent)
+
+        writer.oldest['test'] = old
+        self.assertEqual(feed.since('test'), old)
+        self.assertTrue(feed.since('other') > recent)
+
+
+if __name__ == '__main__':
+    main()
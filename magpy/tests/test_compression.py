@@ -0,0 +1,124 @@
+"""Test compression.py."""
+
+import gzip
+import zlib
+from io import BytesIO
+from unittest import TestCase, main
+from magpy.server.compression import accepted_encodings, choose_encoding, \
+    CompressionTransform
+
+# pylint: disable=R0904
+
+JSON_TYPE = 'application/json; charset=UTF-8'
+
+
+class FakeRequest(object):
+    """Just the headers of a request."""
+    def __init__(self, accept_encoding=None):
+        self.headers = {}
+        if accept_encoding is not None:
+            self.headers['Accept-Encoding'] = accept_encoding
+
+
+def gunzip(data):
+    """Decompress gzip data."""
+    return gzip.GzipFile(fileobj=BytesIO(data)).read()
+
+
+class TestEncodings(TestCase):
+    """Test reading Accept-Encoding."""
+
+    def test_accepted(self):
+        """Encodings with a q of 0 are not accepted."""
+        self.assertEqual(accepted_encodings('gzip, deflate;q=0.5, br;q=0'),
+                         set(['gzip', 'deflate']))
+        self.assertEqual(accepted_encodings(None), set())
+
+    def test_choose(self):
+        """Gzip when brotli is not wanted."""
+        self.assertEqual(choose_encoding('gzip, br', use_brotli=False),
+                         'gzip')
+        self.assertEqual(choose_encoding('identity'), None)
+
+
+class TestCompressionTransform(TestCase):
+    """Test compressing responses."""
+
+    def test_whole_response(self):
+        """A big enough JSON response is gzipped."""
+        transform = CompressionTransform(FakeRequest('gzip'),
+                                         use_brotli=False)
+        body = b'{"results": [' + b'{"a": 1}, ' * 200 + b'{}]}'
+        headers = {'Content-Type': JSON_TYPE,
+                   'Content-Length': str(len(body))}
+        status, headers, chunk = transform.transform_first_chunk(
+            200, headers, body, True)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Content-Length'], str(len(chunk)))
+        self.assertTrue(len(chunk) < len(body) / 5)
+        self.assertEqual(gunzip(chunk), body)
+
+    def test_small_response(self):
+        """Small responses are left alone."""
+        transform = CompressionTransform(FakeRequest('gzip'))
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': JSON_TYPE}, b'{}', True)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(chunk, b'{}')
+
+    def test_not_text(self):
+        """Images and the like are left alone."""
+        transform = CompressionTransform(FakeRequest('gzip'))
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': 'image/png'}, b'x' * 2000, True)
+        self.assertFalse('Content-Encoding' in headers)
+
+    def test_no_transform(self):
+        """Responses marked no-transform, like media files, are left
+        alone, even when they are text."""
+        transform = CompressionTransform(FakeRequest('gzip'))
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': 'text/plain',
+                  'Cache-Control': 'private, no-cache, no-transform'},
+            b'x' * 2000, True)
+        self.assertFalse('Content-Encoding' in headers)
+
+    def test_weak_etag(self):
+        """A compressed response's ETag is weak, as its bytes differ."""
+        transform = CompressionTransform(FakeRequest('gzip'))
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': JSON_TYPE, 'Etag': '"abc"'},
+            b'x' * 2000, True)
+        self.assertEqual(headers['Etag'], 'W/"abc"')
+        transform = CompressionTransform(FakeRequest())
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': JSON_TYPE, 'Etag': '"abc"'},
+            b'x' * 2000, True)
+        self.assertEqual(headers['Etag'], '"abc"')
+
+    def test_not_accepted(self):
+        """Nothing is compressed unless the client accepts it."""
+        transform = CompressionTransform(FakeRequest())
+        status, headers, chunk = transform.transform_first_chunk(
+            200, {'Content-Type': JSON_TYPE}, b'x' * 2000, True)
+        self.assertFalse('Content-Encoding' in headers)
+
+    def test_streamed(self):
+        """Each chunk can be decompressed as soon as it arrives."""
+        transform = CompressionTransform(FakeRequest('gzip'),
+                                         use_brotli=False)
+        status, headers, first = transform.transform_first_chunk(
+            200, {'Content-Type': JSON_TYPE}, b'{"results": [', False)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(first), b'{"results": [')
+        second = transform.transform_chunk(b'{"a": 1}', False)
+        self.assertEqual(decompressor.decompress(second), b'{"a": 1}')
+        last = transform.transform_chunk(b']}', True)
+        self.assertEqual(decompressor.decompress(last), b']}')
+        self.assertTrue(decompressor.eof)
+
+
+if __name__ == '__main__':
+    main()
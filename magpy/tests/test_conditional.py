@@ -0,0 +1,43 @@
+"""Test conditional.py."""
+
+from datetime import datetime, timedelta
+from unittest import TestCase, main
+from bson.objectid import ObjectId
+from magpy.server.conditional import instance_etag, list_etag, etag_matches
+
+# pylint: disable=R0904
+
+
+class TestConditional(TestCase):
+    """Test the ETag helpers."""
+    def test_instance_etag(self):
+        """The ETag comes from the _id and version."""
+        self.assertEqual(
+            instance_etag({'_id': 'book1', '_meta': {'_version': 3}}),
+            '"book1-3"')
+        self.assertEqual(instance_etag({'_id': 'book1'}), None)
+
+    def test_list_etag(self):
+        """The list ETag changes with the history and the query."""
+        old = ObjectId.from_datetime(datetime.utcnow() - timedelta(hours=1))
+        newer = ObjectId.from_datetime(
+            datetime.utcnow() - timedelta(minutes=1))
+        self.assertEqual(list_etag(old, 'a=1'), list_etag(old, 'a=1'))
+        self.assertNotEqual(list_etag(old, 'a=1'), list_etag(old, 'a=2'))
+        self.assertNotEqual(list_etag(old, 'a=1'), list_etag(newer, 'a=1'))
+
+    def test_unsettled_list(self):
+        """A list that has just changed gets no ETag."""
+        self.assertEqual(list_etag(ObjectId(), ''), None)
+
+    def test_etag_matches(self):
+        """If-None-Match can hold several ETags."""
+        self.assertTrue(etag_matches('"a-1"', '"a-1"'))
+        self.assertTrue(etag_matches('"b-1", W/"a-1"', '"a-1"'))
+        self.assertTrue(etag_matches('*', '"a-1"'))
+        self.assertFalse(etag_matches('"a-2"', '"a-1"'))
+        self.assertFalse(etag_matches(None, '"a-1"'))
+
+
+if __name__ == '__main__':
+    main()
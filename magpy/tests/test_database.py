@@ -0,0 +1,61 @@
+"""Test the connection settings in database.py."""
+
+from unittest import TestCase, main
+from pymongo import ReadPreference
+from magpy.server.database import connection_options, \
+    read_preference_mode, with_write_concern
+
+# pylint: disable=R0904
+
+
+class OldCollection(object):
+    """A collection with a settable write concern, like pymongo 2."""
+    write_concern = None
+
+
+class TestConnectionOptions(TestCase):
+    """Test making the client options from the databases setting."""
+
+    def test_defaults(self):
+        """Just ENGINE and NAME gives the old behaviour."""
+        self.assertEqual(
+            connection_options({'ENGINE': 'mongodb', 'NAME': 'vmr'}),
+            {'tz_aware': True})
+
+    def test_options(self):
+        """All the settings become client options."""
+        options = connection_options({
+            'ENGINE': 'mongodb',
+            'NAME': 'vmr',
+            'HOST': 'db.example.com',
+            'PORT': '27018',
+            'OPTIONS': {'max_pool_size': 100},
+            'READ_PREFERENCE': 'secondaryPreferred',
+            'WRITE_CONCERN': {'w': 1, 'j': True}})
+        self.assertEqual(options['host'], 'db.example.com')
+        self.assertEqual(options['port'], 27018)
+        self.assertEqual(options['max_pool_size'], 100)
+        self.assertEqual(options['read_preference'],
+                         ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(options['w'], 1)
+        self.assertEqual(options['j'], True)
+
+    def test_read_preference_names(self):
+        """Both styles of name work."""
+        self.assertEqual(read_preference_mode('primaryPreferred'),
+                         ReadPreference.PRIMARY_PREFERRED)
+        self.assertEqual(read_preference_mode('NEAREST'),
+                         ReadPreference.NEAREST)
+        self.assertRaises(ValueError, read_preference_mode, 'somewhere')
+
+    def test_with_write_concern(self):
+        """The write concern is set on the collection."""
+        collection = OldCollection()
+        self.assertTrue(with_write_concern(collection, None) is collection)
+        self.assertEqual(
+            with_write_concern(collection, {'w': 0}).write_concern,
+            {'w': 0})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Test deltas.py."""
+
+from unittest import TestCase, main
+from magpy.server.deltas import make_delta, apply_delta, is_snapshot, \
+    rebuild_version
+
+# pylint: disable=R0904
+
+OLD = {'_id': 'emma',
+       '_model': 'book',
+       'title': 'Emma',
+       'subtitle': 'A Novel',
+       'author': {'name': 'Austen', 'born': 1775},
+       'pages': [1, 2, 3],
+       '_meta': {'_version': 1}}
+
+NEW = {'_id': 'emma',
+       '_model': 'book',
+       'title': 'Emma',
+       'author': {'name': 'Jane Austen', 'born': 1775},
+       'pages': [1, 2, 3, 4],
+       'year': 1815,
+       '_meta': {'_version': 2}}
+
+
+def entry(document=None, delta=None, version=None, base=None):
+    """A history entry."""
+    item = {'document_version': version}
+    if document is not None:
+        item['document'] = document
+    else:
+        item['delta'] = delta
+        item['base_version'] = base
+    return item
+
+
+class TestDeltas(TestCase):
+    """Test making and applying deltas."""
+
+    def test_make_delta(self):
+        """Only the changes are in the delta."""
+        delta = make_delta(OLD, NEW)
+        self.assertEqual(
+            sorted(delta['set']),
+            sorted([[['author', 'name'], 'Jane Austen'],
+                    [['pages'], [1, 2, 3, 4]],
+                    [['year'], 1815],
+                    [['_meta', '_version'], 2]]))
+        self.assertEqual(delta['unset'], [['subtitle']])
+
+    def test_apply_delta(self):
+        """Applying the delta gives the new document,
+        and leaves the old one alone."""
+        self.assertEqual(apply_delta(OLD, make_delta(OLD, NEW)), NEW)
+        self.assertEqual(OLD['title'], 'Emma')
+        self.assertTrue('subtitle' in OLD)
+
+    def test_new_embedded_document(self):
+        """A new embedded document is set whole."""
+        new = dict(OLD, publisher={'name': 'John Murray'})
+        self.assertEqual(apply_delta(OLD, make_delta(OLD, new)), new)
+
+    def test_is_snapshot(self):
+        """The first version, then every interval."""
+        self.assertEqual([number for number in range(1, 12)
+                          if is_snapshot(number, 5)],
+                         [1, 6, 11])
+        self.assertTrue(is_snapshot(None, 5))
+        self.assertTrue(is_snapshot(3, None))
+
+
+class TestRebuildVersion(TestCase):
+    """Test putting versions back together."""
+
+    def setUp(self):
+        self.versions = [dict(OLD, title='Emma %s' % number,
+                              _meta={'_version': number})
+                         for number in range(1, 8)]
+        self.entries = []
+        for number, document in enumerate(self.versions, 1):
+            if is_snapshot(number, 3):
+                self.entries.append(entry(document, version=number))
+            else:
+                self.entries.append(entry(delta=make_delta(
+                    self.versions[number - 2], document), version=number,
+                                          base=number - 1))
+
+    def test_every_version(self):
+        """Every version comes back as it was."""
+        for number, document in enumerate(self.versions, 1):
+            self.assertEqual(rebuild_version(self.entries, number), document)
+
+    def test_newest(self):
+        """Without a number, the newest version."""
+        self.assertEqual(rebuild_version(self.entries), self.versions[-1])
+
+    def test_missing(self):
+        """An unknown version gives None."""
+        self.assertEqual(rebuild_version(self.entries, 99), None)
+
+    def test_gap(self):
+        """Versions after a missing one cannot be rebuilt."""
+        entries = self.entries[:1] + self.entries[2:]
+        self.assertEqual(rebuild_version(entries, 1), self.versions[0])
+        self.assertEqual(rebuild_version(entries, 3), None)
+        # From the next snapshot on, they can
+        self.assertEqual(rebuild_version(entries, 5), self.versions[4])
+
+    def test_wrong_base(self):
+        """A delta made from another version is not applied,
+        e.g. one of two updates made at the same time."""
+        entries = self.entries[:2] + [entry(
+            delta=make_delta(self.versions[0], self.versions[2]),
+            version=3, base=1)]
+        self.assertEqual(rebuild_version(entries, 3), None)
+        # Both made from version 1
+        entries = self.entries[:2] + [entry(
+            delta=make_delta(self.versions[0], self.versions[1]),
+            version=2, base=1)]
+        self.assertEqual(rebuild_version(entries, 2), None)
+
+    def test_full_history(self):
+        """Old entries without document_version still work."""
+        entries = [{'document': document} for document in self.versions]
+        self.assertEqual(rebuild_version(entries, 4), self.versions[3])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""Test history.py."""
+
+from unittest import TestCase, main
+from magpy.server.history import HistoryWriter
+from magpy.server.database import DatabaseMixin
+
+# pylint: disable=R0904
+
+
+class FakeIOLoop(object):
+    """Keeps the timeouts rather than running them."""
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        """Remember the callback."""
+        self.timeouts.append(callback)
+        return callback
+
+    def remove_timeout(self, timeout):
+        """Forget the callback."""
+        self.timeouts.remove(timeout)
+
+
+class FakeCursor(object):
+    """Keeps the query, to be answered later."""
+    def __init__(self, collection, spec):
+        self.collection = collection
+        self.spec = spec
+
+    def to_list(self, length, callback):
+        """Remember the query."""
+        self.collection.finds.append((self.spec, callback))
+
+
+class FakeCollection(object):
+    """Keeps the inserts and finds, to be answered later."""
+    def __init__(self):
+        self.inserts = []
+        self.finds = []
+
+    def insert(self, documents, callback, **kwargs):
+        """Remember the insert."""
+        self.inserts.append((documents, callback))
+
+    def find(self, spec, **kwargs):
+        """Remember the find."""
+        return FakeCursor(self, spec)
+
+
+class FakeConnection(dict):
+    """Databases of collections."""
+    def __missing__(self, key):
+        self[key] = {'_history': FakeCollection()}
+        return self[key]
+
+
+def version(model, document_id):
+    """A minimal version."""
+    return {'_id': 'h' + document_id,
+            'document_model': model,
+            'document_id': document_id,
+            'document': {'_id': document_id, '_model': model}}
+
+
+class TestHistoryWriter(TestCase):
+    """Test writing the history in batches."""
+
+    def setUp(self):
+        self.connection = FakeConnection()
+        self.ioloop = FakeIOLoop()
+        self.answers = []
+
+    def answer(self, response, error):
+        """Record the callback."""
+        self.answers.append(error)
+
+    def test_write_behind(self):
+        """Requests are answered at once, the versions written later."""
+        writer = HistoryWriter(self.connection, self.ioloop)
+        writer.add('vmr', version('book', '1'), self.answer)
+        writer.add('vmr', [version('book', '2'), version('author', '3')],
+                   self.answer)
+        self.assertEqual(self.answers, [None, None])
+        self.assertTrue(writer.pending('vmr', 'author'))
+        self.assertFalse(writer.pending('vmr', 'page'))
+        self.assertEqual(len(self.ioloop.timeouts), 1)
+
+        self.ioloop.timeouts[0]()
+        inserts = self.connection['vmr']['_history'].inserts
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([item['document_id'] for item in inserts[0][0]],
+                         ['1', '2', '3'])
+        self.assertFalse(writer.pending('vmr', 'author'))
+
+    def test_group(self):
+        """In group mode, requests wait for their batch."""
+        writer = HistoryWriter(self.connection, self.ioloop, wait=True)
+        writer.add('vmr', version('book', '1'), self.answer)
+        writer.add('vmr', version('book', '2'), self.answer)
+        self.assertEqual(self.answers, [])
+        writer.flush()
+        documents, callback = self.connection['vmr']['_history'].inserts[0]
+        self.assertEqual(len(documents), 2)
+        callback(None, None)
+        self.assertEqual(self.answers, [None, None])
+
+    def test_oldest_unwritten(self):
+        """The oldest version not yet written, queued or in flight."""
+        writer = HistoryWriter(self.connection, self.ioloop)
+        self.assertEqual(writer.oldest_unwritten('vmr'), None)
+        writer.add('vmr', version('book', '2'), self.answer)
+        writer.flush()
+        writer.add('vmr', version('book', '3'), self.answer)
+        self.assertEqual(writer.oldest_unwritten('vmr'), 'h2')
+        self.connection['vmr']['_history'].inserts[0][1](None, None)
+        self.assertEqual(writer.oldest_unwritten('vmr'), 'h3')
+
+    def test_batch_size(self):
+        """A full batch is written straight away."""
+        writer = HistoryWriter(self.connection, self.ioloop, batch_size=2)
+        writer.add('vmr', version('book', '1'), self.answer)
+        self.assertEqual(self.connection['vmr']['_history'].inserts, [])
+        writer.add('vmr', version('book', '2'), self.answer)
+        self.assertEqual(len(self.connection['vmr']['_history'].inserts), 1)
+        self.assertEqual(self.ioloop.timeouts, [])
+
+    def test_retry(self):
+        """A failed write behind is tried again."""
+        writer = HistoryWriter(self.connection, self.ioloop)
+        writer.add('vmr', version('book', '1'), self.answer)
+        writer.flush()
+        history = self.connection['vmr']['_history']
+        documents, callback = history.inserts[0]
+        callback(None, Exception('Gone away'))
+        # It asks which were written before putting them back
+        spec, callback = history.finds[0]
+        self.assertEqual(spec, {'_id': {'$in': ['h1']}})
+        callback([], None)
+        self.assertTrue(writer.pending('vmr', 'book'))
+        self.assertEqual(len(self.ioloop.timeouts), 1)
+
+    def test_partial_retry(self):
+        """Only the versions that were not written are tried again."""
+        writer = HistoryWriter(self.connection, self.ioloop)
+        writer.add('vmr', [version('book', '1'), version('author', '2')],
+                   self.answer)
+        writer.flush()
+        history = self.connection['vmr']['_history']
+        history.inserts[0][1](None, Exception('Duplicate'))
+        history.finds[0][1]([{'_id': 'h1'}], None)
+        self.assertFalse(writer.pending('vmr', 'book'))
+        self.assertTrue(writer.pending('vmr', 'author'))
+        self.ioloop.timeouts[0]()
+        self.assertEqual([item['_id'] for item in history.inserts[1][0]],
+                         ['h2'])
+
+    def test_max_retries(self):
+        """A batch that keeps failing is given up on."""
+        writer = HistoryWriter(self.connection, self.ioloop, max_retries=2)
+        writer.add('vmr', version('book', '1'), self.answer)
+        history = self.connection['vmr']['_history']
+        # The first write and two retries
+        for attempt in range(3):
+            writer.flush()
+            history.inserts[attempt][1](None, Exception('Gone away'))
+            history.finds[attempt][1]([], None)
+        self.assertFalse(writer.pending('vmr', 'book'))
+        self.assertTrue(writer.take_dropped('vmr', 'book', '1'))
+        self.assertFalse(writer.take_dropped('vmr', 'book', '2'))
+
+    def test_max_queued(self):
+        """Failed batches beyond the limit are dropped."""
+        writer = HistoryWriter(self.connection, self.ioloop, max_queued=1)
+        writer.add('vmr', [version('book', '1'), version('book', '2')],
+                   self.answer)
+        writer.flush()
+        history = self.connection['vmr']['_history']
+        history.inserts[0][1](None, Exception('Gone away'))
+        history.finds[0][1]([], None)
+        self.assertFalse(writer.pending('vmr', 'book'))
+        self.assertEqual(writer._queues, {})
+        # The next versions of both are to be kept whole
+        self.assertTrue(writer.take_dropped('vmr', 'book', '1'))
+        self.assertTrue(writer.take_dropped('vmr', 'book', '2'))
+        self.assertFalse(writer.take_dropped('vmr', 'book', '1'))
+
+    def test_flush_callback(self):
+        """The flush callback waits for the inserts."""
+        flushed = []
+        writer = HistoryWriter(self.connection, self.ioloop)
+        writer.add('vmr', version('book', '1'), self.answer)
+        writer.flush(lambda: flushed.append(True))
+        self.assertEqual(flushed, [])
+        documents, callback = self.connection['vmr']['_history'].inserts[0]
+        callback(None, None)
+        self.assertEqual(flushed, [True])
+
+
+class FakeApplication(object):
+    """Only has a history writer."""
+    def __init__(self, history_writer):
+        self.history_writer = history_writer
+
+
+class DeltaHistoryHandler(DatabaseMixin):
+    """Stores the history as deltas through the writer."""
+    # pylint: disable=R0903
+    settings = {'history_storage': 'delta',
+                'history_snapshot_interval': 20}
+    _database_name = 'vmr'
+
+    def __init__(self, writer):
+        self.application = FakeApplication(writer)
+
+
+class TestDroppedVersions(TestCase):
+    """After a version is dropped, the next one is kept whole."""
+
+    def test_snapshot_after_drop(self):
+        """The next update of the instance is not a delta."""
+        connection = FakeConnection()
+        writer = HistoryWriter(connection, FakeIOLoop(), max_retries=0)
+        handler = DeltaHistoryHandler(writer)
+        previous = {'_id': '1', '_model': 'book', 'title': 'Emma',
+                    '_meta': {'_version': 2}}
+        instance = dict(previous, title='Persuasion',
+                        _meta={'_version': 3})
+        handler.update_history(instance, 'update',
+                               lambda response, error: None,
+                               previous=previous)
+        writer.flush()
+        history = connection['vmr']['_history']
+        self.assertTrue('delta' in history.inserts[0][0][0])
+        history.inserts[0][1](None, Exception('Gone away'))
+        history.finds[0][1]([], None)
+
+        following = dict(instance, title='Sense', _meta={'_version': 4})
+        other = {'_id': '2', '_model': 'book', 'title': 'Emma',
+                 '_meta': {'_version': 2}}
+        handler.update_history(
+            [following, dict(other, _meta={'_version': 3})], 'update',
+            lambda response, error: None,
+            previous=[instance, other])
+        writer.flush()
+        versions = history.inserts[1][0]
+        self.assertEqual(versions[0]['document'], following)
+        self.assertTrue('delta' in versions[1])
+        # Only the one after the drop
+        handler.update_history(dict(following, _meta={'_version': 5}),
+                               'update', lambda response, error: None,
+                               previous=following)
+        writer.flush()
+        self.assertTrue('delta' in history.inserts[2][0][0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Test indexes.py."""
+
+from unittest import TestCase, main
+from pymongo.errors import DuplicateKeyError
+from magpy.server.indexes import model_indexes, sync_indexes, index_name
+
+# pylint: disable=R0904
+
+BOOK_MODEL = {
+    '_id': 'book',
+    '_model': '_model',
+    'modeldescription': 'A book.',
+    'title': {'field': 'Char', 'index': True},
+    'isbn': {'field': 'Char', 'unique': True},
+    'year': {'field': 'Integer', 'index': -1},
+    'blurb': {'field': 'Text', 'index': False},
+    '_indexes': [{'fields': [['author', 1], ['year', -1]],
+                  'unique': True}]}
+
+
+class FakeCollection(object):
+    """Keeps index information like a pymongo collection."""
+    def __init__(self, indexes=None):
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+        self.indexes.update(indexes or {})
+
+    def index_information(self):
+        """Return the indexes."""
+        return dict(self.indexes)
+
+    duplicates = ()
+
+    def create_index(self, keys, name, unique=False, background=False):
+        """Add an index, unless it is unique over duplicate values."""
+        # pylint: disable=W0613
+        if unique and keys[0][0] in self.duplicates:
+            raise DuplicateKeyError('E11000 duplicate key error')
+        self.indexes[name] = {'key': keys, 'unique': unique}
+
+    def drop_index(self, name):
+        """Remove an index."""
+        del self.indexes[name]
+
+
+class TestIndexes(TestCase):
+    """Test creating indexes from models."""
+    def test_model_indexes(self):
+        """Fields and _indexes are both used."""
+        indexes = model_indexes(BOOK_MODEL)
+        self.assertEqual(len(indexes), 4)
+        self.assertTrue({'fields': [('title', 1)], 'unique': False}
+                        in indexes)
+        self.assertTrue({'fields': [('isbn', 1)], 'unique': True}
+                        in indexes)
+        self.assertTrue({'fields': [('year', -1)], 'unique': False}
+                        in indexes)
+        self.assertTrue({'fields': [('author', 1), ('year', -1)],
+                         'unique': True} in indexes)
+
+    def test_create(self):
+        """Missing indexes are created, existing ones are left."""
+        collection = FakeCollection(
+            {'title_1': {'key': [('title', 1)]}})
+        report = sync_indexes(collection, model_indexes(BOOK_MODEL))
+        self.assertEqual(sorted(report), [
+            ('created', 'magpy_author_1_year_-1'),
+            ('created', 'magpy_isbn_1'),
+            ('created', 'magpy_year_-1')])
+        self.assertEqual(sync_indexes(collection,
+                                      model_indexes(BOOK_MODEL)), [])
+
+    def test_drop(self):
+        """Only our own indexes are dropped."""
+        collection = FakeCollection(
+            {'magpy_old_1': {'key': [('old', 1)]},
+             'other_1': {'key': [('other', 1)]}})
+        report = sync_indexes(collection, [])
+        self.assertEqual(report, [('dropped', 'magpy_old_1')])
+        self.assertTrue('other_1' in collection.indexes)
+        self.assertEqual(sync_indexes(FakeCollection(
+            {'magpy_old_1': {'key': [('old', 1)]}}), [], drop=False), [])
+
+    def test_unique_changed(self):
+        """Changing uniqueness remakes the index."""
+        name = index_name([('isbn', 1)])
+        collection = FakeCollection({name: {'key': [('isbn', 1)]}})
+        report = sync_indexes(collection,
+                              [{'fields': [('isbn', 1)], 'unique': True}])
+        self.assertEqual(report, [('dropped', name), ('created', name)])
+        self.assertTrue(collection.indexes[name]['unique'])
+
+    def test_create_fails(self):
+        """An index that cannot be made does not stop the others."""
+        collection = FakeCollection()
+        collection.duplicates = ('isbn',)
+        report = sync_indexes(collection, model_indexes(BOOK_MODEL))
+        self.assertTrue(('conflict', 'magpy_isbn_1') in report)
+        self.assertTrue(('created', 'magpy_year_-1') in report)
+        self.assertFalse('magpy_isbn_1' in collection.indexes)
+
+
+if __name__ == '__main__':
+    main()
@@ -294,12 +294,10 @@ class MagUnderscoreRestTestCase(MagTestCase):
             'title: "Dr"});')
         # get the data out again
         data_string = self.eval(
-            'localStorage["api:http://localhost/api/author/Suess/"]')
+            'JSON.stringify(MAG._CACHE._entries['
+            '"api:http://localhost/api/author/Suess/"])')
         # Decode it back to JSON
         data = json.loads(data_string)
-        # Check the type member
-        self.assertEqual(data['type'],
-                         "json")
         # Check the _model
         self.assertEqual(data['data']['_model'],
                          "author")
@@ -325,13 +323,11 @@ class MagUnderscoreRestTestCase(MagTestCase):
             ']}, "author", {category:"science_fiction"})')
         # Get the data out again
         data_string = self.eval(
-            'localStorage["api:http://localhost/api/author/?category='
-            'science_fiction"]')
+            'JSON.stringify(MAG._CACHE._entries['
+            '"api:http://localhost/api/author/?category='
+            'science_fiction"])')
         # Decode it back to JSON
         data = json.loads(data_string)
-        # Check the type member
-        self.assertEqual(data['type'],
-                         "json")
         # Check the _model of the first entry
         self.assertEqual(data['data']['results'][0]['_model'],
                          "author")
@@ -362,22 +358,78 @@ class MagUnderscoreRestTestCase(MagTestCase):
             'title: "Dr"});')
         # check the data is in
         data_string = self.eval(
-            'localStorage["api:http://localhost/api/author/Suess/"]')
-        self.assertIs(data_string.startswith('{"type":"json"'), True)
+            'typeof MAG._CACHE._entries["api:http://localhost/api/author/'
+            'Suess/"] === "object"')
+        self.assertIs(data_string, True)
         # delete the data
         self.eval(
             'MAG._REST.delete_api_data({_model: "author", "_id": "Suess", '
             'title: "Dr"});')
         #delete_api_data
         data_string = self.eval(
-            'typeof localStorage["api:http://localhost/api/author/'
+            'typeof MAG._CACHE._entries["api:http://localhost/api/author/'
             'Suess/"] === "undefined"')
-        data_string_text = self.eval(
-            'localStorage["api:http://localhost/api/author/Suess/"]')
 
         self.assertIs(data_string, True)
 
 
+class MagCacheTestCase(MagTestCase):
+    """Test the _CACHE submodule."""
+    def setUp(self):  # pylint: disable=C0103
+        super(MagCacheTestCase, self).setUp()
+        self.eval(
+            'MAG._CACHE.put("api:http://localhost/api/author/Suess/", '
+            '{_model: "author", _id: "Suess", _meta: {_version: 2}}, '
+            '\'"abc"\');'
+            'MAG._CACHE.put("api:http://localhost/api/author/?_limit=2", '
+            '{results: []}, \'"def"\');'
+            'MAG._CACHE.put("api:http://localhost/api/book/", '
+            '{results: []});')
+
+    def cached(self):
+        """The keys of the responses in memory."""
+        return sorted(self.eval('Object.keys(MAG._CACHE._entries);'))
+
+    def test_put(self):
+        """Responses are kept with their ETag and version."""
+        self.assertEqual(
+            self.eval('MAG._CACHE._entries["api:http://localhost/api/'
+                      'author/Suess/"].etag;'),
+            '"abc"')
+        self.assertEqual(
+            self.eval('MAG._CACHE._entries["api:http://localhost/api/'
+                      'author/Suess/"].version;'),
+            2)
+
+    def test_same_version_is_kept(self):
+        """A sync change to the version we have keeps the instance,
+        but the lists of the resource are forgotten."""
+        self.eval('MAG._CACHE.resource_changed("author", '
+                  '[{document_id: "Suess", document: {_id: "Suess", '
+                  '_meta: {_version: 2}}}]);')
+        self.assertEqual(self.cached(),
+                         ['api:http://localhost/api/author/Suess/',
+                          'api:http://localhost/api/book/'])
+
+    def test_write_forgets_resource(self):
+        """Writing to a resource forgets everything about it."""
+        self.eval('MAG._CACHE.url_changed('
+                  '"http://localhost/api/author/Suess/");')
+        self.assertEqual(self.cached(),
+                         ['api:http://localhost/api/book/'])
+
+    def test_least_recently_used_is_dropped(self):
+        """Only max_entries responses are kept in memory."""
+        self.eval('MAG._CACHE.max_entries = 2;'
+                  'MAG._CACHE.get("api:http://localhost/api/author/Suess/", '
+                  'function () {});'
+                  'MAG._CACHE.put("api:http://localhost/api/series/", '
+                  '{results: []});')
+        self.assertEqual(self.cached(),
+                         ['api:http://localhost/api/author/Suess/',
+                          'api:http://localhost/api/series/'])
+
+
 def open_test_collection(collection='test',
                          database_name='test'):
     """Open the MongoDB Database."""
@@ -0,0 +1,164 @@
+"""Test media.py."""
+
+import os
+import base64
+import shutil
+import tempfile
+from unittest import TestCase, main
+import hashlib
+from magpy.server.media import parse_data_uri, media_url, media_path, \
+    write_files, write_many_files, delete_files, replace_files, \
+    content_type_extension, MediaUpload, resource_media_path
+
+# pylint: disable=R0904
+
+PNG_DATA = b'\x89PNG not really'
+PNG_URI = 'data:image/png;base64,' + \
+    base64.b64encode(PNG_DATA).decode('ascii')
+
+
+class TestMediaFiles(TestCase):
+    """Test writing and deleting media files."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def test_parse_data_uri(self):
+        """Get the extension and the content."""
+        extension, content = parse_data_uri(PNG_URI)
+        self.assertEqual(extension, 'png')
+        self.assertEqual(base64.b64decode(content), PNG_DATA)
+        self.assertRaises(ValueError, parse_data_uri, 'nonsense,data')
+        self.assertRaises(ValueError, parse_data_uri,
+                          'data:image/../../b/x;base64,' + content)
+
+    def test_media_path(self):
+        """Media URLs are kept under the media root."""
+        self.assertEqual(media_path(self.media_root, '/media/scan/1_image.png'),
+                         os.path.join(self.media_root, 'scan', '1_image.png'))
+        self.assertRaises(ValueError, media_path, self.media_root,
+                          '/media/../../etc/passwd')
+        self.assertRaises(ValueError, media_path, self.media_root,
+                          '/etc/passwd')
+
+    def test_resource_media_path(self):
+        """A resource's files cannot reach another resource's."""
+        self.assertEqual(
+            resource_media_path(self.media_root, 'a', 'x/../file.txt'),
+            'a/file.txt')
+        for path in ('../b/file.txt', 'x/../../b/file.txt', '..',
+                     '/etc/passwd', ''):
+            self.assertRaises(ValueError, resource_media_path,
+                              self.media_root, 'a', path)
+        # Nor can a symbolic link
+        os.makedirs(os.path.join(self.media_root, 'a'))
+        os.makedirs(os.path.join(self.media_root, 'b'))
+        os.symlink(os.path.join(self.media_root, 'b'),
+                   os.path.join(self.media_root, 'a', 'link'))
+        self.assertRaises(ValueError, resource_media_path,
+                          self.media_root, 'a', 'link/file.txt')
+
+    def test_write_and_delete(self):
+        """Write the files of an instance then delete them."""
+        instance = {'_model': 'scan', '_id': '1'}
+        instance['image'] = media_url(instance, 'image', 'png')
+        write_files(self.media_root, instance, {'image': PNG_URI})
+        path = media_path(self.media_root, instance['image'])
+        with open(path, 'rb') as media_file:
+            self.assertEqual(media_file.read(), PNG_DATA)
+        delete_files(self.media_root, 'scan', [instance['image'], None])
+        self.assertFalse(os.path.exists(path))
+
+    def test_replace(self):
+        """The old file goes and the new one is written."""
+        instance = {'_model': 'scan', '_id': '1'}
+        instance['image'] = media_url(instance, 'image', 'png')
+        write_files(self.media_root, instance, {'image': PNG_URI})
+        old_url = instance['image']
+        instance['image'] = media_url(instance, 'image', 'jpeg')
+        replace_files(self.media_root, instance,
+                      {'image': PNG_URI.replace('png', 'jpeg')}, [old_url])
+        self.assertFalse(os.path.exists(
+            media_path(self.media_root, old_url)))
+        self.assertTrue(os.path.exists(
+            media_path(self.media_root, instance['image'])))
+
+    def test_write_inside_resource(self):
+        """An instance's files cannot be written or deleted outside
+        its resource's directory."""
+        os.makedirs(os.path.join(self.media_root, 'other'))
+        victim = os.path.join(self.media_root, 'other', '1_image.png')
+        with open(victim, 'wb') as media_file:
+            media_file.write(b'keep')
+        instance = {'_model': 'scan', '_id': '../other/1'}
+        instance['image'] = media_url(instance, 'image', 'png')
+        self.assertRaises(ValueError, write_files, self.media_root,
+                          instance, {'image': PNG_URI})
+        self.assertRaises(ValueError, delete_files, self.media_root,
+                          'scan', [instance['image']])
+        self.assertRaises(ValueError, delete_files, self.media_root,
+                          'scan', ['/media/other/1_image.png'])
+        with open(victim, 'rb') as media_file:
+            self.assertEqual(media_file.read(), b'keep')
+
+    def test_write_many(self):
+        """Each instance's error is returned."""
+        good = {'_model': 'scan', '_id': '1', 'image': '/media/scan/1.png'}
+        bad = {'_model': 'scan', '_id': '2', 'image': '/media/scan/2.png'}
+        errors = write_many_files(self.media_root,
+                                  [(good, {'image': PNG_URI}),
+                                   (bad, {'image': 'nonsense,data'})])
+        self.assertEqual(errors[0], None)
+        self.assertTrue(errors[1])
+
+
+    def test_content_type_extension(self):
+        """Uploads get their extension from the Content-Type."""
+        self.assertEqual(content_type_extension('image/png'), 'png')
+        self.assertEqual(content_type_extension('image/tiff; q=1'), 'tiff')
+        self.assertEqual(content_type_extension('image/../x'), 'bin')
+        self.assertEqual(content_type_extension(None), 'bin')
+
+    def test_upload(self):
+        """An upload is only in place when it is finished."""
+        path = os.path.join(self.media_root, 'scan', '1_image.tiff')
+        upload = MediaUpload(path)
+        upload.write(b'part one, ')
+        upload.write(b'part two')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(upload.finish(),
+                         hashlib.sha256(b'part one, part two').hexdigest())
+        self.assertEqual(upload.size, 18)
+        with open(path, 'rb') as media_file:
+            self.assertEqual(media_file.read(), b'part one, part two')
+
+    def test_closed_upload(self):
+        """A closed upload is not in place until it is finished,
+        and can still be thrown away."""
+        path = os.path.join(self.media_root, 'scan', '1_image.tiff')
+        upload = MediaUpload(path)
+        with open(path, 'wb') as media_file:
+            media_file.write(b'old')
+        upload.write(b'new')
+        self.assertEqual(upload.close(), hashlib.sha256(b'new').hexdigest())
+        with open(path, 'rb') as media_file:
+            self.assertEqual(media_file.read(), b'old')
+        upload.abort()
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['1_image.tiff'])
+        with open(path, 'rb') as media_file:
+            self.assertEqual(media_file.read(), b'old')
+
+    def test_aborted_upload(self):
+        """An aborted upload leaves nothing behind."""
+        path = os.path.join(self.media_root, 'scan', '1_image.tiff')
+        upload = MediaUpload(path)
+        upload.write(b'part one')
+        upload.abort()
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Test paging.py."""
+
+from datetime import datetime
+from unittest import TestCase, main
+from bson.objectid import ObjectId
+from magpy.server.paging import paging_sort, make_after_token, \
+    parse_after_token, after_spec, add_after_to_spec, include_sort_fields
+
+# pylint: disable=R0904
+
+
+class TestPaging(TestCase):
+    """Test keyset pagination."""
+    def test_paging_sort(self):
+        """The sort always ends with _id."""
+        self.assertEqual(paging_sort(), [('_id', 1)])
+        self.assertEqual(paging_sort('name'), [('name', 1), ('_id', 1)])
+        self.assertEqual(paging_sort([['name', -1]]),
+                         [('name', -1), ('_id', 1)])
+        self.assertEqual(paging_sort([['_id', -1]]), [('_id', -1)])
+
+    def test_token_round_trip(self):
+        """The values come back out of the token, types and all."""
+        sort = [('meta.created', -1), ('_id', 1)]
+        created = datetime(2013, 5, 1, 12, 30)
+        document = {'_id': ObjectId('51c1a5a1e138235e1d7c3f39'),
+                    'meta': {'created': created}}
+        token = make_after_token(document, sort)
+        values = parse_after_token(token, sort)
+        self.assertEqual(values[0].replace(tzinfo=None), created)
+        self.assertEqual(values[1], document['_id'])
+        self.assertEqual(parse_after_token(token.encode('ascii'), sort),
+                         values)
+
+    def test_bad_token(self):
+        """Tokens that are not ours are refused."""
+        sort = [('_id', 1)]
+        self.assertRaises(ValueError, parse_after_token, 'not a token', sort)
+        token = make_after_token({'_id': 1, 'name': 'x'},
+                                 [('name', 1), ('_id', 1)])
+        self.assertRaises(ValueError, parse_after_token, token, sort)
+        # Same length, different sort
+        self.assertRaises(ValueError, parse_after_token, token,
+                          [('title', 1), ('_id', 1)])
+        self.assertRaises(ValueError, parse_after_token, token,
+                          [('name', -1), ('_id', 1)])
+
+    def test_after_spec(self):
+        """The query continues after the last document."""
+        self.assertEqual(after_spec([('_id', -1)], [5]),
+                         {'_id': {'$lt': 5}})
+        self.assertEqual(
+            after_spec([('name', 1), ('_id', 1)], ['bob', 5]),
+            {'$or': [{'name': {'$gt': 'bob'}},
+                     {'name': 'bob', '_id': {'$gt': 5}}]})
+
+    def test_after_null(self):
+        """Null and missing values sort first, so are asked for apart."""
+        self.assertEqual(
+            after_spec([('name', 1), ('_id', 1)], [None, 5]),
+            {'$or': [{'name': {'$ne': None}},
+                     {'name': None, '_id': {'$gt': 5}}]})
+        self.assertEqual(
+            after_spec([('name', -1), ('_id', 1)], [None, 5]),
+            {'name': None, '_id': {'$gt': 5}})
+        self.assertEqual(
+            after_spec([('name', -1), ('_id', 1)], ['bob', 5]),
+            {'$or': [{'$or': [{'name': {'$lt': 'bob'}}, {'name': None}]},
+                     {'name': 'bob', '_id': {'$gt': 5}}]})
+
+    def test_pages_with_nulls(self):
+        """Paging through documents, some without the sort key,
+        gives each document once."""
+        documents = [{'_id': 1, 'name': 'b'}, {'_id': 2},
+                     {'_id': 3, 'name': 'a'}, {'_id': 4, 'name': None},
+                     {'_id': 5, 'name': 'b'}]
+
+        def matches(document, spec):
+            """Enough of MongoDB's matching for after_spec."""
+            for key, condition in spec.items():
+                if key == '$or':
+                    if not any(matches(document, part)
+                               for part in condition):
+                        return False
+                    continue
+                value = document.get(key)
+                if isinstance(condition, dict):
+                    operator, operand = list(condition.items())[0]
+                    if operator == '$ne':
+                        if value == operand:
+                            return False
+                    elif value is None or \
+                            (operator == '$gt' and not value > operand) or \
+                            (operator == '$lt' and not value < operand):
+                        return False
+                elif value != condition:
+                    return False
+            return True
+
+        for direction in (1, -1):
+            sort = [('name', direction), ('_id', 1)]
+            ordered = sorted(
+                documents,
+                key=lambda document: (document.get('name') is not None,
+                                      document.get('name') or '',
+                                      document['_id'] * direction),
+                reverse=direction < 0)
+            seen = []
+            last = None
+            while True:
+                page = [document for document in ordered if last is None or
+                        matches(document, after_spec(sort, last))][:2]
+                if not page:
+                    break
+                seen.extend(document['_id'] for document in page)
+                last = parse_after_token(make_after_token(page[-1], sort),
+                                         sort)
+            self.assertEqual(seen, [document['_id'] for document in ordered])
+
+    def test_add_after_to_spec(self):
+        """Existing criteria are kept."""
+        self.assertEqual(
+            add_after_to_spec({'kind': 'book'}, [('_id', 1)], [5]),
+            {'$and': [{'kind': 'book'}, {'_id': {'$gt': 5}}]})
+        self.assertEqual(add_after_to_spec(None, [('_id', 1)], [5]),
+                         {'_id': {'$gt': 5}})
+
+    def test_include_sort_fields(self):
+        """The sort keys are always returned."""
+        sort = [('name', 1), ('_id', 1)]
+        self.assertEqual(include_sort_fields(None, sort), None)
+        self.assertEqual(include_sort_fields(['title'], sort),
+                         ['title', 'name', '_id'])
+        self.assertEqual(include_sort_fields({'title': 1}, sort),
+                         {'title': 1, 'name': 1, '_id': 1})
+        self.assertEqual(include_sort_fields({'name': 0, 'text': 0}, sort),
+                         {'text': 0})
+        self.assertEqual(include_sort_fields({'name': 0}, sort), None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Test queries.py."""
+
+from unittest import TestCase, main
+from magpy.server.queries import query_shape, sort_shape, QueryRecorder, \
+    suggest_index, explain_summary, needs_index, placeholder_spec, \
+    load_shape
+
+# pylint: disable=R0904
+
+
+class TestQueryShape(TestCase):
+    """Test taking the values out of queries."""
+
+    def test_values_removed(self):
+        """Values become 1, operators are kept."""
+        self.assertEqual(
+            query_shape({'author': 'austen', 'year': {'$gt': 1800}}),
+            {'author': 1, 'year': {'$gt': 1}})
+
+    def test_same_shape(self):
+        """Queries that differ only by value have the same shape."""
+        self.assertEqual(query_shape({'author': 'austen'}),
+                         query_shape({'author': 'bronte'}))
+
+    def test_logical_operators(self):
+        """The clauses of $or are shaped too."""
+        self.assertEqual(
+            query_shape({'$or': [{'a': 1}, {'b': {'$in': [1, 2]}}]}),
+            {'$or': [{'a': 1}, {'b': {'$in': 1}}]})
+
+    def test_embedded_document(self):
+        """An embedded document without operators is a value."""
+        self.assertEqual(query_shape({'name': {'first': 'jane'}}),
+                         {'name': 1})
+
+    def test_placeholder_spec(self):
+        """A shape can be explained with placeholder values."""
+        self.assertEqual(
+            placeholder_spec({'author': 1,
+                              'year': {'$gt': 1},
+                              '$or': [{'a': 1}, {'b': {'$in': 1}}]}),
+            {'author': None,
+             'year': {'$gt': None},
+             '$or': [{'a': None}, {'b': {'$in': [None]}}]})
+
+    def test_sort_shape(self):
+        """Sorts become lists of [field, direction]."""
+        self.assertEqual(sort_shape('title'), [['title', 1]])
+        self.assertEqual(sort_shape([('year', -1)]), [['year', -1]])
+        self.assertEqual(sort_shape(None), [])
+
+
+class TestQueryRecorder(TestCase):
+    """Test recording queries."""
+
+    def test_record(self):
+        """Queries of the same shape are counted together."""
+        recorder = QueryRecorder()
+        recorder.record('db', 'book', {'author': 'austen'}, None, None, 0.01)
+        recorder.record('db', 'book', {'author': 'bronte'}, None, None, 0.03)
+        recorder.record('db', 'book', {'year': 1813}, None, None, 0.01)
+        shapes = recorder.drain()
+        self.assertEqual(len(shapes), 2)
+        counts = sorted(entry['count'] for entry in shapes.values())
+        self.assertEqual(counts, [1, 2])
+        entry = [entry for entry in shapes.values()
+                 if entry['count'] == 2][0]
+        self.assertAlmostEqual(entry['total_ms'], 40.0)
+        self.assertAlmostEqual(entry['max_ms'], 30.0)
+        # The values are never kept
+        self.assertNotIn('bronte', repr(entry))
+        self.assertEqual(recorder.drain(), {})
+
+    def test_max_shapes(self):
+        """New shapes are ignored once the recorder is full."""
+        recorder = QueryRecorder(max_shapes=1)
+        recorder.record('db', 'book', {'author': 'austen'}, None, None, 0)
+        recorder.record('db', 'book', {'year': 1813}, None, None, 0)
+        recorder.record('db', 'book', {'author': 'bronte'}, None, None, 0)
+        shapes = recorder.drain()
+        self.assertEqual(len(shapes), 1)
+        self.assertEqual(list(shapes.values())[0]['count'], 2)
+
+    def test_flush(self):
+        """Shapes are stored as JSON, as their keys are not allowed
+        as field names, and the longest time is kept."""
+        updates = []
+
+        class Collection(object):
+            """Keeps the updates."""
+            # pylint: disable=R0201
+            def update(self, spec, document, **kwargs):
+                """Keep the update."""
+                updates.append((spec, document, kwargs))
+
+        recorder = QueryRecorder()
+        recorder.record('db', 'book',
+                        {'_meta._version': 2, 'year': {'$gt': 1800}},
+                        None, None, 0.01)
+        recorder.flush({'db': {'_query_stats': Collection()}})
+        self.assertEqual(len(updates), 1)
+        document = updates[0][1]
+        self.assertEqual(load_shape(document['$set']['shape']),
+                         {'_meta._version': 1, 'year': {'$gt': 1}})
+        self.assertEqual(document['$max'], {'last_max_ms': 10.0})
+        self.assertNotIn('last_max_ms', document['$set'])
+        self.assertTrue(callable(updates[0][2]['callback']))
+        # Shapes stored by older versions are still read
+        self.assertEqual(load_shape({'author': 1}), {'author': 1})
+
+
+class TestAdvice(TestCase):
+    """Test suggesting indexes."""
+
+    def test_suggest_index(self):
+        """Equality fields first, then the sort, then ranges."""
+        self.assertEqual(
+            suggest_index({'author': 1, 'year': {'$gt': 1}},
+                          [['title', 1]]),
+            [('author', 1), ('title', 1), ('year', 1)])
+
+    def test_suggest_in(self):
+        """$in counts as equality."""
+        self.assertEqual(
+            suggest_index({'year': {'$gt': 1}, 'author': {'$in': 1}}, []),
+            [('author', 1), ('year', 1)])
+
+    def test_suggest_nothing(self):
+        """No index for $or queries or just the _id sort."""
+        self.assertEqual(suggest_index({'$or': [{'a': 1}]}, []), None)
+        self.assertEqual(suggest_index({}, [['_id', 1]]), None)
+
+    def test_old_explain(self):
+        """Explain output from MongoDB 2."""
+        summary = explain_summary({'cursor': 'BasicCursor',
+                                   'nscanned': 1000,
+                                   'nscannedObjects': 1000,
+                                   'n': 5,
+                                   'scanAndOrder': True})
+        self.assertEqual(summary, {'index': None,
+                                   'examined': 1000,
+                                   'returned': 5,
+                                   'in_memory_sort': True})
+        self.assertTrue(needs_index(summary))
+        summary = explain_summary({'cursor': 'BtreeCursor magpy_author_1',
+                                   'nscanned': 5, 'nscannedObjects': 5,
+                                   'n': 5})
+        self.assertEqual(summary['index'], 'magpy_author_1')
+        self.assertFalse(needs_index(summary))
+
+    def test_new_explain(self):
+        """Explain output from MongoDB 3 onwards."""
+        summary = explain_summary({
+            'queryPlanner': {'winningPlan': {
+                'stage': 'SORT',
+                'inputStage': {
+                    'stage': 'FETCH',
+                    'inputStage': {'stage': 'IXSCAN',
+                                   'indexName': 'magpy_author_1'}}}},
+            'executionStats': {'nReturned': 5,
+                               'totalKeysExamined': 8,
+                               'totalDocsExamined': 8}})
+        self.assertEqual(summary, {'index': 'magpy_author_1',
+                                   'examined': 8,
+                                   'returned': 5,
+                                   'in_memory_sort': True})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Test serialization.py."""
+
+import json
+from datetime import datetime
+from decimal import Decimal
+from unittest import TestCase, main
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+from magpy.server import serialization
+from magpy.server.serialization import dumps, loads
+
+# pylint: disable=R0904
+
+OBJECT_ID = ObjectId('51c1a5a1e138235e1d7c3f39')
+WHEN = datetime(2013, 6, 19, 12, 30, 5, 250000, tzinfo=utc)
+DOCUMENT = {'_id': OBJECT_ID,
+            'title': 'Emma',
+            'published': WHEN,
+            'price': Decimal('7.50'),
+            'chapters': [{'number': 1}, {'number': 2}]}
+
+
+class TestSerialization(TestCase):
+    """Test the JSON layer."""
+    def test_format(self):
+        """BSON types come out the way mag.js expects."""
+        self.assertEqual(
+            json.loads(dumps(DOCUMENT)),
+            {'_id': {'$oid': '51c1a5a1e138235e1d7c3f39'},
+             'title': 'Emma',
+             'published': {'$date': 1371645005250},
+             'price': 7.5,
+             'chapters': [{'number': 1}, {'number': 2}]})
+
+    def test_naive_datetime(self):
+        """Naive datetimes are taken to be UTC."""
+        self.assertEqual(
+            json.loads(dumps(WHEN.replace(tzinfo=None))),
+            {'$date': 1371645005250})
+
+    def test_round_trip(self):
+        """The types come back again."""
+        document = loads(dumps(DOCUMENT))
+        self.assertEqual(document['_id'], OBJECT_ID)
+        self.assertEqual(document['published'], WHEN)
+        self.assertEqual(loads(dumps(DOCUMENT).encode('utf-8')), document)
+
+    def test_other_operators(self):
+        """Query operators are left alone."""
+        self.assertEqual(loads('{"_id": {"$in": ["a", "b"]}}'),
+                         {'_id': {'$in': ['a', 'b']}})
+
+    def test_without_orjson(self):
+        """The plain json module gives the same answer."""
+        fast = dumps(DOCUMENT)
+        backend = serialization.orjson
+        serialization.orjson = None
+        try:
+            self.assertEqual(json.loads(dumps(DOCUMENT)), json.loads(fast))
+        finally:
+            serialization.orjson = backend
+
+    def test_big_integers(self):
+        """Integers bigger than 64 bits still work."""
+        self.assertEqual(loads(dumps({'big': 2 ** 70})), {'big': 2 ** 70})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Test streaming.py."""
+
+import json
+from unittest import TestCase, main
+from magpy.server.streaming import ListStreamWriter
+
+# pylint: disable=R0904
+
+
+class FakeHandler(object):
+    """Records what is written, flushed and finished."""
+    def __init__(self):
+        self.settings = {}
+        self.headers = {}
+        self.written = []
+        self.flushes = 0
+        self.finished = False
+
+    def set_header(self, name, value):
+        """Record a header."""
+        self.headers[name] = value
+
+    def write(self, chunk):
+        """Record a write."""
+        self.written.append(chunk)
+
+    def flush(self):
+        """Count the flushes."""
+        self.flushes += 1
+
+    def finish(self):
+        """Note the response is done."""
+        self.finished = True
+
+
+class TestListStreamWriter(TestCase):
+    """Test the batched list writer."""
+    def setUp(self):  # pylint: disable=C0103
+        self.handler = FakeHandler()
+
+    def output(self):
+        """The JSON that was written."""
+        return json.loads(b''.join(self.handler.written).decode('utf-8'))
+
+    def test_envelope(self):
+        """The output is the usual list envelope."""
+        writer = ListStreamWriter(self.handler)
+        writer.start(2)
+        writer.add({'_id': 'one'})
+        writer.add({'_id': 'two'})
+        writer.finish()
+        self.assertEqual(
+            self.output(),
+            {'count': 2, 'results': [{'_id': 'one'}, {'_id': 'two'}]})
+        self.assertTrue(self.handler.finished)
+
+    def test_empty(self):
+        """No results, no count."""
+        writer = ListStreamWriter(self.handler)
+        writer.start()
+        writer.finish()
+        self.assertEqual(b''.join(self.handler.written), b'{"results":[]}')
+
+    def test_zero_count(self):
+        """A count of zero is still given."""
+        writer = ListStreamWriter(self.handler)
+        writer.start(0)
+        writer.finish()
+        self.assertEqual(self.output(),
+                         {'count': 0, 'results': []})
+
+    def test_flush_count(self):
+        """Flushes once per batch of documents, not per document."""
+        writer = ListStreamWriter(self.handler, flush_count=10)
+        writer.start()
+        for number in range(25):
+            writer.add({'_id': number})
+        self.assertEqual(self.handler.flushes, 2)
+        writer.finish()
+        self.assertEqual(
+            len(self.output()['results']), 25)
+
+    def test_flush_bytes(self):
+        """Flushes when enough bytes are waiting."""
+        writer = ListStreamWriter(self.handler, flush_bytes=100)
+        writer.start()
+        writer.add({'text': 'x' * 200})
+        self.assertEqual(self.handler.flushes, 1)
+
+    def test_flush_multibyte(self):
+        """Bytes are counted, not characters.
+        (Only the orjson serialiser leaves the text unescaped.)"""
+        writer = ListStreamWriter(self.handler, flush_bytes=100)
+        writer.start()
+        writer.add({'text': u'\u03b1' * 60})
+        self.assertEqual(self.handler.flushes, 1)
+        writer.finish()
+        self.assertEqual(
+            self.output(),
+            {'results': [{'text': u'\u03b1' * 60}]})
+
+    def test_extra(self):
+        """Extra keys go after the results."""
+        writer = ListStreamWriter(self.handler)
+        writer.start()
+        writer.finish(after='token')
+        self.assertEqual(self.output(),
+                         {'results': [], 'after': 'token'})
+
+
+if __name__ == '__main__':
+    main()
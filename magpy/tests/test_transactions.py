@@ -0,0 +1,68 @@
+"""Test transactions.py."""
+
+from unittest import TestCase, main
+from magpy.server.transactions import ChangeCoalescer
+
+# pylint: disable=R0904
+
+
+def entry(history_id, document_id, operation, document=True):
+    """Make a history entry."""
+    version = {'_id': history_id,
+               'document_id': document_id,
+               'document_model': 'book',
+               'operation': operation}
+    if document:
+        version['document'] = {'_id': document_id,
+                               '_model': 'book',
+                               'title': 'Version %s' % history_id}
+    return version
+
+
+class ChangeCoalescerTestCase(TestCase):
+    """Test the coalescing of a page of history."""
+
+    def test_latest_change_kept(self):
+        """Several changes to an instance become the latest."""
+        coalescer = ChangeCoalescer()
+        coalescer.add(entry(1, 'emma', 'create'))
+        coalescer.add(entry(2, 'persuasion', 'create'))
+        coalescer.add(entry(3, 'emma', 'update'))
+        changes = list(coalescer)
+        self.assertEqual([change['_id'] for change in changes], [2, 3])
+        self.assertEqual(changes[1]['document']['title'], 'Version 3')
+        self.assertEqual(changes[1]['operation'], 'update')
+        self.assertEqual(coalescer.scanned, 3)
+        self.assertEqual(coalescer.last_id, 3)
+
+    def test_delete_has_no_document(self):
+        """A delete is sent without the instance."""
+        coalescer = ChangeCoalescer()
+        coalescer.add(entry(1, 'emma', 'update'))
+        coalescer.add(entry(2, 'emma', 'delete'))
+        changes = list(coalescer)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['operation'], 'delete')
+        self.assertFalse('document' in changes[0])
+        self.assertEqual(coalescer.missing(), {})
+
+    def test_fill_in_deltas(self):
+        """Deltas get the instance as it is now, or become deletes."""
+        coalescer = ChangeCoalescer()
+        coalescer.add(entry(1, 'emma', 'update', document=False))
+        coalescer.add(entry(2, 'persuasion', 'update', document=False))
+        coalescer.add(entry(3, 'sanditon', 'update'))
+        self.assertEqual(coalescer.missing(),
+                         {'book': ['emma', 'persuasion']})
+        coalescer.fill_in([{'_id': 'emma', 'title': 'Emma'}], 'book')
+        changes = dict((change['document_id'], change)
+                       for change in coalescer)
+        self.assertEqual(changes['emma']['document']['title'], 'Emma')
+        self.assertEqual(changes['persuasion']['operation'], 'delete')
+        self.assertFalse('document' in changes['persuasion'])
+        self.assertEqual(changes['sanditon']['document']['title'],
+                         'Version 3')
+
+
+if __name__ == '__main__':
+    main()
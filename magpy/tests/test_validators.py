@@ -22,7 +22,8 @@ from magpy.server.validators import validate_integer, ValidationError, \
     validate_float, validate_nullboolean, validate_postiveinteger, \
     validate_smallinteger, validate_biginteger, \
     validate_positivesmallinteger, validate_text, validate_time, \
-    validate_bool, validate_decimal, validate_modification, ValidationError
+    validate_bool, validate_decimal, validate_modification, ValidationError, \
+    get_model_plan, get_model_fingerprint
     # validate_long
 
 
@@ -596,6 +597,70 @@ class TestModelValidator(TestCase):
              'height': 176,
              'alt': 'Zeth Ltd Header Logo'})
 
+class TestModelPlan(TestCase):
+    """Test the compiled model plans."""
+    def test_plan_is_cached(self):
+        """The same model definition gives the same plan."""
+        self.assertIs(get_model_plan(IMAGE), get_model_plan(dict(IMAGE)))
+
+    def test_changed_model_gets_new_plan(self):
+        """Changing the model definition gives a new plan."""
+        changed = dict(IMAGE)
+        changed['caption'] = {'field': 'Char'}
+        plan = get_model_plan(changed)
+        self.assertIsNot(plan, get_model_plan(IMAGE))
+        self.assertIn('caption', plan.required_keys)
+
+    def test_model_content_is_used(self):
+        """Models are identified by their content, not their version."""
+        versioned = dict(IMAGE)
+        versioned['_meta'] = {'_version': 3}
+        plan = get_model_plan(versioned)
+        altered = dict(versioned)
+        altered['caption'] = {'field': 'Char'}
+        altered_plan = get_model_plan(altered)
+        self.assertIsNot(altered_plan, plan)
+        self.assertIn('caption', altered_plan.required_keys)
+        # Only the metadata has changed
+        resaved = dict(versioned)
+        resaved['_meta'] = {'_version': 4}
+        self.assertIs(get_model_plan(resaved), plan)
+
+    def test_fingerprint_is_kept(self):
+        """A model object is only fingerprinted once."""
+        model = dict(IMAGE)
+        fingerprint = get_model_fingerprint(model)
+        # Not worked out again, even though (wrongly) changed in place
+        model['caption'] = {'field': 'Char'}
+        self.assertEqual(get_model_fingerprint(model), fingerprint)
+        self.assertNotEqual(get_model_fingerprint(dict(model)), fingerprint)
+
+    def test_key_sets(self):
+        """Required and optional keys are precomputed."""
+        plan = get_model_plan(IMAGE)
+        self.assertEqual(plan.required_keys,
+                         frozenset(['width', 'height', 'alt']))
+        self.assertEqual(plan.optional_keys, frozenset(['src']))
+
+    def test_embedded_list_of_many_items(self):
+        """A long embedded list validates with the shared plans."""
+        article = dict(TEST_ARTICLE)
+        article['comments'] = TEST_ARTICLE['comments'] * 500
+        self.assertEqual(
+            validate_model_instance(
+                EMBEDDED_MODELS['article'],
+                article,
+                embedded_models=EMBEDDED_MODELS),
+            None)
+        article['comments'] = article['comments'] + [
+            {'_model': 'comment', 'text': 1, 'author': {}}]
+        self.assertRaises(
+            ValidationError,
+            validate_model_instance,
+            EMBEDDED_MODELS['article'],
+            article,
+            embedded_models=EMBEDDED_MODELS)
+
 EMBEDDED_MODELS = {
     'article': {
     '_id': 'article',
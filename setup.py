@@ -7,6 +7,8 @@ python setup.py install
 """
 #!/usr/bin/env python
 
+import sys
+
 try:
     from setuptools import setup
 except ImportError:
@@ -40,5 +42,6 @@ setup(name='Magpy',
                               'static/js/sync.js'],
                     'magpy.server': ['defaultconfig.json'],
                     },
-      install_requires=['motor', 'six'],
+      install_requires=['motor', 'six'] + (
+          ['futures'] if sys.version_info[0] == 2 else []),
      )